@@ -0,0 +1,494 @@
+#!/usr/bin/env python
+# encoding:utf-8
+
+"""
+进程监测核心功能实现 - 告警规则
+
+主要包括
+- 告警规则 : 规则文本只解析一次, 按数据序列名建立索引, 每次采样只计算涉及到的规则
+- 持续时间(for) : 条件持续满足一段时间后才触发
+- 回差(clear) : 触发后数值回到恢复阈值才解除, 避免在阈值附近反复触发/解除
+- 去重 : 同一规则的同一序列只在 触发/解除 时各产生一次事件 (可设置 repeat 重复提醒间隔), 相同规则只保存一份
+- 数据来源 : 后台采样器(与 metrics_store 序列名一致), 磁盘使用率, 进程是否存在, 日志关键词出现次数
+
+规则格式
+    <序列名> <比较符> <阈值> [for <持续时间>] [clear <恢复阈值>] [repeat <提醒间隔>]
+        sys.cpu_percent > 90 for 5m clear 80
+        process.1234.cpu_percent > 90% for 5m
+        process.*.rss > 1048576                     (通配符, 对每个匹配的序列分别告警)
+    disk <挂载点|*> used_percent <比较符> <阈值> [...]
+        disk / used_percent > 95
+    pid <pid> gone [...]
+        pid 1234 gone
+    log <日志路径> "<关键词>" rate <比较符> <次数>[/s|/m|/h] [...]
+        log /var/log/app.log "ERROR" rate > 10/m
+
+持续时间 : 数字 + s/m/h/d (默认秒), 比较符 : > >= < <= == !=
+进程相关的序列需要采样器关注该进程, 指定pid的规则会自动关注.
+"""
+
+import os
+import re
+import fnmatch
+import operator
+import threading
+from collections import deque
+from time import time
+
+from sys_monitor import get_disk_stat
+from metrics_store import sample_values
+
+# 保存的告警事件数量
+ALERT_HISTORY_SIZE = 1000
+# 磁盘使用率的检查间隔(秒)
+ALERT_DISK_INTERVAL = 10
+# 每次采样最多读取的日志字节数
+ALERT_LOG_READ_LIMIT = 4 * 1024 ** 2
+# 没有新数据的告警的清理间隔/超时时间(秒), 如退出的进程
+ALERT_STALE_SECONDS = 60
+# 通配符匹配结果缓存的序列名数量
+ALERT_GLOB_CACHE_SIZE = 65536
+
+# 告警状态
+ALERT_PENDING = "pending"  # 条件满足, 未达到持续时间
+ALERT_FIRING = "firing"
+ALERT_RESOLVED = "resolved"
+
+_OPS = {
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le,
+    "==": operator.eq,
+    "!=": operator.ne,
+}
+_DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+_OP = r"(?P<op>>=|<=|==|!=|>|<)"
+_NUMBER = r"(?P<value>-?\d+(?:\.\d+)?)%?"
+_OPTIONS = r"(?P<options>(?:\s+\S+\s+\S+)*)\s*$"
+_RULE_PATTERNS = (
+    ("pid", re.compile(r"^pid\s+(?P<pid>\d+)\s+gone" + _OPTIONS)),
+    ("disk", re.compile(r"^disk\s+(?P<mount>\S+)\s+used_percent\s*" + _OP + r"\s*" + _NUMBER + _OPTIONS)),
+    ("log", re.compile(r'^log\s+(?P<path>\S+)\s+"(?P<keyword>[^"]+)"\s+rate\s*' + _OP + r"\s*" + _NUMBER +
+                       r"(?:/(?P<unit>[smh]))?" + _OPTIONS)),
+    ("metric", re.compile(r"^(?P<metric>\S+?)\s*" + _OP + r"\s*" + _NUMBER + _OPTIONS)),
+)
+_PROCESS_METRIC = re.compile(r"^process\.(\d+)\.")
+
+
+def parse_duration(text):
+    """持续时间 5m -> 300 (秒)"""
+    m = re.match(r"^(\d+(?:\.\d+)?)([smhd]?)$", text)
+    if m is None:
+        raise ValueError("invalid duration : {}".format(text))
+    return float(m.group(1)) * _DURATION_UNITS.get(m.group(2) or "s")
+
+
+def disk_metric(mount):
+    """磁盘使用率序列名"""
+    return "disk.{}.used_percent".format(mount)
+
+
+def log_metric(path, keyword, window):
+    """日志关键词次数序列名 (最近 window 秒内包含关键词的行数)"""
+    return "log.{}.{}.count_{:g}s".format(path, keyword, window)
+
+
+def alive_metric(pid):
+    """进程是否存在序列名 (1 - 存在, 0 - 已退出)"""
+    return "process.{}.alive".format(pid)
+
+
+class Rule(object):
+    """编译后的告警规则"""
+    __slots__ = ("id", "text", "severity", "metric", "is_pattern", "op", "threshold", "clear", "duration",
+                 "repeat", "source", "alerts")
+
+    def __init__(self, rule_id, text, severity="warning"):
+        self.id = rule_id
+        self.text = " ".join(text.split())
+        self.severity = severity
+        self.clear = None  # 恢复阈值 (None - 与阈值相同)
+        self.duration = 0
+        self.repeat = 0
+        self.source = None  # 需要额外采集的数据 ("pid", pid) / ("disk", 挂载点) / ("log", 路径, 关键词, 时间窗口)
+        self.alerts = {}  # 序列名 -> _Alert (只保存未恢复的告警)
+        self._compile()
+
+    def _compile(self):
+        """解析规则文本"""
+        for kind, pattern in _RULE_PATTERNS:
+            m = pattern.match(self.text)
+            if m is not None:
+                break
+        else:
+            raise ValueError("invalid alert rule : {}".format(self.text))
+
+        fields = m.groupdict()
+        if kind == "pid":
+            self.metric, self.op, self.threshold = alive_metric(fields["pid"]), operator.lt, 1
+            self.source = ("pid", fields["pid"])
+        else:
+            self.op, self.threshold = _OPS[fields["op"]], float(fields["value"])
+            if kind == "disk":
+                self.metric = disk_metric(fields["mount"])
+                self.source = ("disk", fields["mount"])
+            elif kind == "log":
+                window = _DURATION_UNITS[fields["unit"] or "s"]
+                self.metric = log_metric(fields["path"], fields["keyword"], window)
+                self.source = ("log", fields["path"], fields["keyword"], window)
+            else:
+                self.metric = fields["metric"]
+                m = _PROCESS_METRIC.match(self.metric)
+                if m is not None:
+                    self.source = ("pid", m.group(1))
+        self.is_pattern = any(c in self.metric for c in "*?[")
+
+        options = fields["options"].split()
+        for key, value in zip(options[0::2], options[1::2]):
+            if key == "for":
+                self.duration = parse_duration(value)
+            elif key == "repeat":
+                self.repeat = parse_duration(value)
+            elif key == "clear" and kind != "pid":
+                self.clear = float(value.rstrip("%"))
+            else:
+                raise ValueError("invalid alert rule option '{} {}' : {}".format(key, value, self.text))
+
+    def trigger(self, value):
+        """是否满足触发条件"""
+        return self.op(value, self.threshold)
+
+    def hold(self, value):
+        """已触发的告警是否保持 (数值没有回到恢复阈值)"""
+        if self.clear is None or self.op in (operator.eq, operator.ne):
+            return self.op(value, self.threshold)
+        return self.op(value, self.clear)
+
+    def to_dict(self):
+        """规则信息"""
+        return {"id": self.id, "text": self.text, "severity": self.severity, "metric": self.metric,
+                "threshold": self.threshold, "clear": self.clear, "duration": self.duration, "repeat": self.repeat,
+                "alerts": len(self.alerts)}
+
+
+class _Alert(object):
+    """某一规则在某一序列上的告警状态"""
+    __slots__ = ("state", "since", "fired", "notified", "updated", "value")
+
+    def __init__(self, now, value):
+        self.state = ALERT_PENDING
+        self.since = now  # 条件开始满足的时间
+        self.fired = None  # 触发时间
+        self.notified = None  # 最近一次提醒时间
+        self.updated = now
+        self.value = value
+
+
+class _LogTail(object):
+    """增量读取日志, 统计最近一段时间内包含关键词的行数 (日志轮转/截断后从头读取)"""
+
+    def __init__(self, path):
+        self.path = path
+        self.windows = {}  # 关键词 -> 需要的时间窗口集合
+        self._counts = {}  # 关键词 -> deque([(时间, 行数), ...])
+        self._offset = None
+        self._inode = None
+        self._partial = b""
+
+    def _read(self):
+        """读取新增的完整行"""
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return []
+        if self._offset is None:  # 只统计开始关注之后写入的内容
+            self._offset, self._inode = st.st_size, st.st_ino
+            return []
+        if st.st_ino != self._inode or st.st_size < self._offset:
+            self._offset, self._inode, self._partial = 0, st.st_ino, b""
+        if st.st_size == self._offset:
+            return []
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(self._offset)
+                data = f.read(ALERT_LOG_READ_LIMIT)
+        except IOError:
+            return []
+        self._offset += len(data)
+        lines = (self._partial + data).split(b"\n")
+        self._partial = lines.pop()[-ALERT_LOG_READ_LIMIT:]
+        return lines
+
+    def update(self, now):
+        """读取新增内容, 返回 {序列名: 时间窗口内的行数}"""
+        lines = self._read()
+        data = b"\n".join(lines)
+        values = {}
+        for keyword, windows in self.windows.items():
+            counts = self._counts.setdefault(keyword, deque())
+            n = sum(1 for line in lines if keyword in line) if keyword in data else 0
+            counts.append((now, n))
+            longest = max(windows)
+            while counts and counts[0][0] <= now - longest:
+                counts.popleft()
+            for window in windows:
+                values[log_metric(self.path, keyword, window)] = sum(c for t, c in counts if t > now - window)
+        return values
+
+
+class AlertEngine(object):
+    """告警规则引擎 (线程安全)"""
+
+    def __init__(self, history_size=ALERT_HISTORY_SIZE):
+        self._rules = {}  # 规则id -> Rule
+        self._texts = {}  # 规则文本 -> 规则id
+        self._exact = {}  # 序列名 -> [Rule, ...]
+        self._patterns = {}  # 通配符 -> [Rule, ...]
+        self._pattern_cache = {}  # 序列名 -> 匹配的通配符规则
+        self._pids = set()
+        self._disks = set()
+        self._logs = {}  # 日志路径 -> _LogTail
+        self._next_id = 1
+        self._last_disk = 0
+        self._last_sweep = 0
+        self._lock = threading.RLock()
+        self._callbacks = []
+        self.history = deque(maxlen=history_size)
+        self.sampler = None
+        self.evaluated = 0  # 累计规则计算次数
+
+    def add_rule(self, text, severity="warning"):
+        """添加告警规则, 返回规则id (相同规则只添加一次, 返回已有规则的id)"""
+        with self._lock:
+            rule_id = self._texts.get(" ".join(text.split()))
+            if rule_id is not None:
+                return rule_id
+            rule = Rule(self._next_id, text, severity)
+            self._next_id += 1
+            self._rules[rule.id] = rule
+            self._texts[rule.text] = rule.id
+            index = self._patterns if rule.is_pattern else self._exact
+            index.setdefault(rule.metric, []).append(rule)
+            if rule.is_pattern:
+                self._pattern_cache.clear()
+            self._update_sources()
+            return rule.id
+
+    def remove_rule(self, rule_id):
+        """删除告警规则 (未恢复的告警不再产生事件)"""
+        with self._lock:
+            rule = self._rules.pop(rule_id, None)
+            if rule is None:
+                return False
+            del self._texts[rule.text]
+            index = self._patterns if rule.is_pattern else self._exact
+            index[rule.metric].remove(rule)
+            if not index[rule.metric]:
+                del index[rule.metric]
+            if rule.is_pattern:
+                self._pattern_cache.clear()
+            self._update_sources()
+            return True
+
+    def get_rules(self):
+        """所有告警规则"""
+        with self._lock:
+            return [self._rules[rule_id].to_dict() for rule_id in sorted(self._rules)]
+
+    def get_alerts(self):
+        """未恢复的告警 (pending/firing)"""
+        with self._lock:
+            return [self._event(rule, metric, alert, alert.state, alert.updated)
+                    for rule in self._rules.values() for metric, alert in rule.alerts.items()]
+
+    def get_history(self, count=100):
+        """最近的告警事件"""
+        with self._lock:
+            return list(self.history)[-count:]
+
+    def subscribe(self, callback):
+        """订阅告警事件 callback(事件) (在采样线程中调用)"""
+        with self._lock:
+            if callback not in self._callbacks:
+                self._callbacks.append(callback)
+
+    def unsubscribe(self, callback):
+        """取消订阅"""
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def _update_sources(self):
+        """根据规则更新需要额外采集的数据 (需持有锁)"""
+        pids, disks, windows = set(), set(), {}
+        for rule in self._rules.values():
+            if rule.source is None:
+                continue
+            if rule.source[0] == "pid":
+                pids.add(rule.source[1])
+            elif rule.source[0] == "disk":
+                disks.add(rule.source[1])
+            else:
+                path, keyword, window = rule.source[1:]
+                windows.setdefault(path, {}).setdefault(keyword, set()).add(window)
+        if self.sampler is not None:
+            for pid in pids - self._pids:
+                self.sampler.watch_process(pid)
+        self._pids, self._disks = pids, disks
+        for path in list(self._logs):
+            if path not in windows:
+                del self._logs[path]
+        for path, keywords in windows.items():
+            tail = self._logs.get(path)
+            if tail is None:
+                tail = self._logs[path] = _LogTail(path)
+            tail.windows = keywords
+
+    def attach(self, sampler):
+        """订阅采样器, 每次采样后计算规则 (采样器需要另外启动)"""
+        with self._lock:
+            self.sampler = sampler
+            for pid in self._pids:
+                sampler.watch_process(pid)
+        sampler.subscribe(self.on_sample)
+
+    def detach(self):
+        """取消订阅采样器"""
+        if self.sampler is not None:
+            self.sampler.unsubscribe(self.on_sample)
+            self.sampler = None
+
+    def on_sample(self, prev, last):
+        """采样回调 - 计算序列值并计算规则"""
+        if prev is None:
+            return
+        values = sample_values(prev, last)
+        with self._lock:
+            pids, disks, logs = self._pids, self._disks, list(self._logs.values())
+            check_disk = disks and last.time - self._last_disk >= ALERT_DISK_INTERVAL
+            if check_disk:
+                self._last_disk = last.time
+        for pid in pids:
+            values[alive_metric(pid)] = 1 if pid in last.process else 0
+        if check_disk:
+            values.update(read_disk_used_percent(disks))
+        for tail in logs:
+            values.update(tail.update(last.time))
+        self.evaluate(values, last.time)
+
+    def evaluate(self, values, now=None):
+        """
+        计算规则 (只计算 values 中的序列涉及到的规则)
+        :param values: 序列名 -> 数值
+        :return: 本次产生的告警事件
+        """
+        now = time() if now is None else now
+        events = []
+        with self._lock:
+            exact = self._exact
+            if len(values) <= len(exact):
+                for metric, value in values.items():
+                    for rule in exact.get(metric, ()):
+                        self._step(rule, metric, value, now, events)
+            else:
+                for metric, rules in exact.items():
+                    if metric in values:
+                        for rule in rules:
+                            self._step(rule, metric, values[metric], now, events)
+            if self._patterns:
+                for metric, value in values.items():
+                    for rule in self._match_patterns(metric):
+                        self._step(rule, metric, value, now, events)
+            if now - self._last_sweep >= ALERT_STALE_SECONDS:
+                self._sweep(now, events)
+            self.history.extend(events)
+            callbacks = list(self._callbacks)
+        for event in events:
+            for callback in callbacks:
+                try:
+                    callback(event)
+                except Exception as err:
+                    print "Error : alert callback - {}".format(err)
+        return events
+
+    def _match_patterns(self, metric):
+        """序列名匹配的通配符规则 (结果缓存)"""
+        rules = self._pattern_cache.get(metric)
+        if rules is None:
+            if len(self._pattern_cache) >= ALERT_GLOB_CACHE_SIZE:
+                self._pattern_cache.clear()
+            rules = [rule for pattern, pattern_rules in self._patterns.items()
+                     if fnmatch.fnmatchcase(metric, pattern) for rule in pattern_rules]
+            self._pattern_cache[metric] = rules
+        return rules
+
+    def _step(self, rule, metric, value, now, events):
+        """根据新数值更新某一规则在某一序列上的告警状态"""
+        self.evaluated += 1
+        alert = rule.alerts.get(metric)
+        if alert is None:
+            if not rule.trigger(value):
+                return
+            alert = rule.alerts[metric] = _Alert(now, value)
+        alert.value, alert.updated = value, now
+
+        if alert.state == ALERT_PENDING:
+            if not rule.trigger(value):
+                del rule.alerts[metric]
+            elif now - alert.since >= rule.duration:
+                alert.state = ALERT_FIRING
+                alert.fired = alert.notified = now
+                events.append(self._event(rule, metric, alert, ALERT_FIRING, now))
+        elif not rule.hold(value):
+            del rule.alerts[metric]
+            events.append(self._event(rule, metric, alert, ALERT_RESOLVED, now))
+        elif rule.repeat and now - alert.notified >= rule.repeat:
+            alert.notified = now
+            events.append(self._event(rule, metric, alert, ALERT_FIRING, now))
+
+    def _sweep(self, now, events):
+        """清理长时间没有新数据的告警 (如进程已退出), 已触发的产生解除事件 (需持有锁)"""
+        self._last_sweep = now
+        for rule in self._rules.values():
+            for metric, alert in rule.alerts.items():
+                if now - alert.updated < ALERT_STALE_SECONDS:
+                    continue
+                del rule.alerts[metric]
+                if alert.state == ALERT_FIRING:
+                    alert.value = None
+                    events.append(self._event(rule, metric, alert, ALERT_RESOLVED, now))
+
+    @staticmethod
+    def _event(rule, metric, alert, state, now):
+        """告警事件"""
+        return {"rule": rule.id, "text": rule.text, "severity": rule.severity, "metric": metric, "state": state,
+                "value": alert.value, "threshold": rule.threshold, "since": alert.since, "fired": alert.fired,
+                "time": now}
+
+    def get_status(self):
+        """规则引擎状态"""
+        with self._lock:
+            return {"rules": len(self._rules), "alerts": sum(len(r.alerts) for r in self._rules.values()),
+                    "evaluated": self.evaluated, "history": len(self.history)}
+
+
+def read_disk_used_percent(mounts):
+    """磁盘使用率 {序列名: 使用率}, "*" 表示所有物理磁盘挂载点 (与 get_disk_stat 一致)"""
+    values = {}
+    if "*" in mounts:
+        for disk in get_disk_stat():
+            values[disk_metric(disk[-1])] = disk[4]
+    for mount in mounts:
+        if mount == "*" or disk_metric(mount) in values:
+            continue
+        try:
+            st = os.statvfs(mount)
+        except OSError:
+            continue
+        block_size = st.f_bsize or st.f_frsize
+        total = st.f_blocks * block_size
+        if total:
+            values[disk_metric(mount)] = round((st.f_blocks - st.f_bfree) * block_size * 100.0 / total, 2)
+    return values
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# encoding:utf-8
+
+"""
+进程监测核心功能实现 - 异步接口
+
+主要包括
+- Future : 异步调用结果 (result 等待结果, add_done_callback 完成回调)
+- 有界线程池 : 执行较慢的文件系统操作(文件夹大小,日志搜索,statvfs,全进程遍历),队列满时立即返回失败
+- 各采集函数的异步版本 async_*, 返回 Future
+    - 单进程 /proc 读取等快速操作直接在调用线程中执行,返回已完成的 Future
+    - 较慢的操作放入线程池执行
+    - 速率计算(calc_*)不再 sleep, 由后台采样器(sampler)在下一次采样完成后给出结果
+
+在事件循环(twisted/tornado等)中使用时,通过 add_done_callback 的 call_soon 参数
+将回调转到事件循环线程中执行, 如 twisted 的 reactor.callFromThread, tornado 的 IOLoop.add_callback.
+等待速率结果不占用任何线程,一个事件循环可以同时处理大量查询.
+"""
+
+import threading
+from Queue import Queue, Full
+from functools import wraps
+
+import sys_monitor
+import process_monitor
+import process_manage
+import bulk_collect
+from sampler import sampler
+
+# 线程池线程数
+ASYNC_MAX_WORKERS = 4
+# 线程池等待队列长度
+ASYNC_MAX_QUEUE = 1024
+
+
+class FutureTimeout(Exception):
+    """等待结果超时"""
+    pass
+
+
+class ExecutorBusy(Exception):
+    """线程池等待队列已满"""
+    pass
+
+
+class Future(object):
+    """异步调用结果 (线程安全)"""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exception = None
+        self._callbacks = []  # (回调函数, call_soon)
+
+    def done(self):
+        """是否已经完成"""
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """等待并获取结果 (调用出错时抛出对应异常)"""
+        if not self._done.wait(timeout):
+            raise FutureTimeout()
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        """等待并获取调用异常 (没有异常返回None)"""
+        if not self._done.wait(timeout):
+            raise FutureTimeout()
+        return self._exception
+
+    def add_done_callback(self, callback, call_soon=None):
+        """
+        添加完成回调 callback(future)
+        :param call_soon: 回调的执行方式, 如 reactor.callFromThread (None - 在完成结果的线程中直接调用)
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append((callback, call_soon))
+                return
+        self._invoke(callback, call_soon)
+
+    def set_result(self, result):
+        """设置结果"""
+        self._finish(result, None)
+
+    def set_exception(self, exception):
+        """设置异常"""
+        self._finish(None, exception)
+
+    def _finish(self, result, exception):
+        """完成并执行回调"""
+        with self._lock:
+            if self._done.is_set():
+                return
+            self._result = result
+            self._exception = exception
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback, call_soon in callbacks:
+            self._invoke(callback, call_soon)
+
+    def _invoke(self, callback, call_soon):
+        """执行回调"""
+        try:
+            if call_soon is None:
+                callback(self)
+            else:
+                call_soon(callback, self)
+        except Exception as err:
+            print "Error : future callback - {}".format(err)
+
+
+class BoundedExecutor(object):
+    """有界线程池 (线程按需创建, 等待队列满时提交失败)"""
+
+    def __init__(self, max_workers=ASYNC_MAX_WORKERS, max_queue=ASYNC_MAX_QUEUE):
+        self.max_workers = max_workers
+        self._queue = Queue(max_queue)
+        self._workers = []
+        self._idle = 0
+        self._lock = threading.Lock()
+        self._shutdown = False
+
+    def submit(self, func, *args, **kwargs):
+        """提交任务,返回 Future"""
+        future = Future()
+        with self._lock:
+            if self._shutdown:
+                future.set_exception(ExecutorBusy("executor is shut down"))
+                return future
+            try:
+                self._queue.put_nowait((future, func, args, kwargs))
+            except Full:
+                future.set_exception(ExecutorBusy("executor queue is full ({})".format(self._queue.maxsize)))
+                return future
+            if self._idle > 0:
+                self._idle -= 1  # 该任务由空闲线程处理
+            elif len(self._workers) < self.max_workers:
+                worker = threading.Thread(target=self._work, name="watch_dogs_executor")
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+        return future
+
+    def _work(self):
+        """工作线程"""
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            future, func, args, kwargs = item
+            try:
+                future.set_result(func(*args, **kwargs))
+            except Exception as err:
+                future.set_exception(err)
+            with self._lock:
+                self._idle += 1
+
+    def shutdown(self, wait=True):
+        """关闭线程池 (已提交的任务会执行完)"""
+        with self._lock:
+            if self._shutdown:
+                return
+            self._shutdown = True
+            workers = list(self._workers)
+        for _ in workers:
+            self._queue.put(None)
+        if wait:
+            for worker in workers:
+                worker.join()
+
+    def get_status(self):
+        """线程池状态"""
+        with self._lock:
+            return {"workers": len(self._workers), "max_workers": self.max_workers,
+                    "queue": self._queue.qsize(), "max_queue": self._queue.maxsize}
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """获取默认线程池"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = BoundedExecutor()
+        return _executor
+
+
+def run_inline(func, *args, **kwargs):
+    """在当前线程执行,返回已完成的 Future"""
+    future = Future()
+    try:
+        future.set_result(func(*args, **kwargs))
+    except Exception as err:
+        future.set_exception(err)
+    return future
+
+
+def run_in_executor(func, *args, **kwargs):
+    """在默认线程池中执行,返回 Future"""
+    return get_executor().submit(func, *args, **kwargs)
+
+
+def _inline(func):
+    """快速操作的异步版本"""
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        return run_inline(func, *args, **kwargs)
+
+    return wrapper
+
+
+def _offload(func):
+    """较慢操作的异步版本"""
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        return run_in_executor(func, *args, **kwargs)
+
+    return wrapper
+
+
+def _wait_sampler(compute, *args):
+    """通过采样器计算速率, 数据不足时在下一次采样完成后重试"""
+    future = Future()
+
+    def attempt(prev=None, last=None):
+        try:
+            value = compute(*args)
+        except Exception as err:
+            future.set_exception(err)
+            return
+        if value is None:
+            sampler.call_on_next_sample(attempt)
+        else:
+            future.set_result(value)
+
+    sampler.start()
+    attempt()
+    return future
+
+
+# 系统 - 快速读取
+async_get_total_cpu_time = _inline(sys_monitor.get_total_cpu_time)
+async_get_cpu_total_time_by_cores = _inline(sys_monitor.get_cpu_total_time_by_cores)
+async_get_mem_info = _inline(sys_monitor.get_mem_info)
+async_calc_mem_percent = _inline(sys_monitor.calc_mem_percent)
+async_get_all_net_device = _inline(sys_monitor.get_all_net_device)
+async_get_net_dev_data = _inline(sys_monitor.get_net_dev_data)
+async_get_cpu_info = _inline(sys_monitor.get_cpu_info)
+async_get_sys_info = _inline(sys_monitor.get_sys_info)
+async_get_sys_total_mem = _inline(sys_monitor.get_sys_total_mem)
+async_get_sys_loadavg = _inline(sys_monitor.get_sys_loadavg)
+async_get_sys_uptime = _inline(sys_monitor.get_sys_uptime)
+# 系统 - statvfs (网络文件系统可能阻塞)
+async_get_disk_stat = _offload(sys_monitor.get_disk_stat)
+
+# 进程 - 快速读取
+async_get_all_pid = _inline(process_monitor.get_all_pid)
+async_get_process_info = _inline(process_monitor.get_process_info)
+async_get_process_cpu_time = _inline(process_monitor.get_process_cpu_time)
+async_get_process_start_time = _inline(process_monitor.get_process_start_time)
+async_get_process_mem = _inline(process_monitor.get_process_mem)
+async_get_process_io = _inline(process_monitor.get_process_io)
+async_get_process_net_history = _inline(process_monitor.get_process_net_history)
+async_get_process_parent_pid = _inline(process_manage.get_process_parent_pid)
+async_get_process_group_id = _inline(process_manage.get_process_group_id)
+async_get_process_execute_path = _inline(process_manage.get_process_execute_path)
+# 进程 - 文件系统/日志/全进程遍历
+async_get_path_total_size = _offload(process_monitor.get_path_total_size)
+async_get_path_avail_size = _offload(process_monitor.get_path_avail_size)
+async_is_log_exist = _offload(process_monitor.is_log_exist)
+async_get_log_head = _offload(process_monitor.get_log_head)
+async_get_log_tail = _offload(process_monitor.get_log_tail)
+async_get_log_last_update_time = _offload(process_monitor.get_log_last_update_time)
+async_get_log_keyword_lines = _offload(process_monitor.get_log_keyword_lines)
+async_get_all_pid_name = _offload(process_manage.get_all_pid_name)
+async_search_pid_by_keyword = _offload(process_manage.search_pid_by_keyword)
+async_get_process_tree = _offload(process_manage.get_process_tree)
+async_get_same_group_process = _offload(process_manage.get_same_group_process)
+async_get_all_child_process = _offload(process_manage.get_all_child_process)
+async_bulk_get_process_info = _offload(bulk_collect.bulk_get_process_info)
+async_bulk_get_process_mem = _offload(bulk_collect.bulk_get_process_mem)
+async_bulk_get_process_io = _offload(bulk_collect.bulk_get_process_io)
+
+
+# 速率 - 等待采样器
+
+def async_calc_cpu_percent():
+    """计算CPU总占用率 (返回的是百分比)"""
+    return _wait_sampler(sampler.get_cpu_percent)
+
+
+def async_calc_cpu_percent_by_cores():
+    """计算CPU各核占用率 (返回的是百分比)"""
+    return _wait_sampler(sampler.get_cpu_percent_by_cores)
+
+
+def async_calc_net_speed(device_name=None):
+    """计算某一网卡的网络速度 [下载速度,上传速度] (单位为KB/s, 默认为默认网卡)"""
+    if device_name is None:
+        device_name = sys_monitor.get_default_net_device()
+    return _wait_sampler(sampler.get_net_speed, device_name)
+
+
+def async_calc_process_cpu_percent(pid):
+    """计算进程CPU使用率 (计算的cpu总体占用率)"""
+    return _wait_sampler(sampler.get_process_cpu_percent, pid)
+
+
+def async_calc_process_cpu_io(pid):
+    """计算进程的磁盘IO速度 (单位MB/s)"""
+    return _wait_sampler(sampler.get_process_io_speed, pid)
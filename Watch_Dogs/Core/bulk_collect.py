@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# encoding:utf-8
+
+"""
+进程监测核心功能实现 - 批量采集
+
+主要包括
+- 批量获取进程信息 /proc/[pid]/stat + cmdline
+- 批量获取进程stat数据
+- 批量获取进程cpu时间片
+- 批量获取进程占用内存
+- 批量获取进程读写数据
+- 批量获取进程名
+
+与 process_monitor 中的单进程接口不同,批量接口不会因为某个进程退出或无权限而抛出异常:
+每个进程要么返回数据,要么返回一个错误码,同时统计各类错误的数量.
+遍历过程中进程退出的代价只是一次失败的 open.
+
+返回结果格式
+{
+    "data": {pid: 数据},
+    "errors": {pid: 错误码},
+    "error_count": {错误名称: 数量}
+}
+"""
+
+import os
+import errno
+
+from process_monitor import get_all_pid, MEM_PAGE_SIZE
+from proc_root import proc_path
+from self_monitor import instrument
+
+# 错误码
+OK = 0
+NO_SUCH_PROCESS = 1  # 进程不存在(已退出)
+ACCESS_DENIED = 2  # 无读取权限
+OTHER_ERROR = 3  # 其他错误(如数据格式无法解析)
+
+ERROR_NAME = {
+    NO_SUCH_PROCESS: "no_such_process",
+    ACCESS_DENIED: "access_denied",
+    OTHER_ERROR: "other_error",
+}
+
+_NO_SUCH_PROCESS_ERRNO = (errno.ENOENT, errno.ESRCH, errno.ENOTDIR)
+_ACCESS_DENIED_ERRNO = (errno.EACCES, errno.EPERM)
+
+# 单次读取的最大长度 (stat/io/statm 远小于该值)
+_READ_SIZE = 4096
+
+
+def read_proc_file(path, size=_READ_SIZE):
+    """读取 /proc 文件 (一次 open + read),返回 (数据, 错误码)"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError as e:
+        if e.errno in _NO_SUCH_PROCESS_ERRNO:
+            return None, NO_SUCH_PROCESS
+        if e.errno in _ACCESS_DENIED_ERRNO:
+            return None, ACCESS_DENIED
+        return None, OTHER_ERROR
+    try:
+        return os.read(fd, size), OK
+    except OSError as e:  # 打开后进程退出 (ESRCH)
+        if e.errno in _ACCESS_DENIED_ERRNO:
+            return None, ACCESS_DENIED
+        return None, NO_SUCH_PROCESS
+    finally:
+        os.close(fd)
+
+
+def parse_process_stat(p_data):
+    """
+    解析 /proc/[pid]/stat (comm 中可能包含空格和括号,以最后一个 ')' 作为分隔)
+    返回 dict, 字段含义见 process_monitor.get_process_cpu_time
+    """
+    left = p_data.index("(")
+    right = p_data.rindex(")")
+    fields = p_data[right + 2:].split(" ")
+    return {
+        "pid": int(p_data[:left]),
+        "comm": p_data[left + 1:right],
+        "state": fields[0],  # (3)
+        "ppid": int(fields[1]),  # (4)
+        "pgrp": int(fields[2]),  # (5)
+        "session": int(fields[3]),  # (6)
+        "tty_nr": int(fields[4]),  # (7)
+        "minflt": int(fields[7]),  # (10)
+        "majflt": int(fields[9]),  # (12)
+        "utime": int(fields[11]),  # (14)
+        "stime": int(fields[12]),  # (15)
+        "cutime": int(fields[13]),  # (16)
+        "cstime": int(fields[14]),  # (17)
+        "priority": int(fields[15]),  # (18)
+        "nice": int(fields[16]),  # (19)
+        "num_threads": int(fields[17]),  # (20)
+        "starttime": int(fields[19]),  # (22)
+        "vsize": int(fields[20]),  # (23)
+        "rss": int(fields[21]),  # (24) 页数
+        "processor": int(fields[36]) if len(fields) > 36 else -1,  # (39)
+    }
+
+
+def collect_per_pid(pids, read_one):
+    """批量采集 - read_one(pid) 返回 (数据, 错误码), 结果格式见模块说明 (其他模块的批量接口也使用)"""
+    if pids is None:
+        pids = get_all_pid()
+    data = {}
+    errors = {}
+    error_count = {}
+    for pid in pids:
+        value, code = read_one(pid)
+        if code == OK:
+            data[pid] = value
+        else:
+            errors[pid] = code
+            name = ERROR_NAME[code]
+            error_count[name] = error_count.get(name, 0) + 1
+
+    return {"data": data, "errors": errors, "error_count": error_count}
+
+
+def _read_stat(pid):
+    """读取并解析 /proc/[pid]/stat"""
+    p_data, code = read_proc_file(proc_path(pid, "stat"))
+    if code != OK:
+        return None, code
+    try:
+        return parse_process_stat(p_data), OK
+    except (ValueError, IndexError):
+        return None, OTHER_ERROR
+
+
+def _read_cmdline(pid):
+    """读取 /proc/[pid]/cmdline (命令行可能很长,最多读取128KB)"""
+    p_cmdline, code = read_proc_file(proc_path(pid, "cmdline"), 131072)
+    if code != OK:
+        return None, code
+    return p_cmdline.replace("\0", " ").strip(), OK
+
+
+@instrument
+def bulk_get_process_stat(pids=None, with_cmdline=False):
+    """批量获取进程stat数据 - /proc/[pid]/stat (with_cmdline - 同时读取 /proc/[pid]/cmdline)"""
+    if not with_cmdline:
+        return collect_per_pid(pids, _read_stat)
+
+    def read_one(pid):
+        stat, code = _read_stat(pid)
+        if code != OK:
+            return None, code
+        stat["cmdline"], code = _read_cmdline(pid)
+        if code != OK:
+            return None, code
+        return stat, OK
+
+    return collect_per_pid(pids, read_one)
+
+
+@instrument
+def bulk_get_process_info(pids=None):
+    """批量获取进程信息 - /proc/[pid]/stat + /proc/[pid]/cmdline (字段与 get_process_info 一致)"""
+
+    def read_one(pid):
+        stat, code = _read_stat(pid)
+        if code != OK:
+            return None, code
+        cmdline, code = _read_cmdline(pid)
+        if code != OK:
+            return None, code
+        return {
+            "pid": stat["pid"],
+            "comm": stat["comm"],
+            "state": stat["state"],
+            "ppid": stat["ppid"],
+            "pgrp": stat["pgrp"],
+            "thread num": stat["num_threads"],
+            "cmdline": cmdline
+        }, OK
+
+    return collect_per_pid(pids, read_one)
+
+
+@instrument
+def bulk_get_process_cpu_time(pids=None):
+    """批量获取进程cpu时间片 (utime+stime+cutime+cstime)"""
+
+    def read_one(pid):
+        stat, code = _read_stat(pid)
+        if code != OK:
+            return None, code
+        return stat["utime"] + stat["stime"] + stat["cutime"] + stat["cstime"], OK
+
+    return collect_per_pid(pids, read_one)
+
+
+@instrument
+def bulk_get_process_mem(pids=None, style="M"):
+    """批量获取进程占用内存 (rss * page size,单位与 get_process_mem 一致)"""
+
+    def read_one(pid):
+        stat, code = _read_stat(pid)
+        if code != OK:
+            return None, code
+        kb = stat["rss"] * MEM_PAGE_SIZE
+        if style == "M":
+            return round(kb / 1024., 2), OK
+        elif style == "G":
+            return round(kb / 1024. ** 2, 2), OK
+        return kb, OK
+
+    return collect_per_pid(pids, read_one)
+
+
+@instrument
+def bulk_get_process_io(pids=None):
+    """批量获取进程读写数据 [rchar, wchar] - /proc/[pid]/io (需要root权限)"""
+
+    def read_one(pid):
+        p_io, code = read_proc_file(proc_path(pid, "io"))
+        if code != OK:
+            return None, code
+        lines = p_io.split("\n", 2)
+        try:
+            return [int(lines[0].split(":")[1]), int(lines[1].split(":")[1])], OK
+        except (ValueError, IndexError):  # 内容不完整 (如读取被截断)
+            return None, OTHER_ERROR
+
+    return collect_per_pid(pids, read_one)
+
+
+@instrument
+def bulk_get_pid_name(pids=None, name_type="cmdline"):
+    """批量获取进程名 (cmdline为空时使用comm,与 get_all_pid_name 一致)"""
+
+    def read_one(pid):
+        stat, code = _read_stat(pid)
+        if code != OK:
+            return None, code
+        if name_type == "comm":
+            return stat["comm"], OK
+        cmdline, code = _read_cmdline(pid)
+        if code != OK:
+            return None, code
+        return cmdline or stat["comm"], OK
+
+    return collect_per_pid(pids, read_one)
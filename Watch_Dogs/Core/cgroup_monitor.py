@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+# encoding:utf-8
+
+"""
+进程监测核心功能实现 - cgroup (v2) 资源监测
+
+主要包括
+- 进程 -> cgroup 映射 (/proc/[pid]/cgroup 中的 "0::路径"), 按 pid+starttime 缓存, 每个进程只在第一次出现时读取
+- 每个 cgroup 只读取一次自身的统计文件 (不需要逐个进程累加, 已退出的子进程消耗也包含在内)
+    - cpu.stat      : CPU时间 (usage/user/system), 限流 (nr_periods/nr_throttled/throttled_usec)
+    - memory.current, memory.stat : 内存占用及明细 (anon/file/shmem/...)
+    - io.stat       : 各设备读写字节数/次数
+    - pids.current  : 任务数
+    - cpu.pressure, memory.pressure, io.pressure : 压力(PSI) some/full avg10/avg60/avg300/total
+- 根据两次读取计算 CPU占用率, 限流比例, 读写速度, 压力(stall时间占比)
+- 容器id : cgroup 路径中的64位十六进制id (docker/containerd/cri-o/podman), 按前缀查询时至少 CGROUP_ID_PREFIX 位
+- /proc/[pid]/cgroup 中的路径相对于读取者的 cgroup 命名空间 : 监测程序运行在有独立 cgroup 命名空间的容器中时,
+  命名空间外的进程路径为 "/../../system.slice/xxx", 无法对应到 cgroup 目录, 这些进程不计入任何 cgroup
+  (需要统计宿主机上的全部 cgroup 时, 监测程序应使用宿主机的 cgroup 命名空间, 如 docker run --cgroupns=host)
+
+cgroup 根目录默认为 sys_path("fs/cgroup") (混合模式下为 fs/cgroup/unified), 可以指定其他目录(如测试用的目录树).
+只支持 cgroup v2, 没有开启的控制器对应的数据为None.
+
+reference   :   https://www.kernel.org/doc/Documentation/admin-guide/cgroup-v2.rst
+reference   :   https://www.kernel.org/doc/Documentation/accounting/psi.rst
+"""
+
+import os
+import re
+import threading
+from time import time
+
+from bulk_collect import read_proc_file, OK, NO_SUCH_PROCESS
+from proc_root import proc_path, sys_path, use_proc_root
+from sampler import read_cpu_times
+
+# 没有进程表(starttime)时, 进程 -> cgroup 映射的有效时间(秒)
+CGROUP_MAP_TTL = 30
+# 读取的压力(PSI)文件
+CGROUP_PRESSURE = ("cpu", "memory", "io")
+# 结果的排序字段
+CGROUP_ORDERS = {"cpu": "cpu_percent", "memory": "memory", "pids": "pids", "read": "read_bytes_per_sec",
+                 "write": "write_bytes_per_sec", "throttled": "throttled_percent"}
+
+_CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+# 按容器id前缀查询时的最小长度 (与 docker ps 显示的短id一致)
+CGROUP_ID_PREFIX = 12
+
+_CONTAINER_ID = re.compile(r"[0-9a-f]{64}")
+_STAT_SIZE = 8192  # memory.stat 约 2~3KB
+
+
+def cgroup_root():
+    """cgroup v2 挂载目录"""
+    root = sys_path("fs/cgroup")
+    if not os.path.exists(root + "/cgroup.controllers") and os.path.isdir(root + "/unified"):
+        return root + "/unified"  # 混合模式 (v1 + v2)
+    return root
+
+
+def parse_process_cgroup(data):
+    """
+    解析 /proc/[pid]/cgroup 内容, 返回 cgroup v2 路径 (如 /system.slice/docker-xxx.scope)
+    没有 v2 路径, 或路径在读取者的 cgroup 命名空间之外 (包含 "..") 时返回None
+    """
+    for line in data.splitlines():
+        if line.startswith("0::"):
+            path = line[3:].strip() or "/"
+            if ".." in path.split("/"):
+                return None
+            return path
+    return None
+
+
+def parse_keyed(data):
+    """解析 "键 值" 格式 (cpu.stat, memory.stat), 返回 {键: 整数}"""
+    res = {}
+    for line in data.splitlines():
+        fields = line.split()
+        if len(fields) == 2:
+            res[fields[0]] = int(fields[1])
+    return res
+
+
+def parse_io_stat(data):
+    """解析 io.stat 内容, 返回 {设备号("8:0"): {"rbytes", "wbytes", "rios", "wios", "dbytes", "dios"}}"""
+    res = {}
+    for line in data.splitlines():
+        fields = line.split()
+        if not fields:
+            continue
+        res[fields[0]] = dict((k, int(v)) for k, v in (field.split("=", 1) for field in fields[1:]))
+    return res
+
+
+def parse_pressure(data):
+    """解析压力(PSI)文件内容, 返回 {"some"/"full": {"avg10", "avg60", "avg300" (%), "total" (微秒)}}"""
+    res = {}
+    for line in data.splitlines():
+        fields = line.split()
+        if not fields:
+            continue
+        values = dict(field.split("=", 1) for field in fields[1:])
+        res[fields[0]] = {"avg10": float(values["avg10"]), "avg60": float(values["avg60"]),
+                          "avg300": float(values["avg300"]), "total": int(values["total"])}
+    return res
+
+
+def container_id(path):
+    """cgroup 路径中的容器id, 不是容器时返回None"""
+    ids = _CONTAINER_ID.findall(path)
+    return ids[-1] if ids else None
+
+
+def _read(path, name, parse=None):
+    """读取 cgroup 中的一个文件, 不存在(控制器未开启)时返回None"""
+    data, code = read_proc_file(path + "/" + name, _STAT_SIZE)
+    if code != OK:
+        return None
+    try:
+        return parse(data) if parse is not None else int(data)
+    except ValueError:  # memory.max 等可能为 "max"
+        return None
+
+
+def read_cgroup_stats(path, root=None):
+    """
+    读取一个 cgroup 的统计数据 (每个文件一次读取)
+    :param path: cgroup 路径, 如 /system.slice/docker-xxx.scope
+    :param root: cgroup 根目录 (None - cgroup_root())
+    :return: {"cpu", "memory_current", "memory", "io", "pids", "pressure": {"cpu", "memory", "io"}},
+             cgroup 已删除时返回None
+    """
+    root = os.path.normpath(root or cgroup_root())
+    directory = os.path.normpath(root + path)
+    if directory != root and not directory.startswith(root.rstrip("/") + "/"):  # 不读取根目录之外的目录
+        return None
+    if not os.path.isdir(directory):
+        return None
+    return {
+        "cpu": _read(directory, "cpu.stat", parse_keyed),
+        "memory_current": _read(directory, "memory.current"),
+        "memory": _read(directory, "memory.stat", parse_keyed),
+        "io": _read(directory, "io.stat", parse_io_stat),
+        "pids": _read(directory, "pids.current"),
+        "pressure": dict((name, _read(directory, name + ".pressure", parse_pressure)) for name in CGROUP_PRESSURE),
+    }
+
+
+def _delta(new, old, key):
+    """两次读取的差值 (任一次没有该数据时为None)"""
+    if new is None or old is None or key not in new or key not in old:
+        return None
+    return new[key] - old[key]
+
+
+def _io_total(io):
+    """所有设备的读写字节数之和 (rbytes, wbytes)"""
+    if io is None:
+        return None
+    return (sum(dev.get("rbytes", 0) for dev in io.values()),
+            sum(dev.get("wbytes", 0) for dev in io.values()))
+
+
+class CgroupMonitor(object):
+    """按 cgroup(容器) 统计资源占用 (线程安全)"""
+
+    def __init__(self, sampler=None, root=None, proc_root=None, map_ttl=CGROUP_MAP_TTL):
+        """
+        :param sampler: 采样器, attach 后使用采样器的进程表(starttime)和CPU总时间
+        :param root: cgroup 根目录 (None - 每次更新时使用 cgroup_root())
+        :param proc_root: 单独调用 refresh 时使用的 proc 根目录 (None - 全局配置)
+        """
+        self.sampler = sampler
+        self.root = root
+        self.proc_root = proc_root
+        self.map_ttl = map_ttl
+        self._members = {}  # pid -> (starttime, 读取时间, cgroup路径)
+        self._groups = {}  # cgroup路径 -> 结果
+        self._last = {}  # cgroup路径 -> 上一次读取的统计数据
+        self._cpu_total = None  # 上一次更新时的系统总cpu时间片
+        self._time = None
+        self._lock = threading.Condition()
+        self.seq = 0
+
+    def attach(self, sampler=None, ttl=None):
+        """
+        订阅采样器并开启进程表采集
+        :param ttl: 进程表的使用时间(秒), 按需使用时每次查询前调用以延长 (None - 直到 detach)
+        """
+        if sampler is not None:
+            self.sampler = sampler
+        self.sampler.enable_table(owner=self, ttl=ttl)
+        self.sampler.subscribe(self.update)
+
+    def detach(self):
+        """取消订阅并释放进程表"""
+        self.sampler.unsubscribe(self.update)
+        self.sampler.release_table(self)
+
+    def update(self, prev, last):
+        """采样回调 (在采样线程中, 已使用采样器的 proc 根目录)"""
+        if last.table is None:  # 进程表已停止采集, 重新开始后需要再等待两次更新
+            with self._lock:
+                self.seq = 0
+                self._cpu_total = self._time = None
+                self._last = {}
+            return
+        self._update(last.table.pids, last.table.starttime, last.cpu[0], last.time)
+        with self._lock:
+            self.seq += 1
+            self._lock.notify_all()
+
+    def refresh(self):
+        """不使用采样器时单独更新一次 (读取 /proc 下的所有进程)"""
+        with use_proc_root(self.proc_root):
+            pids = [name for name in os.listdir(proc_path()) if name.isdigit()]
+            cpu_total = read_cpu_times()[0][0]
+            self._update(pids, [None] * len(pids), cpu_total, time())
+        with self._lock:
+            self.seq += 1
+            self._lock.notify_all()
+
+    def _cgroup(self, pid, starttime, now):
+        """进程所在的 cgroup, 进程已退出返回None"""
+        cached = self._members.get(pid)
+        if cached is not None and cached[0] == starttime and (starttime is not None or now - cached[1] < self.map_ttl):
+            return cached
+        data, code = read_proc_file(proc_path(pid, "cgroup"))
+        if code != OK:
+            return None if code == NO_SUCH_PROCESS else (starttime, now, None)
+        return starttime, now, parse_process_cgroup(data)
+
+    def _update(self, pids, starttimes, cpu_total, now):
+        """更新 进程 -> cgroup 映射, 然后读取每个 cgroup 的统计数据"""
+        members = {}
+        processes = {}  # cgroup路径 -> 进程数
+        for pid, starttime in zip(pids, starttimes):
+            member = self._cgroup(pid, starttime, now)
+            if member is None:
+                continue
+            members[pid] = member
+            path = member[2]
+            if path is not None:
+                processes[path] = processes.get(path, 0) + 1
+
+        root = self.root or cgroup_root()
+        current = {}
+        for path in processes:
+            stats = read_cgroup_stats(path, root)
+            if stats is not None:
+                current[path] = stats
+
+        with self._lock:
+            # 两次更新间可用的CPU时间(秒) = 系统总cpu时间片 / 每秒时间片数
+            cpu_seconds = float(cpu_total - self._cpu_total) / _CLOCK_TICKS if self._cpu_total is not None else None
+            seconds = now - self._time if self._time is not None else None
+            self._groups = dict((path, self._result(path, stats, self._last.get(path), processes[path],
+                                                    cpu_seconds, seconds))
+                                for path, stats in current.items())
+            self._members = members
+            self._last = current
+            self._cpu_total = cpu_total
+            self._time = now
+            self._lock.notify_all()
+
+    @staticmethod
+    def _result(path, stats, old, processes, cpu_seconds, seconds):
+        """单个 cgroup 的结果 (old - 上一次读取的统计数据, 没有时速率为None)"""
+        cpu, old_cpu = stats["cpu"], old["cpu"] if old is not None else None
+        res = {
+            "path": path,
+            "container_id": container_id(path),
+            "processes": processes,
+            "pids": stats["pids"],
+            "cpu_seconds": cpu["usage_usec"] / 1e6 if cpu and "usage_usec" in cpu else None,
+            "cpu_percent": None,
+            "cpu_cores": None,  # 使用的CPU核数
+            "nr_throttled": cpu.get("nr_throttled") if cpu else None,
+            "throttled_seconds": cpu["throttled_usec"] / 1e6 if cpu and "throttled_usec" in cpu else None,
+            "throttled_percent": None,  # 两次读取间被限流的周期比例
+            "memory": stats["memory_current"],
+            "memory_stat": stats["memory"],
+            "read_bytes": None,
+            "write_bytes": None,
+            "read_bytes_per_sec": None,
+            "write_bytes_per_sec": None,
+            "pressure": {},
+        }
+        io = _io_total(stats["io"])
+        if io is not None:
+            res["read_bytes"], res["write_bytes"] = io
+
+        usage = _delta(cpu, old_cpu, "usage_usec")
+        if usage is not None and seconds:
+            res["cpu_cores"] = usage / 1e6 / seconds
+            if cpu_seconds:
+                res["cpu_percent"] = usage / 1e6 * 100.0 / cpu_seconds
+        periods = _delta(cpu, old_cpu, "nr_periods")
+        if periods:
+            res["throttled_percent"] = _delta(cpu, old_cpu, "nr_throttled") * 100.0 / periods
+        elif periods is not None:
+            res["throttled_percent"] = 0.0
+        old_io = _io_total(old["io"]) if old is not None else None
+        if io is not None and old_io is not None and seconds:
+            res["read_bytes_per_sec"] = max(io[0] - old_io[0], 0) / seconds  # 设备移除后总数可能减少
+            res["write_bytes_per_sec"] = max(io[1] - old_io[1], 0) / seconds
+
+        for name, pressure in stats["pressure"].items():
+            if pressure is None:
+                res["pressure"][name] = None
+                continue
+            old_pressure = old["pressure"].get(name) if old is not None else None
+            item = res["pressure"][name] = {}
+            for kind, values in pressure.items():
+                item[kind] = dict(values)
+                stall = _delta(values, old_pressure.get(kind) if old_pressure else None, "total")
+                # 两次读取间的stall时间占比(%)
+                item[kind]["stall_percent"] = stall / 1e6 * 100.0 / seconds if stall is not None and seconds else None
+        return res
+
+    def wait_ready(self, timeout=None):
+        """等待第一次计算出速率 (需要两次更新), 超时返回False"""
+        deadline = None if timeout is None else time() + timeout
+        with self._lock:
+            while self.seq < 2:
+                remaining = None if deadline is None else deadline - time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._lock.wait(remaining)
+            return True
+
+    def get_groups(self, n=None, by="cpu", containers_only=False):
+        """
+        各 cgroup 的资源占用
+        :param n: 返回数量 (None - 全部)
+        :param by: 排序字段 cpu/memory/pids/read/write/throttled
+        :param containers_only: 只返回路径中包含容器id的 cgroup
+        """
+        if by not in CGROUP_ORDERS:
+            raise ValueError("unknown order : {} (available : {})".format(by, ", ".join(sorted(CGROUP_ORDERS))))
+        with self._lock:
+            res = [group for group in self._groups.values() if not containers_only or group["container_id"]]
+        field = CGROUP_ORDERS[by]
+        res.sort(key=lambda item: item[field], reverse=True)  # None 排在最后
+        return res[:n] if n is not None else res
+
+    def get_group(self, path):
+        """
+        单个 cgroup 的资源占用, 路径或容器id (可以只是前缀, 至少 CGROUP_ID_PREFIX 位)
+        不存在或前缀对应多个容器时抛出 KeyError
+        """
+        with self._lock:
+            group = self._groups.get(path)
+            if group is None and len(path) >= CGROUP_ID_PREFIX:
+                matches = [item for item in self._groups.values()
+                           if item["container_id"] and item["container_id"].startswith(path)]
+                if len(set(item["container_id"] for item in matches)) == 1:
+                    group = matches[0]
+        if group is None:
+            raise KeyError(path)
+        return group
+
+    def get_process_cgroup(self, pid):
+        """进程所在的 cgroup 路径 (最近一次更新的结果)"""
+        with self._lock:
+            member = self._members.get(str(pid))
+        return member[2] if member is not None else None
+
+    def get_status(self):
+        with self._lock:
+            return {"seq": self.seq, "root": self.root or cgroup_root(), "processes": len(self._members),
+                    "groups": len(self._groups)}
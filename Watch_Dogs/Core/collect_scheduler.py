@@ -0,0 +1,519 @@
+#!/usr/bin/env python
+# encoding:utf-8
+
+"""
+进程监测核心功能实现 - 采集调度
+
+主要包括
+- 每个采集项单独设置采集间隔及随机抖动 (如CPU每秒一次, 磁盘/CPU信息每10分钟一次)
+- CPU时间预算 : 统计每个采集项每次执行消耗的CPU时间(线程CPU时间, 指数加权平均),
+  调度线程的CPU占用超过预算时, 优先将开销(CPU时间/间隔)最大的采集项的间隔加倍, 直到回到预算内;
+  占用远低于预算时逐步恢复原间隔.
+  预算只包括调度线程执行的采集项, 不包括 sampler 采样线程及RPC请求的开销
+- 合并读取 : 读取同一个文件的采集项(如 /proc/stat 的总体CPU和各核心CPU)在同一时刻到期
+  (或即将到期)时只读取一次文件, 分别解析
+- 共用采样器 : attach(sampler) 后 cpu / cpu_cores / net 不再由调度线程读取 /proc/stat 和 /proc/net/dev,
+  而是取 sampler 每次采样的数值 (feed), 避免同一文件每秒读取两次
+
+采集项
+    Collector("cpu", parse_cpu, interval=1, source=lambda: proc_path("stat"))   # 读取 source 后调用 parse(数据)
+    Collector("disk", get_disk_stat, interval=600)                               # 没有 source 时直接调用 func()
+    Collector("net", None, interval=2, fed=True)                                 # 不调度, 由 feed 提供数值
+
+每次采集的结果保存最近两次 (时间, 数值), 可以订阅采集完成回调 callback(采集项名, 时间, 数值).
+与 sampler 一样, 调度器可以设置 proc 根目录 (见 proc_root).
+
+reference   :   http://man7.org/linux/man-pages/man2/clock_gettime.2.html (CLOCK_THREAD_CPUTIME_ID)
+"""
+
+import heapq
+import random
+import ctypes
+import ctypes.util
+import resource
+import threading
+from time import time
+
+import sys_monitor
+from proc_root import proc_path, proc_ns_path, use_proc_root
+from sampler import parse_cpu_times, parse_net_dev
+from self_monitor import record
+
+# 调度器CPU时间预算 (占单核的百分比, None - 不限制)
+SCHEDULER_CPU_BUDGET = 1.0
+# 默认随机抖动 (间隔的比例, 0.1 为 ±10%)
+SCHEDULER_JITTER = 0.1
+# 超出预算时采集间隔最多延长的倍数
+SCHEDULER_MAX_STRETCH = 16
+# 调整间隔的周期(秒)
+SCHEDULER_ADJUST_INTERVAL = 10
+# 开销低于预算的该比例时恢复间隔
+SCHEDULER_RELAX_RATIO = 0.5
+# 合并读取时最多提前执行 (间隔的比例)
+SCHEDULER_COALESCE_RATIO = 0.25
+# 单次执行开销的指数加权平均系数
+SCHEDULER_COST_ALPHA = 0.3
+# 由采样器提供的采集项 (采集项名, Sample 属性, 间隔)
+SAMPLED_COLLECTORS = (("cpu", "cpu", 1), ("cpu_cores", "cores", 5), ("net", "net", 2))
+
+CLOCK_THREAD_CPUTIME_ID = 3
+# getrusage(RUSAGE_THREAD) 精度为时钟中断(tick), 不能用于测量单次采集 (python2 resource 模块中没有该常量)
+_RUSAGE_THREAD = 1
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+_libc = None
+
+
+def thread_cpu_time():
+    """当前线程的CPU时间(秒) - clock_gettime(CLOCK_THREAD_CPUTIME_ID), 不支持时使用 getrusage"""
+    global _libc
+    if _libc is None:
+        try:
+            _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            _libc.clock_gettime  # 检查函数是否存在
+        except (OSError, AttributeError):
+            _libc = False
+    if _libc:
+        ts = _Timespec()
+        if _libc.clock_gettime(CLOCK_THREAD_CPUTIME_ID, ctypes.byref(ts)) == 0:
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+    usage = resource.getrusage(_RUSAGE_THREAD)
+    return usage.ru_utime + usage.ru_stime
+
+
+def parse_meminfo(data):
+    """解析 /proc/meminfo 内容, 返回 {字段名: 数值(KB)}"""
+    res = {}
+    for line in data.splitlines():
+        name, _, value = line.partition(":")
+        value = value.split()
+        if value:
+            res[name] = int(value[0])
+    return res
+
+
+class Collector(object):
+    """采集项"""
+
+    def __init__(self, name, func, interval, jitter=SCHEDULER_JITTER, source=None, max_stretch=SCHEDULER_MAX_STRETCH,
+                 fed=False):
+        """
+        :param func: 采集函数, 有 source 时为 func(文件内容), 否则为 func()
+        :param interval: 采集间隔(秒)
+        :param jitter: 随机抖动 (间隔的比例)
+        :param source: 返回数据文件路径的函数, 相同路径的采集项合并读取
+        :param max_stretch: 超出预算时间隔最多延长的倍数 (1 - 不延长)
+        :param fed: 不由调度线程执行, 数值由 CollectScheduler.feed 提供 (func 不使用)
+        """
+        if interval <= 0:
+            raise ValueError("interval must be positive : {}".format(interval))
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.source = source
+        self.max_stretch = 1 if fed else max_stretch
+        self.fed = fed
+        self.stretch = 1  # 当前间隔倍数
+        self.cost = None  # 单次执行CPU时间(秒, 加权平均)
+        self.next_time = 0
+        self.runs = 0
+        self.errors = 0
+        self.last_error = None
+        self.prev = None  # (时间, 数值)
+        self.last = None
+
+    @property
+    def effective_interval(self):
+        """当前实际采集间隔"""
+        return self.interval * self.stretch
+
+    def cost_rate(self, stretch=None):
+        """开销 - 每秒消耗的CPU时间"""
+        if self.cost is None:
+            return 0.0
+        return self.cost / (self.interval * (stretch or self.stretch))
+
+    def schedule(self, now):
+        """计算下一次执行时间 (加入随机抖动)"""
+        jitter = self.jitter * random.uniform(-1, 1)
+        self.next_time = now + self.effective_interval * (1 + jitter)
+
+    def add_cost(self, cost):
+        """记录一次执行的CPU时间"""
+        if self.cost is None:
+            self.cost = cost
+        else:
+            self.cost += SCHEDULER_COST_ALPHA * (cost - self.cost)
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "interval": self.interval,
+            "effective_interval": self.effective_interval,
+            "stretch": self.stretch,
+            "fed": self.fed,
+            "cost": self.cost,
+            "cpu_percent": self.cost_rate() * 100,
+            "runs": self.runs,
+            "errors": self.errors,
+            "last_error": self.last_error,
+            "last_time": self.last[0] if self.last is not None else None,
+        }
+
+
+class CollectScheduler(object):
+    """采集调度器 (线程安全)"""
+
+    def __init__(self, budget=SCHEDULER_CPU_BUDGET, proc_root=None):
+        """
+        :param budget: CPU时间预算, 占单核的百分比 (None - 不限制)
+        :param proc_root: 采集使用的 proc 根目录 (None - 全局配置)
+        """
+        self.budget = budget
+        self.proc_root = proc_root
+        self._collectors = {}  # 名称 -> Collector
+        self._heap = []  # (执行时间, 序号, 名称), 间隔调整后旧的项在出堆时跳过
+        self._seq = 0
+        self._callbacks = []
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+        self._adjust_time = time()
+        self._cpu_start = None  # 调度线程启动时的 (时间, 线程CPU时间)
+        self._cpu_last = None  # 调度线程最近一次执行后的 (时间, 线程CPU时间)
+        self._sampler = None  # attach 的采样器
+        self.reads = 0  # 读取文件次数
+        self.coalesced = 0  # 合并读取节省的读取次数
+
+    def _push(self, collector):
+        """加入执行队列 (需持有锁)"""
+        self._seq += 1
+        heapq.heappush(self._heap, (collector.next_time, self._seq, collector.name))
+
+    def add_collector(self, collector):
+        """添加采集项 (同名替换), 第一次执行时间在 [0, 抖动] 秒内随机分散"""
+        with self._cond:
+            self._collectors[collector.name] = collector
+            if collector.fed:  # 不调度
+                collector.next_time = None
+                return
+            collector.next_time = time() + collector.jitter * random.random()
+            self._push(collector)
+            self._cond.notify()
+
+    def remove_collector(self, name):
+        """删除采集项"""
+        with self._cond:
+            return self._collectors.pop(name, None) is not None
+
+    def get_collector_names(self):
+        with self._cond:
+            return sorted(self._collectors)
+
+    def subscribe(self, callback):
+        """订阅采集结果, 每次采集完成后调用 callback(采集项名, 时间, 数值) (在调度线程中, fed 采集项在调用 feed 的线程中)"""
+        with self._cond:
+            self._callbacks.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._cond:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def start(self):
+        """启动调度线程"""
+        with self._cond:
+            if self.is_running():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="watch_dogs_scheduler")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self, timeout=5):
+        """停止调度线程"""
+        self._stop.set()
+        with self._cond:
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def feed(self, name, value_time, value):
+        """
+        为 fed 采集项提供数值 (如 sampler 的采样结果), 距上一次数值不足采集间隔时忽略
+        返回是否记录
+        """
+        with self._cond:
+            collector = self._collectors.get(name)
+            if collector is None or not collector.fed:
+                return False
+            last = collector.last
+            if last is not None and value_time - last[0] < collector.interval * (1 - collector.jitter):
+                return False
+            collector.runs += 1
+            collector.prev, collector.last = collector.last, (value_time, value)
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            try:
+                callback(name, value_time, value)
+            except Exception as err:
+                print "Error : scheduler callback - {}".format(err)
+        return True
+
+    def attach(self, sampler):
+        """订阅采样器, 每次采样后将 cpu / cpu_cores / net 提供给对应的 fed 采集项"""
+        self.detach()
+        self._sampler = sampler
+        sampler.subscribe(self._on_sample)
+
+    def detach(self):
+        """取消订阅采样器"""
+        if self._sampler is not None:
+            self._sampler.unsubscribe(self._on_sample)
+            self._sampler = None
+
+    def _on_sample(self, prev, last):
+        """采样回调 (在采样线程中)"""
+        for name, attr, interval in SAMPLED_COLLECTORS:
+            value = getattr(last, attr)
+            if value is not None:
+                self.feed(name, last.time, value)
+
+    def _run(self):
+        """调度线程"""
+        self._cpu_start = (time(), thread_cpu_time())
+        while not self._stop.is_set():
+            with self._cond:
+                due = self._next_due()
+                if due is None:
+                    self._cond.wait(self._wait_time())
+                    continue
+            try:
+                self.run_collectors(due)
+            except Exception as err:  # 采集失败不能让线程退出
+                print "Error : scheduler - {}".format(err)
+            self._cpu_last = (time(), thread_cpu_time())
+            if time() - self._adjust_time >= SCHEDULER_ADJUST_INTERVAL:
+                self.adjust()
+
+    def _wait_time(self):
+        """距离下一次执行的时间 (需持有锁)"""
+        if not self._heap:
+            return SCHEDULER_ADJUST_INTERVAL
+        return max(0.0, min(self._heap[0][0] - time(), SCHEDULER_ADJUST_INTERVAL))
+
+    def _next_due(self):
+        """取出已到期的采集项, 并加入可以合并读取的采集项 (需持有锁), 没有到期的返回None"""
+        now = time()
+        while self._heap:
+            next_time, _, name = self._heap[0]
+            collector = self._collectors.get(name)
+            if collector is None or collector.next_time != next_time:  # 已删除或已重新调度
+                heapq.heappop(self._heap)
+                continue
+            if next_time > now:
+                return None
+            heapq.heappop(self._heap)
+            due = [collector]
+            if collector.source is not None:
+                due.extend(self._coalesce(collector, now))
+            return due
+        return None
+
+    def _coalesce(self, collector, now):
+        """与 collector 读取同一文件且即将到期的采集项 (需持有锁)"""
+        with use_proc_root(self.proc_root):
+            path = collector.source()
+            res = []
+            for other in self._collectors.values():
+                if other is collector or other.source is None:
+                    continue
+                if other.next_time is None or other.next_time - now > other.effective_interval * SCHEDULER_COALESCE_RATIO:
+                    continue
+                if other.source() == path:
+                    res.append(other)
+        for other in res:
+            other.next_time = None  # 从队列中移除 (出堆时跳过)
+        return res
+
+    def run_collectors(self, collectors):
+        """执行一组采集项 (同一 source 只读取一次)"""
+        groups = {}  # 文件路径 -> [采集项]
+        results = []
+        with use_proc_root(self.proc_root):
+            for collector in collectors:
+                if collector.source is None:
+                    results.append(self._execute(collector, collector.func))
+                else:
+                    groups.setdefault(collector.source(), []).append(collector)
+            for path, group in groups.items():
+                cpu_start = thread_cpu_time()
+                try:
+                    with open(path, "r") as f:
+                        data = f.read()
+                    error = None
+                except EnvironmentError as err:
+                    data, error = None, err
+                self.reads += 1
+                self.coalesced += len(group) - 1
+                read_cost = (thread_cpu_time() - cpu_start) / len(group)  # 读取开销平均分配
+                for collector in group:
+                    if error is not None:
+                        results.append(self._execute(collector, None, error, read_cost))
+                    else:
+                        results.append(self._execute(collector, lambda: collector.func(data), None, read_cost))
+
+        now = time()
+        with self._cond:
+            callbacks = list(self._callbacks)
+            for collector in collectors:
+                if self._collectors.get(collector.name) is collector:
+                    collector.schedule(now)
+                    self._push(collector)
+        for name, value_time, value in results:
+            for callback in callbacks:
+                try:
+                    callback(name, value_time, value)
+                except Exception as err:
+                    print "Error : scheduler callback - {}".format(err)
+
+    @staticmethod
+    def _execute(collector, func, error=None, extra_cost=0.0):
+        """执行一个采集项, 记录开销及结果, 返回 (名称, 时间, 数值)"""
+        start, cpu_start = time(), thread_cpu_time()
+        value = None
+        if error is None:
+            try:
+                value = func()
+            except Exception as err:
+                error = err
+        collector.add_cost(thread_cpu_time() - cpu_start + extra_cost)
+        collector.runs += 1
+        now = time()
+        record("scheduler." + collector.name, now - start, type(error).__name__ if error is not None else None)
+        if error is not None:
+            collector.errors += 1
+            collector.last_error = str(error)
+            return collector.name, now, None
+        collector.prev, collector.last = collector.last, (now, value)
+        return collector.name, now, value
+
+    def get_cost_rate(self):
+        """所有采集项的预计开销 (占单核的百分比)"""
+        with self._cond:
+            return sum(c.cost_rate() for c in self._collectors.values()) * 100
+
+    def adjust(self):
+        """
+        按CPU时间预算调整采集间隔
+        - 超出预算 : 按开销从大到小, 将间隔加倍直到预计开销回到预算内
+        - 低于预算的 SCHEDULER_RELAX_RATIO : 按开销从小到大, 在不超出预算的前提下将间隔减半
+        """
+        self._adjust_time = time()
+        if self.budget is None:
+            return
+        budget = self.budget / 100.0
+        with self._cond:
+            collectors = list(self._collectors.values())
+            total = sum(c.cost_rate() for c in collectors)
+            if total > budget:
+                for c in sorted(collectors, key=lambda c: -c.cost_rate()):
+                    while total > budget and c.stretch * 2 <= c.max_stretch:
+                        total -= c.cost_rate() - c.cost_rate(c.stretch * 2)
+                        c.stretch *= 2
+                    if total <= budget:
+                        break
+            elif total < budget * SCHEDULER_RELAX_RATIO:
+                for c in sorted(collectors, key=lambda c: c.cost_rate()):
+                    if c.stretch == 1:
+                        continue
+                    increase = c.cost_rate(c.stretch / 2) - c.cost_rate()
+                    if total + increase > budget * SCHEDULER_RELAX_RATIO:
+                        break
+                    total += increase
+                    c.stretch /= 2
+                    if c.next_time is not None:  # 按新间隔重新调度
+                        c.next_time = min(c.next_time, time() + c.effective_interval)
+                        self._push(c)
+
+    def get_result(self, name):
+        """采集项最近一次结果 (时间, 数值), 还没有采集返回None"""
+        with self._cond:
+            collector = self._collectors.get(name)
+            if collector is None:
+                raise KeyError(name)
+            return collector.last
+
+    def get_results(self, name):
+        """采集项最近两次结果 ((时间, 数值), (时间, 数值)), 用于计算速率"""
+        with self._cond:
+            collector = self._collectors.get(name)
+            if collector is None:
+                raise KeyError(name)
+            return collector.prev, collector.last
+
+    def get_status(self):
+        """调度状态 - 预算, 调度线程的实际CPU占用 (不包括 sampler), 各采集项间隔/开销"""
+        with self._cond:
+            collectors = [c.to_dict() for c in self._collectors.values()]
+        cpu_percent = None
+        start, last = self._cpu_start, self._cpu_last
+        if start is not None and last is not None and last[0] > start[0]:
+            # 调度线程启动以来的实际CPU占用 (线程CPU时间只能在调度线程中读取)
+            cpu_percent = (last[1] - start[1]) * 100.0 / (last[0] - start[0])
+        return {
+            "budget": self.budget,
+            "cpu_percent": cpu_percent,
+            "estimated_cpu_percent": sum(c["cpu_percent"] for c in collectors),
+            "sampler": self._sampler is not None,
+            "reads": self.reads,
+            "coalesced": self.coalesced,
+            "collectors": sorted(collectors, key=lambda c: c["name"]),
+        }
+
+
+def default_collectors(sampled=False):
+    """
+    默认采集项
+    - /proc/stat : 总体CPU(1秒), 各核心CPU(5秒) 合并读取
+    - /proc/meminfo : 内存(5秒), /proc/net/dev : 网卡流量(2秒), /proc/loadavg : 负载(5秒)
+    - 磁盘占用 / CPU信息 / 系统信息 (10分钟)
+    :param sampled: cpu / cpu_cores / net 由采样器提供 (fed, 见 CollectScheduler.attach), 不读取文件
+    """
+    cpu_stat = lambda: proc_path("stat")
+    if sampled:
+        collectors = [Collector(name, None, interval, fed=True) for name, attr, interval in SAMPLED_COLLECTORS]
+    else:
+        collectors = [
+            Collector("cpu", lambda data: parse_cpu_times(data)[0], 1, source=cpu_stat),
+            Collector("cpu_cores", lambda data: parse_cpu_times(data)[1], 5, source=cpu_stat),
+            Collector("net", parse_net_dev, 2, source=lambda: proc_ns_path("net/dev")),
+        ]
+    return collectors + [
+        Collector("mem", parse_meminfo, 5, source=lambda: proc_path("meminfo")),
+        Collector("loadavg", sys_monitor.get_sys_loadavg, 5),
+        Collector("disk", sys_monitor.get_disk_stat, 600, max_stretch=1),
+        Collector("cpu_info", sys_monitor.get_cpu_info, 600, max_stretch=1),
+        Collector("sys_info", sys_monitor.get_sys_info, 600, max_stretch=1),
+    ]
+
+
+def create_scheduler(budget=SCHEDULER_CPU_BUDGET, proc_root=None, sampler=None):
+    """
+    创建包含默认采集项的调度器 (需要调用 start 启动)
+    :param sampler: 提供 cpu / cpu_cores / net 的采样器 (应使用相同的 proc 根目录), None - 调度器自己读取
+    """
+    scheduler = CollectScheduler(budget, proc_root)
+    for collector in default_collectors(sampled=sampler is not None):
+        scheduler.add_collector(collector)
+    if sampler is not None:
+        scheduler.attach(sampler)
+    return scheduler
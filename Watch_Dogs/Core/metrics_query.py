@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+# encoding:utf-8
+
+"""
+进程监测核心功能实现 - 历史数据查询
+
+主要包括
+- 时间范围查询 (自动选择 原始数据/1分钟汇总/1小时汇总)
+- 降采样 (按固定时间间隔 avg/min/max/sum/count/last)
+- 百分位数 (p50/p95/p99 ...) : summarize 只根据原始数据计算, 时间范围超出原始数据时为None
+  (汇总数据只有各周期的平均值, 其百分位数会低估尾部); top_k 使用汇总数据时为各周期平均值的百分位数(近似)
+- 按聚合值排序的 top-K 序列 (如 CPU占用最高的进程)
+- 变化速率 (每秒变化量, 支持计数器重置)
+
+所有计算都在 metrics_store 返回的连续 array('d') 上进行:
+安装了 numpy 时使用 numpy 向量运算, 否则使用数组切片 + 内置函数(sum/min/max/sorted/map 在C中循环),
+不在 Python 中逐点循环.
+"""
+
+import heapq
+import fnmatch
+import operator
+from bisect import bisect_left
+from array import array
+from time import time
+
+from metrics_store import RESOLUTION_RAW, RESOLUTION_MINUTE, RESOLUTION_HOUR
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+RESOLUTION_AUTO = "auto"
+# 汇总数据的字段 (开始时间, 最小值, 平均值, 最大值, 采样数)
+ROLLUP_FIELDS = {"min": 1, "avg": 2, "max": 3, "count": 4}
+AGGREGATE_FUNCS = ("avg", "min", "max", "sum", "count", "last")
+
+
+def _percentile_name(func):
+    """p95 -> 95 (不是百分位数返回None)"""
+    if func.startswith("p"):
+        try:
+            return float(func[1:])
+        except ValueError:
+            return None
+    return None
+
+
+def _check_func(func):
+    """检查聚合函数"""
+    if func not in AGGREGATE_FUNCS and _percentile_name(func) is None:
+        raise ValueError("unknown aggregate function : {}".format(func))
+
+
+def _check_step(step):
+    """检查降采样间隔 (必须为正数)"""
+    if isinstance(step, bool) or not isinstance(step, (int, long, float)) or step <= 0:
+        raise ValueError("step must be a positive number of seconds : {!r}".format(step))
+
+
+def _resolve_time(t):
+    """负数表示相对当前时间, 如 -3600 为最近1小时"""
+    if t is not None and t < 0:
+        return time() + t
+    return t
+
+
+def choose_resolution(store, name, start=None):
+    """选择能覆盖起始时间的最高精度 (原始数据 -> 1分钟 -> 1小时)"""
+    if start is None:
+        return RESOLUTION_HOUR if store.get_time_range(name, RESOLUTION_HOUR) else RESOLUTION_RAW
+    for resolution in (RESOLUTION_RAW, RESOLUTION_MINUTE):
+        time_range = store.get_time_range(name, resolution)
+        if time_range is not None and time_range[0] <= start:
+            return resolution
+    return RESOLUTION_HOUR if store.get_time_range(name, RESOLUTION_HOUR) else RESOLUTION_MINUTE
+
+
+def query_range(store, name, start=None, end=None, resolution=RESOLUTION_AUTO, field="avg"):
+    """
+    时间范围查询
+    :param resolution: raw/1m/1h/auto
+    :param field: 汇总数据使用的字段 avg/min/max/count
+    :return: (时间数组, 数值数组, 采样数数组(原始数据为None), 实际使用的精度)
+    """
+    if resolution == RESOLUTION_AUTO:
+        resolution = choose_resolution(store, name, start)
+    data = store.query(name, start, end, resolution, include_pending=True)
+    if resolution == RESOLUTION_RAW:
+        return data[0::2], data[1::2], None, resolution
+    return data[0::5], data[ROLLUP_FIELDS[field]::5], data[4::5], resolution
+
+
+def _weighted_avg(values, weights):
+    """加权平均"""
+    total = sum(weights)
+    if not total:
+        return 0.0
+    return sum(map(operator.mul, values, weights)) / total
+
+
+def percentile(values, q):
+    """百分位数 (线性插值, 与 numpy.percentile 默认方式一致), 没有数据返回None"""
+    if not len(values):
+        return None
+    if numpy is not None:
+        return float(numpy.percentile(numpy.frombuffer(values, dtype=numpy.float64), q))
+    return percentile_sorted(sorted(values), q)
+
+
+def percentiles(values, qs=(50, 95, 99)):
+    """多个百分位数 {"p50": 数值, ...} (只排序一次)"""
+    if not len(values):
+        return dict(("p{:g}".format(q), None) for q in qs)
+    if numpy is not None:
+        res = numpy.percentile(numpy.frombuffer(values, dtype=numpy.float64), list(qs))
+        return dict(("p{:g}".format(q), float(v)) for q, v in zip(qs, res))
+    ordered = array("d", sorted(values))
+    return dict(("p{:g}".format(q), percentile_sorted(ordered, q)) for q in qs)
+
+
+def percentile_sorted(ordered, q):
+    """已排序数据的百分位数"""
+    pos = (len(ordered) - 1) * q / 100.0
+    low = int(pos)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (pos - low)
+
+
+def aggregate(values, func="avg", weights=None):
+    """
+    聚合 avg/min/max/sum/count/last/pNN, 没有数据返回None
+    :param weights: 汇总数据的采样数, 用于计算加权平均
+    """
+    _check_func(func)
+    if not len(values):
+        return 0 if func == "count" else None
+    if func == "count":
+        return int(sum(weights)) if weights is not None else len(values)
+    if func == "last":
+        return values[-1]
+    q = _percentile_name(func)
+    if q is not None:
+        return percentile(values, q)
+    if numpy is not None:
+        v = numpy.frombuffer(values, dtype=numpy.float64)
+        if func == "avg":
+            if weights is not None:
+                w = numpy.frombuffer(weights, dtype=numpy.float64)
+                return float((v * w).sum() / w.sum()) if w.sum() else 0.0
+            return float(v.mean())
+        return float({"min": v.min, "max": v.max, "sum": v.sum}[func]())
+    if func == "avg":
+        if weights is not None:
+            return _weighted_avg(values, weights)
+        return sum(values) / len(values)
+    return float({"min": min, "max": max, "sum": sum}[func](values))
+
+
+def _bucket_bounds(times, step):
+    """已排序时间数组按 step 分桶, 返回 [(桶开始时间, 起始下标, 结束下标), ...]"""
+    if not len(times):
+        return []
+    res = []
+    start = times[0] - times[0] % step
+    lo = 0
+    n = len(times)
+    while lo < n:
+        hi = bisect_left(times, start + step, lo)
+        if hi > lo:
+            res.append((start, lo, hi))
+        if hi >= n:
+            break
+        start = times[hi] - times[hi] % step  # 跳过没有数据的桶
+        lo = hi
+    return res
+
+
+def downsample(times, values, step, func="avg", weights=None):
+    """
+    降采样 - 按 step 秒分桶聚合 (桶数量远小于数据点数, 每个桶内使用切片聚合)
+    :return: (桶开始时间数组, 聚合值数组)
+    """
+    _check_func(func)
+    _check_step(step)
+    if numpy is not None and func in ("avg", "sum", "min", "max", "count") and len(times):
+        t = numpy.frombuffer(times, dtype=numpy.float64)
+        v = numpy.frombuffer(values, dtype=numpy.float64)
+        buckets = t - numpy.mod(t, step)
+        starts = numpy.flatnonzero(numpy.r_[True, buckets[1:] != buckets[:-1]])
+        if func == "min":
+            res = numpy.minimum.reduceat(v, starts)
+        elif func == "max":
+            res = numpy.maximum.reduceat(v, starts)
+        elif func == "count":
+            res = numpy.add.reduceat(numpy.frombuffer(weights, dtype=numpy.float64), starts) \
+                if weights is not None else numpy.diff(numpy.r_[starts, len(v)]).astype(numpy.float64)
+        elif func == "sum":
+            res = numpy.add.reduceat(v, starts)
+        elif weights is not None:
+            w = numpy.frombuffer(weights, dtype=numpy.float64)
+            res = numpy.add.reduceat(v * w, starts) / numpy.maximum(numpy.add.reduceat(w, starts), 1e-300)
+        else:
+            res = numpy.add.reduceat(v, starts) / numpy.diff(numpy.r_[starts, len(v)])
+        return array("d", buckets[starts].tolist()), array("d", res.tolist())
+
+    out_times = array("d")
+    out_values = array("d")
+    for start, lo, hi in _bucket_bounds(times, step):
+        out_times.append(start)
+        out_values.append(aggregate(values[lo:hi], func, weights[lo:hi] if weights is not None else None))
+    return out_times, out_values
+
+
+def rate(times, values, counter=False):
+    """
+    每秒变化速率 (相邻两点之差 / 时间差)
+    :param counter: 数据为单调递增的计数器, 数值变小时视为计数器重置(该点速率使用当前值)
+    :return: (时间数组, 速率数组) 时间为后一个点的时间
+    """
+    if len(values) < 2:
+        return array("d"), array("d")
+    if numpy is not None:
+        t = numpy.frombuffer(times, dtype=numpy.float64)
+        v = numpy.frombuffer(values, dtype=numpy.float64)
+        dv = numpy.diff(v)
+        if counter:
+            dv = numpy.where(dv < 0, v[1:], dv)
+        dt = numpy.diff(t)
+        return array("d", t[1:].tolist()), array("d", (dv / numpy.where(dt > 0, dt, 1)).tolist())
+    dv = map(operator.sub, values[1:], values[:-1])
+    if counter:
+        dv = map(lambda d, v: v if d < 0 else d, dv, values[1:])
+    # 存储中的时间严格递增, 时间差总是大于0
+    dt = map(operator.sub, times[1:], times[:-1])
+    return times[1:], array("d", map(operator.truediv, dv, dt))
+
+
+def summarize(store, name, start=None, end=None, resolution=RESOLUTION_AUTO, qs=(50, 95, 99)):
+    """
+    序列统计 - 采样数, 平均值, 最小值, 最大值, 百分位数
+    百分位数只根据原始数据计算 (percentiles_exact), 使用汇总数据时为None
+    """
+    start, end = _resolve_time(start), _resolve_time(end)
+    times, values, weights, resolution = query_range(store, name, start, end, resolution)
+    res = {
+        "name": name,
+        "resolution": resolution,
+        "points": len(values),
+        "count": aggregate(values, "count", weights),
+        "avg": aggregate(values, "avg", weights),
+        "min": None,
+        "max": None,
+    }
+    if resolution == RESOLUTION_RAW:
+        res["min"], res["max"] = aggregate(values, "min"), aggregate(values, "max")
+    else:  # 汇总数据使用各周期的最小值/最大值
+        res["min"] = aggregate(query_range(store, name, start, end, resolution, "min")[1], "min")
+        res["max"] = aggregate(query_range(store, name, start, end, resolution, "max")[1], "max")
+    res["percentiles_exact"] = resolution == RESOLUTION_RAW
+    res.update(percentiles(values if resolution == RESOLUTION_RAW else array("d"), qs))
+    return res
+
+
+def top_k(store, pattern, k=10, func="avg", start=None, end=None, resolution=RESOLUTION_AUTO, reverse=False):
+    """
+    按聚合值排序的前k个序列
+    :param pattern: 序列名通配符, 如 "process.*.cpu_percent"
+    :param func: 聚合函数, 百分位数在使用汇总数据时为各周期平均值的百分位数 (近似)
+    :param reverse: True - 取最小的k个
+    :return: [(序列名, 聚合值), ...]
+    """
+    _check_func(func)
+    start, end = _resolve_time(start), _resolve_time(end)
+    scored = []
+    for name in store.get_series_names():
+        if not fnmatch.fnmatchcase(name, pattern):
+            continue
+        field = func if func in ("min", "max") else "avg"
+        times, values, weights, _ = query_range(store, name, start, end, resolution, field)
+        value = aggregate(values, func, weights)
+        if value is not None:
+            scored.append((value, name))
+    select = heapq.nsmallest if reverse else heapq.nlargest
+    return [(name, value) for value, name in select(k, scored)]
+
+
+def query_metrics(store, name, start=None, end=None, resolution=RESOLUTION_AUTO, step=None, func="avg",
+                  as_rate=False, counter=False):
+    """
+    查询接口 (供RPC使用)
+    :param start: 开始时间, 负数表示相对当前时间(如 -3600 为最近1小时)
+    :param step: 降采样间隔(秒, 正数), None - 不降采样
+    :param as_rate: 返回每秒变化速率
+    :return: {"name", "resolution", "times": [...], "values": [...]}
+    """
+    if step is not None:
+        _check_step(step)
+    start, end = _resolve_time(start), _resolve_time(end)
+    field = func if func in ("min", "max") else "avg"
+    times, values, weights, resolution = query_range(store, name, start, end, resolution, field)
+    if step is not None:
+        times, values = downsample(times, values, step, func, weights)
+    if as_rate:
+        times, values = rate(times, values, counter)
+    return {"name": name, "resolution": resolution, "times": times.tolist(), "values": values.tolist()}
@@ -0,0 +1,503 @@
+#!/usr/bin/env python
+# encoding:utf-8
+
+"""
+进程监测核心功能实现 - 历史数据存储
+
+主要包括
+- 每个数据序列(如 sys.cpu_percent, process.1234.rss)保存为三个定长的环形文件(mmap读写)
+    - .raw : 原始采样 (时间, 数值)
+    - .1m  : 1分钟汇总 (开始时间, 最小值, 平均值, 最大值, 采样数)
+    - .1h  : 1小时汇总 (开始时间, 最小值, 平均值, 最大值, 采样数)
+- 写入原始采样时自动生成1分钟/1小时汇总, 重启后根据文件内容恢复未完成的汇总
+- 文件大小固定, 序列数量超过上限时删除最久没有更新的序列, 磁盘占用有上限
+- 记录器 : 订阅采样器(sampler), 将系统及关注进程的数据写入存储
+    - 进程序列按pid命名 (process.<pid>.rss), 记录每个pid的starttime, pid被新进程复用时删除旧进程的序列重新开始
+
+环形文件格式 (小端)
+    文件头(512字节) : magic(4s) 版本(B) 类型(B) 记录大小(H) 容量(I) 保留(I) 已写入记录总数(Q) 序列名(256s)
+    记录           : 容量 * 记录大小, 第 n 条记录位于 n % 容量
+"""
+
+import os
+import re
+import mmap
+import struct
+import hashlib
+import threading
+from array import array
+from time import time
+
+from sys_monitor import get_mem_info
+from process_monitor import MEM_PAGE_SIZE
+from proc_root import proc_path
+
+# 存储目录
+METRICS_STORE_PATH = os.path.join(os.path.expanduser("~"), ".watch_dogs", "metrics")
+# 各环形文件容量 (记录数)
+METRICS_RAW_SIZE = 3600  # 1秒采样时保存1小时
+METRICS_MINUTE_SIZE = 1440  # 1天
+METRICS_HOUR_SIZE = 2160  # 90天
+# 序列数量上限 (每个序列约 56KB + 56KB + 84KB)
+METRICS_MAX_SERIES = 1000
+
+RESOLUTION_RAW = "raw"
+RESOLUTION_MINUTE = "1m"
+RESOLUTION_HOUR = "1h"
+RESOLUTIONS = (RESOLUTION_RAW, RESOLUTION_MINUTE, RESOLUTION_HOUR)
+# 汇总周期(秒)
+ROLLUP_SECONDS = {RESOLUTION_MINUTE: 60, RESOLUTION_HOUR: 3600}
+
+_MAGIC = b"WDTS"
+_VERSION = 1
+_HEADER = struct.Struct("<4sBBHIIQ256s")
+_HEADER_SIZE = 512
+_COUNT_OFFSET = 16  # 文件头中 已写入记录总数 的位置
+_RECORD = {
+    RESOLUTION_RAW: struct.Struct("<dd"),  # 时间, 数值
+    RESOLUTION_MINUTE: struct.Struct("<ddddd"),  # 开始时间, 最小值, 平均值, 最大值, 采样数
+    RESOLUTION_HOUR: struct.Struct("<ddddd"),
+}
+_KIND = {RESOLUTION_RAW: 0, RESOLUTION_MINUTE: 1, RESOLUTION_HOUR: 2}
+_COUNT = struct.Struct("<Q")
+_CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+_TIME = struct.Struct("<d")
+
+
+class MetricsStoreError(Exception):
+    """历史数据存储错误 (文件格式不匹配等)"""
+    pass
+
+
+class RingFile(object):
+    """定长环形文件 (mmap)"""
+
+    def __init__(self, path, name, resolution, capacity):
+        self.path = path
+        self.record = _RECORD[resolution]
+        size = _HEADER_SIZE + self.record.size * capacity
+
+        exists = os.path.exists(path)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if not exists or os.fstat(fd).st_size == 0:
+                os.ftruncate(fd, size)
+                self._mm = mmap.mmap(fd, size)
+                _HEADER.pack_into(self._mm, 0, _MAGIC, _VERSION, _KIND[resolution], self.record.size, capacity, 0, 0,
+                                  name.encode("utf-8"))
+            else:
+                self._mm = mmap.mmap(fd, os.fstat(fd).st_size)
+        finally:
+            os.close(fd)  # mmap 之后不再需要文件描述符
+
+        magic, version, kind, record_size, file_capacity, _, self.count, _ = _HEADER.unpack_from(self._mm, 0)
+        if magic != _MAGIC or version != _VERSION or kind != _KIND[resolution] or record_size != self.record.size:
+            self._mm.close()
+            raise MetricsStoreError("bad ring file : {}".format(path))
+        # 已存在的文件使用文件中的容量
+        self.capacity = file_capacity
+
+    @staticmethod
+    def read_name(path):
+        """读取环形文件中保存的序列名"""
+        with open(path, "rb") as f:
+            data = f.read(_HEADER.size)
+        if len(data) < _HEADER.size:
+            return None
+        magic, version = _HEADER.unpack(data)[:2]
+        if magic != _MAGIC or version != _VERSION:
+            return None
+        return _HEADER.unpack(data)[-1].rstrip(b"\0").decode("utf-8")
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def _offset(self, i):
+        """第i条(按时间顺序,0为最早)记录的位置"""
+        first = self.count - len(self)
+        return _HEADER_SIZE + (first + i) % self.capacity * self.record.size
+
+    def append(self, *values):
+        """追加一条记录 (覆盖最早的记录)"""
+        self.record.pack_into(self._mm, _HEADER_SIZE + self.count % self.capacity * self.record.size, *values)
+        self.count += 1
+        _COUNT.pack_into(self._mm, _COUNT_OFFSET, self.count)
+
+    def get(self, i):
+        """第i条记录 (支持负数下标)"""
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError("ring index out of range")
+        return self.record.unpack_from(self._mm, self._offset(i))
+
+    def get_time(self, i):
+        """第i条记录的时间 (记录的第一个字段)"""
+        return _TIME.unpack_from(self._mm, self._offset(i))[0]
+
+    def bisect(self, t):
+        """第一条时间 >= t 的记录下标"""
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.get_time(mid) < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def read_array(self, start=0, end=None):
+        """读取 [start, end) 范围内的记录, 返回连续的 array('d') (各字段交错存放)"""
+        n = len(self)
+        end = n if end is None else min(end, n)
+        res = array("d")
+        if start >= end:
+            return res
+        first = (self.count - n + start) % self.capacity
+        total = end - start
+        # 环形文件最多分为两段连续数据
+        head = min(total, self.capacity - first)
+        offset = _HEADER_SIZE + first * self.record.size
+        res.fromstring(self._mm[offset:offset + head * self.record.size])
+        if total > head:
+            res.fromstring(self._mm[_HEADER_SIZE:_HEADER_SIZE + (total - head) * self.record.size])
+        return res
+
+    def flush(self):
+        """写回磁盘"""
+        self._mm.flush()
+
+    def close(self):
+        """关闭文件"""
+        self._mm.close()
+
+
+class Series(object):
+    """一个数据序列 (原始数据 + 1分钟/1小时汇总)"""
+
+    def __init__(self, path_prefix, name, raw_size, minute_size, hour_size):
+        self.name = name
+        self.path_prefix = path_prefix
+        self.rings = {
+            RESOLUTION_RAW: RingFile(path_prefix + ".raw", name, RESOLUTION_RAW, raw_size),
+            RESOLUTION_MINUTE: RingFile(path_prefix + ".1m", name, RESOLUTION_MINUTE, minute_size),
+            RESOLUTION_HOUR: RingFile(path_prefix + ".1h", name, RESOLUTION_HOUR, hour_size),
+        }
+        # 未完成的汇总 [开始时间, 最小值, 最大值, 总和, 采样数]
+        self._pending = {RESOLUTION_MINUTE: None, RESOLUTION_HOUR: None}
+        self.last_time = 0
+        self._restore()
+
+    def _restore(self):
+        """根据文件内容恢复未完成的汇总"""
+        raw, minute, hour = (self.rings[r] for r in RESOLUTIONS)
+        hour_end = hour.get(-1)[0] + ROLLUP_SECONDS[RESOLUTION_HOUR] if len(hour) else 0
+        for i in range(minute.bisect(hour_end), len(minute)):
+            start, low, avg, high, count = minute.get(i)
+            self._merge(RESOLUTION_HOUR, start, low, high, avg * count, count)
+        minute_end = minute.get(-1)[0] + ROLLUP_SECONDS[RESOLUTION_MINUTE] if len(minute) else 0
+        for i in range(raw.bisect(minute_end), len(raw)):
+            t, value = raw.get(i)
+            self._merge(RESOLUTION_MINUTE, t, value, value, value, 1)
+        if len(raw):
+            self.last_time = raw.get(-1)[0]
+
+    def _merge(self, resolution, t, low, high, total, count):
+        """合并数据到未完成的汇总, 进入新的周期时写入上一个周期的汇总"""
+        seconds = ROLLUP_SECONDS[resolution]
+        start = t - t % seconds
+        pending = self._pending[resolution]
+        if pending is not None and pending[0] != start:
+            self._flush_pending(resolution)
+            pending = None
+        if pending is None:
+            self._pending[resolution] = [start, low, high, total, count]
+        else:
+            pending[1] = min(pending[1], low)
+            pending[2] = max(pending[2], high)
+            pending[3] += total
+            pending[4] += count
+
+    def _flush_pending(self, resolution):
+        """写入未完成的汇总"""
+        start, low, high, total, count = self._pending[resolution]
+        self._pending[resolution] = None
+        self.rings[resolution].append(start, low, total / count, high, count)
+        if resolution == RESOLUTION_MINUTE:
+            self._merge(RESOLUTION_HOUR, start, low, high, total, count)
+
+    def append(self, t, value):
+        """写入一个采样 (时间早于最后一个采样时忽略, 返回是否写入)"""
+        if t <= self.last_time:
+            return False
+        value = float(value)
+        self.rings[RESOLUTION_RAW].append(t, value)
+        self.last_time = t
+        self._merge(RESOLUTION_MINUTE, t, value, value, value, 1)
+        return True
+
+    def query(self, start=None, end=None, resolution=RESOLUTION_RAW):
+        """
+        查询 [start, end) 时间范围内的数据
+        :return: array('d') - 原始数据为 时间,数值 交错存放; 汇总数据为 开始时间,最小值,平均值,最大值,采样数 交错存放
+        """
+        ring = self.rings[resolution]
+        lo = 0 if start is None else ring.bisect(start)
+        hi = len(ring) if end is None else ring.bisect(end)
+        return ring.read_array(lo, hi)
+
+    def get_pending(self, resolution):
+        """未完成的汇总 (开始时间, 最小值, 平均值, 最大值, 采样数), 没有时返回None"""
+        pending = self._pending[resolution]
+        if pending is None:
+            return None
+        start, low, high, total, count = pending
+        return start, low, total / count, high, count
+
+    def flush(self):
+        """写回磁盘"""
+        for ring in self.rings.values():
+            ring.flush()
+
+    def close(self):
+        """关闭文件"""
+        for ring in self.rings.values():
+            ring.close()
+
+    def remove(self):
+        """关闭并删除文件"""
+        self.close()
+        for ring in self.rings.values():
+            try:
+                os.remove(ring.path)
+            except OSError:
+                pass
+
+
+def _series_file_name(name):
+    """序列名转换为文件名 (包含特殊字符时加上哈希值避免重名)"""
+    safe = re.sub(r"[^\w.-]", "_", name)
+    if safe != name or len(safe) > 200:
+        safe = "{}-{}".format(safe[:200], hashlib.md5(name.encode("utf-8")).hexdigest()[:8])
+    return safe
+
+
+class MetricsStore(object):
+    """历史数据存储 (线程安全)"""
+
+    def __init__(self, path=METRICS_STORE_PATH, raw_size=METRICS_RAW_SIZE, minute_size=METRICS_MINUTE_SIZE,
+                 hour_size=METRICS_HOUR_SIZE, max_series=METRICS_MAX_SERIES):
+        self.path = path
+        self.raw_size = raw_size
+        self.minute_size = minute_size
+        self.hour_size = hour_size
+        self.max_series = max_series
+        self._series = {}
+        self._lock = threading.RLock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._load()
+
+    def _load(self):
+        """打开目录中已有的序列"""
+        for fn in sorted(os.listdir(self.path)):
+            if not fn.endswith(".raw"):
+                continue
+            try:
+                name = RingFile.read_name(os.path.join(self.path, fn))
+                if name is not None and _series_file_name(name) == fn[:-4]:
+                    self._open_series(name)
+            except (MetricsStoreError, IOError, OSError, struct.error) as err:
+                print "Error : metrics store - skip {} ({})".format(fn, err)
+
+    def _open_series(self, name):
+        """打开或创建序列"""
+        series = Series(os.path.join(self.path, _series_file_name(name)), name, self.raw_size, self.minute_size,
+                        self.hour_size)
+        self._series[name] = series
+        return series
+
+    def _get_series(self, name, create=False):
+        """获取序列 (create - 不存在时创建, 超过序列数量上限时删除最久没有更新的序列)"""
+        series = self._series.get(name)
+        if series is None and create:
+            if len(self._series) >= self.max_series:
+                oldest = min(self._series.values(), key=lambda s: s.last_time)
+                del self._series[oldest.name]
+                oldest.remove()
+            series = self._open_series(name)
+        return series
+
+    def append(self, name, value, t=None):
+        """写入一个采样"""
+        with self._lock:
+            return self._get_series(name, True).append(time() if t is None else t, value)
+
+    def append_many(self, values, t=None):
+        """同一时间写入多个序列的采样 {序列名: 数值}"""
+        t = time() if t is None else t
+        with self._lock:
+            for name, value in values.items():
+                self._get_series(name, True).append(t, value)
+
+    def query(self, name, start=None, end=None, resolution=RESOLUTION_RAW, include_pending=False):
+        """
+        查询序列数据 (序列不存在返回空数组), 格式见 Series.query
+        :param include_pending: 汇总数据包含当前未完成的周期
+        """
+        if resolution not in RESOLUTIONS:
+            raise ValueError("unknown resolution : {}".format(resolution))
+        with self._lock:
+            series = self._get_series(name)
+            if series is None:
+                return array("d")
+            res = series.query(start, end, resolution)
+            if include_pending and resolution != RESOLUTION_RAW:
+                pending = series.get_pending(resolution)
+                if pending is not None and (start is None or pending[0] >= start) and \
+                        (end is None or pending[0] < end):
+                    res.extend(pending)
+            return res
+
+    def get_time_range(self, name, resolution=RESOLUTION_RAW):
+        """序列某一精度数据的 (最早时间, 最晚时间), 没有数据返回None"""
+        with self._lock:
+            series = self._get_series(name)
+            if series is None or not len(series.rings[resolution]):
+                return None
+            ring = series.rings[resolution]
+            return ring.get_time(0), ring.get_time(len(ring) - 1)
+
+    def get_series_names(self, prefix=""):
+        """所有序列名"""
+        with self._lock:
+            return sorted(name for name in self._series if name.startswith(prefix))
+
+    def remove_series(self, name):
+        """删除序列"""
+        with self._lock:
+            series = self._series.pop(name, None)
+            if series is not None:
+                series.remove()
+
+    def flush(self):
+        """写回磁盘"""
+        with self._lock:
+            for series in self._series.values():
+                series.flush()
+
+    def close(self):
+        """关闭存储"""
+        with self._lock:
+            for series in self._series.values():
+                series.flush()
+                series.close()
+            self._series.clear()
+
+    def get_status(self):
+        """存储状态"""
+        with self._lock:
+            per_series = _HEADER_SIZE * 3 + _RECORD[RESOLUTION_RAW].size * self.raw_size + \
+                         _RECORD[RESOLUTION_MINUTE].size * self.minute_size + \
+                         _RECORD[RESOLUTION_HOUR].size * self.hour_size
+            return {"path": self.path, "series": len(self._series), "max_series": self.max_series,
+                    "disk_bytes": per_series * len(self._series), "max_disk_bytes": per_series * self.max_series}
+
+
+def sample_values(prev, last):
+    """
+    根据前后两次采样计算各序列的值 (序列名 -> 数值)
+    sys.cpu_percent, sys.mem_percent, sys.mem_available, sys.net.<网卡>.recv_kbs/send_kbs,
+    process.<pid>.rss/cpu_percent/read_mbs/write_mbs
+    """
+    seconds = last.time - prev.time
+    values = {}
+    total = last.cpu[0] - prev.cpu[0]
+    if total > 0:
+        values["sys.cpu_percent"] = (last.cpu[1] - prev.cpu[1]) * 100.0 / total
+    mem_total, mem_free, mem_available = get_mem_info()
+    values["sys.mem_percent"] = (mem_total - mem_available) * 100.0 / mem_total
+    values["sys.mem_available"] = mem_available
+    for device, (recv, send) in last.net.items():
+        if device in prev.net:
+            values["sys.net.{}.recv_kbs".format(device)] = (recv - prev.net[device][0]) / 1024.0 / seconds
+            values["sys.net.{}.send_kbs".format(device)] = (send - prev.net[device][1]) / 1024.0 / seconds
+    for pid, (starttime, cpu_time, io, rss) in last.process.items():
+        values["process.{}.rss".format(pid)] = rss * MEM_PAGE_SIZE
+        before = prev.process.get(pid)
+        if before is None or before[0] != starttime:  # 新进程或pid复用
+            continue
+        if total > 0:
+            values["process.{}.cpu_percent".format(pid)] = (cpu_time - before[1]) * 100.0 / total
+        if io is not None and before[2] is not None:
+            values["process.{}.read_mbs".format(pid)] = (io[0] - before[2][0]) / 1000. ** 2 / seconds
+            values["process.{}.write_mbs".format(pid)] = (io[1] - before[2][1]) / 1000. ** 2 / seconds
+    return values
+
+
+class MetricsRecorder(object):
+    """将采样器的数据写入历史数据存储"""
+
+    # 写回磁盘的间隔(秒)
+    FLUSH_INTERVAL = 60
+
+    def __init__(self, store, sampler):
+        self.store = store
+        self.sampler = sampler
+        self._last_flush = time()
+        self._starttimes = {}  # pid -> 序列所属进程的starttime
+        self._boot_time = None
+
+    def start(self):
+        """订阅采样器 (采样器需要另外启动)"""
+        self.sampler.subscribe(self.record)
+
+    def stop(self):
+        """取消订阅并写回磁盘"""
+        self.sampler.unsubscribe(self.record)
+        self.store.flush()
+
+    def record(self, prev, last):
+        """采样回调 - 计算两次采样之间的速率并写入"""
+        if prev is None:
+            return
+        self._check_processes(last.process)
+        values = sample_values(prev, last)
+        self.store.append_many(values, last.time)
+
+        if last.time - self._last_flush >= self.FLUSH_INTERVAL:
+            self.store.flush()
+            self._last_flush = last.time
+
+    def _check_processes(self, processes):
+        """pid 被新进程复用时删除旧进程的序列, 避免两个进程的数据写入同一序列 (汇总值混合)"""
+        starttimes = {}
+        for pid, info in processes.items():
+            starttime = starttimes[pid] = info[0]
+            known = self._starttimes.get(pid)
+            if known == starttime:
+                continue
+            names = self.store.get_series_names("process.{}.".format(pid))
+            if known is None:  # 第一次出现 (如重启后), 只删除最后数据早于进程启动时间的序列
+                start = self._process_start(starttime)
+                ranges = [(name, self.store.get_time_range(name)) for name in names] if start is not None else []
+                names = [name for name, time_range in ranges if time_range is not None and time_range[1] < start]
+            for name in names:
+                self.store.remove_series(name)
+        self._starttimes = starttimes
+
+    def _process_start(self, starttime):
+        """进程启动时间 (时间戳, 由 /proc/stat 的 btime 计算, 精度1秒), 无法读取时返回None"""
+        if self._boot_time is None:
+            try:
+                with open(proc_path("stat")) as f:
+                    for line in f:
+                        if line.startswith("btime "):
+                            self._boot_time = int(line.split()[1])
+                            break
+            except (IOError, OSError, ValueError):
+                return None
+        if self._boot_time is None:
+            return None
+        return self._boot_time + float(starttime) / _CLOCK_TICKS
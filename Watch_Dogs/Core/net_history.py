@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# encoding:utf-8
+
+"""
+进程监测核心功能实现 - 进程网络流量历史
+
+主要包括
+- 按进程保存定长的网络流量时间序列(上传/下载速度)
+- 按进程累计上传/下载字节数
+- nethogs 报告 REMOVE 或进程退出时清除对应进程的数据
+- 查询最近N分钟内上传/下载速度的最小值/平均值/最大值
+
+数据使用 array 定长环形缓冲区保存,每个进程的内存占用固定
+"""
+
+import os
+import threading
+from array import array
+from time import time
+
+from proc_root import proc_path
+
+# 每个进程保留的采样点数量 (nethogs约每秒回调一次,默认约保留1小时)
+NET_HISTORY_SIZE = 3600
+# 检查进程是否退出的时间间隔(秒)
+NET_HISTORY_SWEEP_INTERVAL = 10
+
+
+class ProcessNetHistory(object):
+    """单个进程的网络流量历史 - 定长环形缓冲区"""
+
+    __slots__ = ("pid", "size", "pos", "count", "time", "sent_kbs", "recv_kbs", "sent_bytes", "recv_bytes",
+                 "total_sent_bytes", "total_recv_bytes", "records")
+
+    def __init__(self, pid, size=NET_HISTORY_SIZE):
+        self.pid = pid
+        self.size = size
+        self.pos = 0  # 下一个写入位置
+        self.count = 0  # 已保存的采样点数量
+        self.time = array("d", [0.0]) * size
+        self.sent_kbs = array("f", [0.0]) * size
+        self.recv_kbs = array("f", [0.0]) * size
+        self.sent_bytes = array("d", [0.0]) * size  # 采样时的累计上传字节数
+        self.recv_bytes = array("d", [0.0]) * size  # 采样时的累计下载字节数
+        self.total_sent_bytes = 0  # 累计上传字节数(跨nethogs记录)
+        self.total_recv_bytes = 0  # 累计下载字节数(跨nethogs记录)
+        self.records = {}  # record_id -> (sent_bytes, recv_bytes) nethogs记录内的累计值
+
+    def append(self, t, record_id, sent_bytes, recv_bytes, sent_kbs, recv_kbs):
+        """添加一个采样点"""
+        # nethogs 的 sent_bytes/recv_bytes 是单条记录内的累计值,记录重建后会从0开始
+        prev_sent, prev_recv = self.records.get(record_id, (0, 0))
+        self.total_sent_bytes += sent_bytes - prev_sent if sent_bytes >= prev_sent else sent_bytes
+        self.total_recv_bytes += recv_bytes - prev_recv if recv_bytes >= prev_recv else recv_bytes
+        self.records[record_id] = (sent_bytes, recv_bytes)
+
+        i = self.pos
+        self.time[i] = t
+        self.sent_kbs[i] = sent_kbs
+        self.recv_kbs[i] = recv_kbs
+        self.sent_bytes[i] = self.total_sent_bytes
+        self.recv_bytes[i] = self.total_recv_bytes
+        self.pos = (i + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def window_indexes(self, since):
+        """获取时间不早于 since 的采样点下标(按时间先后排列)"""
+        res = []
+        i = self.pos
+        for _ in range(self.count):
+            i = (i - 1) % self.size
+            if self.time[i] < since:
+                break
+            res.append(i)
+        res.reverse()
+        return res
+
+    def summary(self, minutes, now=None):
+        """最近N分钟内上传/下载速度的 min/avg/max 以及累计流量"""
+        now = time() if now is None else now
+        indexes = self.window_indexes(now - minutes * 60)
+        res = {
+            "pid": self.pid,
+            "samples": len(indexes),
+            "sent_bytes": self.total_sent_bytes,
+            "recv_bytes": self.total_recv_bytes,
+            "window_sent_bytes": 0,
+            "window_recv_bytes": 0,
+            "sent_kbs": None,
+            "recv_kbs": None,
+        }
+        if not indexes:
+            return res
+
+        for name, buf in (("sent_kbs", self.sent_kbs), ("recv_kbs", self.recv_kbs)):
+            values = [buf[i] for i in indexes]
+            res[name] = {
+                "min": round(min(values), 2),
+                "avg": round(sum(values) / len(values), 2),
+                "max": round(max(values), 2),
+            }
+        # 窗口内流量 = 窗口内最后一个累计值 - 窗口前一个累计值(窗口外无数据时即为窗口内第一个点之前的0)
+        first, last = indexes[0], indexes[-1]
+        before = (first - 1) % self.size
+        has_before = self.count > len(indexes)
+        res["window_sent_bytes"] = self.sent_bytes[last] - (self.sent_bytes[before] if has_before else 0)
+        res["window_recv_bytes"] = self.recv_bytes[last] - (self.recv_bytes[before] if has_before else 0)
+
+        return res
+
+
+class NetHistory(object):
+    """所有进程的网络流量历史 (nethogs 回调线程写入,其他线程查询)"""
+
+    def __init__(self, size=NET_HISTORY_SIZE, sweep_interval=NET_HISTORY_SWEEP_INTERVAL):
+        self.size = size
+        self.sweep_interval = sweep_interval
+        self._histories = {}  # pid -> ProcessNetHistory
+        self._lock = threading.Lock()
+        self._last_sweep = time()
+
+    def update(self, pid, record_id, sent_bytes, recv_bytes, sent_kbs, recv_kbs, t=None):
+        """记录一次 nethogs SET 数据 (定期清理已退出进程,返回本次被清除的pid)"""
+        t = time() if t is None else t
+        with self._lock:
+            history = self._histories.get(pid)
+            if history is None:
+                history = self._histories[pid] = ProcessNetHistory(pid, self.size)
+            history.append(t, record_id, sent_bytes, recv_bytes, sent_kbs, recv_kbs)
+        if t - self._last_sweep >= self.sweep_interval:
+            return self.sweep(t)
+        return []
+
+    def remove(self, pid):
+        """清除进程数据 (nethogs REMOVE 或进程退出)"""
+        with self._lock:
+            return self._histories.pop(pid, None) is not None
+
+    def sweep(self, now=None):
+        """清除已经退出的进程数据,返回被清除的pid"""
+        self._last_sweep = time() if now is None else now
+        with self._lock:
+            dead = [pid for pid in self._histories if not os.path.exists(proc_path(pid))]
+            for pid in dead:
+                del self._histories[pid]
+        return dead
+
+    def get_pids(self):
+        """有历史数据的进程"""
+        with self._lock:
+            return list(self._histories)
+
+    def query(self, pid, minutes=5, now=None):
+        """查询某一进程最近N分钟内的网络流量统计 (无数据返回空字典)"""
+        with self._lock:
+            history = self._histories.get(pid)
+            if history is None:
+                return {}
+            return history.summary(minutes, now)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# encoding:utf-8
+
+"""
+进程监测核心功能实现 - pidfd
+
+主要包括
+- pidfd_open (Linux 5.3+) 获取指向进程的文件描述符
+- pidfd_send_signal (Linux 5.1+) 通过pidfd发送信号(不受pid复用影响)
+- 检测当前内核是否支持pidfd
+
+pidfd 在进程退出时变为可读,可以放入 epoll 中同时等待大量进程退出.
+内核不支持时各函数抛出 OSError(ENOSYS),调用方需要退回到轮询方式.
+
+reference   :   http://man7.org/linux/man-pages/man2/pidfd_open.2.html
+reference   :   http://man7.org/linux/man-pages/man2/pidfd_send_signal.2.html
+"""
+
+import os
+import ctypes
+import ctypes.util
+
+# 系统调用号 (自 Linux 5.1 起所有架构统一编号)
+SYS_pidfd_send_signal = 424
+SYS_pidfd_open = 434
+
+_libc = None
+_supported = None
+
+
+def _syscall(*args):
+    """执行系统调用,失败时抛出 OSError"""
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    res = _libc.syscall(*args)
+    if res < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return res
+
+
+def pidfd_open(pid):
+    """获取进程的pidfd (需调用方 os.close)"""
+    return _syscall(SYS_pidfd_open, ctypes.c_int(int(pid)), ctypes.c_uint(0))
+
+
+def pidfd_send_signal(pidfd, sig):
+    """通过pidfd向进程发送信号"""
+    return _syscall(SYS_pidfd_send_signal, ctypes.c_int(pidfd), ctypes.c_int(sig), None, ctypes.c_uint(0))
+
+
+def is_pidfd_supported():
+    """检测内核是否支持 pidfd_open (结果缓存)"""
+    global _supported
+    if _supported is None:
+        try:
+            os.close(pidfd_open(os.getpid()))
+            _supported = True
+        except (OSError, AttributeError):  # ENOSYS - 内核不支持, EPERM - 被seccomp等限制
+            _supported = False
+    return _supported
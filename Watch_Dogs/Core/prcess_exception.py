@@ -18,6 +18,8 @@ import errno
 
 from functools import wraps
 
+from self_monitor import instrument
+
 
 # Note eerno : Standard errno system symbols
 # 一个标准的系统错误系统符号,类似于 linux/include/errno.h
@@ -97,7 +99,7 @@ class AccessDenied(ProcessException):
 
 
 def wrap_process_exceptions(func):
-    """装饰器 - 进程信息获取异常"""
+    """装饰器 - 进程信息获取异常 (同时记录调用次数/耗时, 见 self_monitor)"""
 
     @wraps(func)
     def wrapper(*args, **kwargs):
@@ -114,4 +116,4 @@ def wrap_process_exceptions(func):
             # gone so there's no way to distinguish them in here.
             raise
 
-    return wrapper
+    return instrument(wrapper)
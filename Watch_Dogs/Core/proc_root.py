@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# encoding:utf-8
+
+"""
+进程监测核心功能实现 - procfs/sysfs 根目录
+
+主要包括
+- 可配置的 proc/sys 根目录, 所有采集函数通过 proc_path / sys_path 生成路径
+    - 全局配置 : set_proc_root / set_sys_root, 或环境变量 WATCH_DOGS_PROC_ROOT / WATCH_DOGS_SYS_ROOT
+    - 线程内临时切换 : with use_proc_root("/host/proc"): ... (可以在不同线程中同时监测多个根目录)
+- pid命名空间转换 (/proc/[pid]/status 中的 NSpid)
+    - 在容器中挂载宿主机 proc (如 /host/proc) 时, 目录中的pid为宿主机pid
+    - 宿主机pid -> 进程所在命名空间(容器内)的pid, 容器内pid -> 宿主机pid
+- is_own_pid_namespace : 根目录与监控进程不在同一pid命名空间时, process_manage 的信号/重启接口拒绝执行
+
+例 : 容器中运行, 宿主机的 /proc 挂载在 /host/proc
+    WATCH_DOGS_PROC_ROOT=/host/proc WATCH_DOGS_SYS_ROOT=/host/sys python rpc_agent.py
+
+statvfs 等文件系统操作使用的仍是容器内的路径, 磁盘信息需要另外挂载宿主机的文件系统.
+
+reference   :   http://man7.org/linux/man-pages/man7/pid_namespaces.7.html
+"""
+
+import os
+import threading
+from time import time
+from contextlib import contextmanager
+
+PROC_ROOT = os.environ.get("WATCH_DOGS_PROC_ROOT", "/proc").rstrip("/") or "/proc"
+SYS_ROOT = os.environ.get("WATCH_DOGS_SYS_ROOT", "/sys").rstrip("/") or "/sys"
+# pid转换索引的有效时间(秒)
+PID_MAP_TTL = 5
+
+_local = threading.local()
+
+
+def get_proc_root():
+    """当前线程使用的 proc 根目录"""
+    return getattr(_local, "proc", None) or PROC_ROOT
+
+
+def get_sys_root():
+    """当前线程使用的 sys 根目录"""
+    return getattr(_local, "sys", None) or SYS_ROOT
+
+
+def set_proc_root(path):
+    """设置全局 proc 根目录"""
+    global PROC_ROOT
+    PROC_ROOT = path.rstrip("/") or "/proc"
+
+
+def set_sys_root(path):
+    """设置全局 sys 根目录"""
+    global SYS_ROOT
+    SYS_ROOT = path.rstrip("/") or "/sys"
+
+
+def proc_path(*parts):
+    """proc 下的路径, 如 proc_path(1234, "stat") -> /proc/1234/stat"""
+    root = getattr(_local, "proc", None) or PROC_ROOT
+    if not parts:
+        return root
+    return root + "/" + "/".join(map(str, parts))
+
+
+def sys_path(*parts):
+    """sys 下的路径, 如 sys_path("fs/cgroup") -> /sys/fs/cgroup"""
+    root = getattr(_local, "sys", None) or SYS_ROOT
+    if not parts:
+        return root
+    return root + "/" + "/".join(map(str, parts))
+
+
+def proc_ns_path(*parts):
+    """
+    按命名空间显示的系统数据(如 net/dev, mounts)的路径
+    /proc/net, /proc/mounts 指向 /proc/self, 显示的是读取进程所在命名空间的数据,
+    使用其他根目录(如宿主机)时读取该根目录中1号进程的数据
+    """
+    root = getattr(_local, "proc", None) or PROC_ROOT
+    if root == "/proc":
+        return proc_path(*parts)
+    return proc_path(1, *parts)
+
+
+@contextmanager
+def use_proc_root(proc=None, sys=None):
+    """在当前线程中临时使用其他根目录 (None - 不改变)"""
+    prev = getattr(_local, "proc", None), getattr(_local, "sys", None)
+    if proc is not None:
+        _local.proc = proc.rstrip("/")
+    if sys is not None:
+        _local.sys = sys.rstrip("/")
+    try:
+        yield
+    finally:
+        _local.proc, _local.sys = prev
+
+
+def read_ns_pids(pid):
+    """
+    进程在各层pid命名空间中的pid - /proc/[pid]/status NSpid (since Linux 4.1)
+    返回 [proc根目录所在命名空间中的pid, ..., 进程自身所在命名空间中的pid], 没有 NSpid 时返回 [pid]
+    """
+    with open(proc_path(pid, "status"), "r") as p_status:
+        for line in p_status:
+            if line.startswith("NSpid:"):
+                return map(int, line.split()[1:])
+    return [int(pid)]
+
+
+def get_pid_namespace(pid="self", root=None):
+    """进程所在的pid命名空间 (/proc/[pid]/ns/pid 的inode), 无权限或进程不存在返回None"""
+    try:
+        link = os.readlink((root or get_proc_root()) + "/{}/ns/pid".format(pid))  # pid:[4026531836]
+    except OSError:
+        return None
+    return int(link[link.index("[") + 1:-1])
+
+
+def is_own_pid_namespace(root=None):
+    """
+    proc 根目录与本进程是否在同一个pid命名空间 (根目录中的pid可以直接用于 kill / pidfd_open / waitpid)
+    根目录的命名空间为其中1号进程所在的命名空间, 无法读取时视为不同
+    """
+    root = root or get_proc_root()
+    if root == "/proc":
+        return True
+    own = get_pid_namespace("self", "/proc")
+    return own is not None and own == get_pid_namespace(1, root)
+
+
+class PidTranslator(object):
+    """pid转换 - proc根目录所在命名空间(如宿主机)的pid 与 进程自身所在命名空间(如容器内)的pid"""
+
+    def __init__(self, proc_root=None, ttl=PID_MAP_TTL):
+        """:param proc_root: proc 根目录 (None - 使用时的当前根目录)"""
+        self.proc_root = proc_root
+        self.ttl = ttl
+        self._index = {}  # 命名空间内的pid -> [根目录中的pid, ...] (只包含不在根目录所在命名空间中的进程)
+        self._time = 0
+        self._lock = threading.Lock()
+
+    def _root(self):
+        return self.proc_root or get_proc_root()
+
+    def to_ns_pid(self, pid):
+        """根目录中的pid -> 进程自身所在命名空间中的pid"""
+        with use_proc_root(self.proc_root):
+            return read_ns_pids(pid)[-1]
+
+    def _refresh(self):
+        """遍历根目录, 重建索引 (需持有锁)"""
+        index = {}
+        with use_proc_root(self.proc_root):
+            for pid in os.listdir(proc_path()):
+                if not pid.isdigit():
+                    continue
+                try:
+                    ns_pids = read_ns_pids(pid)
+                except (IOError, OSError):  # 进程已退出
+                    continue
+                if len(ns_pids) > 1:
+                    index.setdefault(ns_pids[-1], []).append(int(pid))
+        self._index = index
+        self._time = time()
+
+    def to_root_pids(self, ns_pid, namespace=None):
+        """
+        某一命名空间中的pid -> 根目录中的pid
+        :param namespace: pid命名空间inode (见 get_pid_namespace), None - 本进程所在的命名空间 (如本进程所在容器)
+        :return: [根目录中的pid, ...] (不同命名空间中可能有相同的pid, 无法读取命名空间时返回所有匹配)
+        """
+        ns_pid = int(ns_pid)
+        if namespace is None:
+            namespace = get_pid_namespace("self", "/proc")
+        root = self._root()
+        with self._lock:
+            age = time() - self._time
+            if age >= self.ttl or (ns_pid not in self._index and age >= 1):  # 新启动的进程
+                self._refresh()
+            candidates = list(self._index.get(ns_pid, ()))
+        if os.path.exists("{}/{}".format(root, ns_pid)) and ns_pid not in candidates:
+            candidates.append(ns_pid)  # 与根目录在同一命名空间的进程
+        if namespace is None:
+            return sorted(candidates)
+        namespaces = dict((pid, get_pid_namespace(pid, root)) for pid in candidates)
+        res = [pid for pid in candidates if namespaces[pid] == namespace]
+        if not res and all(ns is None for ns in namespaces.values()):  # 无权限读取命名空间
+            res = candidates
+        return sorted(res)
+
+    def to_root_pid(self, ns_pid, namespace=None):
+        """某一命名空间中的pid -> 根目录中的pid (没有唯一匹配时返回None)"""
+        pids = self.to_root_pids(ns_pid, namespace)
+        return pids[0] if len(pids) == 1 else None
@@ -0,0 +1,455 @@
+#!/usr/bin/env python
+# encoding:utf-8
+
+"""
+进程监测核心功能实现 - 进程过滤表达式
+
+主要包括
+- 过滤表达式编译为判断函数 (只编译一次, 可以重复用于不同的进程快照)
+- 只读取表达式用到的字段所在的文件, 每个进程的文件按需读取(第一次用到时)
+    - 如 uid/user 来自 /proc/[pid]/status, 表达式中没有用到时不会读取
+    - and/or 中读取代价低的条件先判断, 前面的条件已经决定结果时不再读取后面条件的文件
+- 传入采样器的进程表(sampler.ProcessTable)时, 表中已有的字段(rss/threads/cpu_time/读写字节数)直接使用
+
+语法
+    user=app and state in (R,D) and rss > 2G and cmdline ~ /java.*kafka/
+    not (comm = bash or comm = sh) and threads >= 10
+
+    比较 : =  !=  >  >=  <  <=  ~(正则匹配)  !~  in (a, b, ...)  not in (...)
+    逻辑 : and  or  not  (...)  (不区分大小写)
+    数值 : 整数/小数, 字节数可以使用 K/M/G/T 后缀 (1024进制)
+    字符串 : 不含空格和特殊字符时可以不加引号, 否则使用 "..." 或 '...'
+    正则 : /.../ 或字符串 (re.search)
+
+字段
+    /proc/[pid]/stat    : pid ppid comm state pgrp session tty nice priority threads starttime rss vsize cpu_time
+    /proc/[pid]/status  : uid euid gid user
+    /proc/[pid]/cmdline : cmdline
+    /proc/[pid]/io      : read_bytes write_bytes (rchar/wchar, 需要root权限)
+    /proc/[pid]/exe     : exe
+
+无法读取的字段(如无权限)比较结果为假.
+"""
+
+import os
+import re
+import pwd
+
+from bulk_collect import read_proc_file, parse_process_stat, OK, ACCESS_DENIED
+from process_monitor import get_all_pid, MEM_PAGE_SIZE
+from proc_root import proc_path
+
+# 字段 -> 数据来源
+FIELD_SOURCE = {
+    "pid": "stat", "ppid": "stat", "comm": "stat", "state": "stat", "pgrp": "stat", "session": "stat",
+    "tty": "stat", "nice": "stat", "priority": "stat", "threads": "stat", "starttime": "stat", "rss": "stat",
+    "vsize": "stat", "cpu_time": "stat",
+    "uid": "status", "euid": "status", "gid": "status", "user": "status",
+    "cmdline": "cmdline",
+    "read_bytes": "io", "write_bytes": "io",
+    "exe": "exe",
+}
+# 读取代价 (and/or 中代价低的条件先判断)
+SOURCE_COST = {"table": 0, "stat": 1, "status": 2, "io": 2, "cmdline": 3, "exe": 3}
+# 字符串类型的字段, 其余为数值
+STRING_FIELDS = ("comm", "state", "user", "cmdline", "exe")
+
+# 进程表(ProcessTable)中已有的字段 -> (列名, 换算)
+_TABLE_FIELDS = {
+    "starttime": ("starttime", None),
+    "cpu_time": ("cpu", None),
+    "rss": ("rss", MEM_PAGE_SIZE * 1024),
+    "threads": ("threads", None),
+    "read_bytes": ("read", None),
+    "write_bytes": ("write", None),
+}
+_SIZE_SUFFIX = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+_KEYWORDS = ("and", "or", "not", "in")
+
+_TOKEN = re.compile(r"""
+    \s*(?:
+        (?P<op>>=|<=|!=|!~|==|=|>|<|~)
+      | (?P<punct>[(),])
+      | (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+      | (?P<word>[^\s()=!<>~,"']+)
+    )""", re.VERBOSE)
+_REGEX = re.compile(r"\s*/((?:[^/\\]|\\.)*)/")
+
+
+class FilterSyntaxError(ValueError):
+    """过滤表达式语法错误"""
+    pass
+
+
+def _tokenize(text):
+    """词法分析 -> [(类型, 值), ...], 类型为 op/punct/string/regex/word"""
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        if tokens and tokens[-1] in (("op", "~"), ("op", "!~")):  # 正则匹配操作符之后可以是 /.../
+            m = _REGEX.match(text, pos)
+            if m is not None:
+                tokens.append(("regex", m.group(1).replace("\\/", "/")))
+                pos = m.end()
+                continue
+        m = _TOKEN.match(text, pos)
+        if m is None or m.end() == pos:
+            raise FilterSyntaxError("unexpected character at {} : {}".format(pos, text[pos:pos + 10]))
+        kind = m.lastgroup
+        value = m.group(kind)
+        if kind == "string":
+            value = re.sub(r"\\(.)", r"\1", value[1:-1])
+        tokens.append((kind, value))
+        pos = m.end()
+    return tokens
+
+
+def _parse_value(token, field):
+    """比较值 - 数值字段转换为数值(支持字节后缀), 字符串字段保持原样"""
+    kind, value = token
+    if field in STRING_FIELDS or kind in ("string", "regex"):
+        return value
+    try:
+        if value[-1].upper() in _SIZE_SUFFIX:
+            return float(value[:-1]) * _SIZE_SUFFIX[value[-1].upper()]
+        return float(value) if "." in value else int(value)
+    except (ValueError, IndexError):
+        raise FilterSyntaxError("{} requires a number : {}".format(field, value))
+
+
+class _Parser(object):
+    """语法分析 -> 语法树
+    ("and", [子节点]) / ("or", [子节点]) / ("not", 子节点) / ("cmp", 字段, 操作符, 值)
+    """
+
+    def __init__(self, text):
+        self.tokens = _tokenize(text)
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            raise FilterSyntaxError("unexpected end of expression")
+        self.pos += 1
+        return token
+
+    def is_keyword(self, word):
+        kind, value = self.peek()
+        return kind == "word" and value.lower() == word
+
+    def expect(self, kind, value=None):
+        token = self.next()
+        if token[0] != kind or (value is not None and token[1] != value):
+            raise FilterSyntaxError("expected {} but got {}".format(value or kind, token[1]))
+        return token
+
+    def parse(self):
+        if not self.tokens:
+            raise FilterSyntaxError("empty expression")
+        node = self.parse_or()
+        if self.pos != len(self.tokens):
+            raise FilterSyntaxError("unexpected token : {}".format(self.peek()[1]))
+        return node
+
+    def parse_or(self):
+        nodes = [self.parse_and()]
+        while self.is_keyword("or"):
+            self.next()
+            nodes.append(self.parse_and())
+        return nodes[0] if len(nodes) == 1 else ("or", nodes)
+
+    def parse_and(self):
+        nodes = [self.parse_not()]
+        while self.is_keyword("and"):
+            self.next()
+            nodes.append(self.parse_not())
+        return nodes[0] if len(nodes) == 1 else ("and", nodes)
+
+    def parse_not(self):
+        if self.is_keyword("not"):
+            self.next()
+            return "not", self.parse_not()
+        if self.peek() == ("punct", "("):
+            self.next()
+            node = self.parse_or()
+            self.expect("punct", ")")
+            return node
+        return self.parse_compare()
+
+    def parse_compare(self):
+        kind, field = self.next()
+        if kind != "word" or field.lower() in _KEYWORDS:
+            raise FilterSyntaxError("expected a field name but got {}".format(field))
+        if field not in FIELD_SOURCE:
+            raise FilterSyntaxError("unknown field : {} (available : {})".format(field,
+                                                                              ", ".join(sorted(FIELD_SOURCE))))
+        negate = False
+        if self.is_keyword("not"):
+            self.next()
+            negate = True
+            if not self.is_keyword("in"):
+                raise FilterSyntaxError("expected in after not")
+        if self.is_keyword("in"):
+            self.next()
+            self.expect("punct", "(")
+            values = [_parse_value(self.next(), field)]
+            while self.peek() == ("punct", ","):
+                self.next()
+                values.append(_parse_value(self.next(), field))
+            self.expect("punct", ")")
+            node = ("cmp", field, "in", frozenset(values))
+            return ("not", node) if negate else node
+        kind, op = self.next()
+        if kind != "op":
+            raise FilterSyntaxError("expected an operator after {} but got {}".format(field, op))
+        op = "=" if op == "==" else op
+        value_token = self.next()
+        if value_token[0] not in ("word", "string", "regex"):
+            raise FilterSyntaxError("expected a value after {} {}".format(field, op))
+        if op in ("~", "!~"):
+            try:
+                value = re.compile(value_token[1])
+            except re.error as err:
+                raise FilterSyntaxError("invalid regex {} : {}".format(value_token[1], err))
+        else:
+            value = _parse_value(value_token, field)
+            if field in STRING_FIELDS and op not in ("=", "!="):
+                raise FilterSyntaxError("{} only supports = != ~ !~ in".format(field))
+        return "cmp", field, op, value
+
+
+def _compare(op, value):
+    """比较操作 -> 判断函数(字段值), 字段值为None时为假"""
+    if op == "=":
+        return lambda v: v is not None and v == value
+    if op == "!=":
+        return lambda v: v is not None and v != value
+    if op == ">":
+        return lambda v: v is not None and v > value
+    if op == ">=":
+        return lambda v: v is not None and v >= value
+    if op == "<":
+        return lambda v: v is not None and v < value
+    if op == "<=":
+        return lambda v: v is not None and v <= value
+    if op == "~":
+        search = value.search
+        return lambda v: v is not None and search(str(v)) is not None
+    if op == "!~":
+        search = value.search
+        return lambda v: v is not None and search(str(v)) is None
+    if op == "in":
+        return lambda v: v in value
+    raise FilterSyntaxError("unknown operator : {}".format(op))
+
+
+def _compile(node, table_fields):
+    """语法树 -> (判断函数(进程记录), 读取代价, 用到的字段)"""
+    kind = node[0]
+    if kind == "cmp":
+        field, op, value = node[1:]
+        test = _compare(op, value)
+        source = "table" if field in table_fields else FIELD_SOURCE[field]
+
+        def predicate(record):
+            return test(record.get(field))
+
+        return predicate, SOURCE_COST[source], {field}
+    if kind == "not":
+        child, cost, fields = _compile(node[1], table_fields)
+        return (lambda record: not child(record)), cost, fields
+    children = sorted((_compile(child, table_fields) for child in node[1]), key=lambda c: c[1])
+    funcs = tuple(c[0] for c in children)
+    fields = set()
+    for c in children:
+        fields |= c[2]
+    cost = max(c[1] for c in children)
+    if kind == "and":
+        return (lambda record: all(f(record) for f in funcs)), cost, fields
+    return (lambda record: any(f(record) for f in funcs)), cost, fields
+
+
+_user_names = {}
+
+
+def user_name(uid):
+    """uid -> 用户名 (缓存, 没有对应用户时为uid字符串)"""
+    name = _user_names.get(uid)
+    if name is None:
+        try:
+            name = pwd.getpwuid(uid).pw_name
+        except KeyError:
+            name = str(uid)
+        _user_names[uid] = name
+    return name
+
+
+class ProcessGone(Exception):
+    """读取过程中进程已退出"""
+    pass
+
+
+class ProcessRecord(object):
+    """单个进程的字段 (按需读取, 每个文件最多读取一次)"""
+    __slots__ = ("pid", "values", "loaded", "table", "row")
+
+    def __init__(self, pid, table=None, row=None):
+        self.pid = pid
+        self.values = {"pid": int(pid)}
+        self.loaded = set()
+        self.table = table  # 进程表 (ProcessTable) 及本进程所在行
+        self.row = row
+
+    def get(self, field):
+        """字段值 (无法读取为None), 进程已退出时抛出 ProcessGone"""
+        values = self.values
+        if field in values:
+            return values[field]
+        if self.table is not None and field in _TABLE_FIELDS:
+            column, scale = _TABLE_FIELDS[field]
+            data = getattr(self.table, column)
+            if data is not None:
+                value = data[self.row]
+                values[field] = value * scale if scale is not None and value is not None else value
+                return values[field]
+        source = FIELD_SOURCE[field]
+        if source not in self.loaded:
+            self.loaded.add(source)
+            _LOADERS[source](self.pid, values)
+        return values.get(field)
+
+
+def _read(pid, name, size=4096):
+    """读取进程文件, 进程已退出时抛出 ProcessGone, 无权限返回None"""
+    data, code = read_proc_file(proc_path(pid, name), size)
+    if code == OK:
+        return data
+    if code == ACCESS_DENIED:
+        return None
+    raise ProcessGone(pid)
+
+
+def _load_stat(pid, values):
+    data = _read(pid, "stat")
+    if data is None:
+        return
+    stat = parse_process_stat(data)
+    values.update({
+        "pid": stat["pid"], "ppid": stat["ppid"], "comm": stat["comm"], "state": stat["state"],
+        "pgrp": stat["pgrp"], "session": stat["session"], "tty": stat["tty_nr"], "nice": stat["nice"],
+        "priority": stat["priority"], "threads": stat["num_threads"], "starttime": stat["starttime"],
+        "rss": stat["rss"] * MEM_PAGE_SIZE * 1024, "vsize": stat["vsize"],
+        "cpu_time": stat["utime"] + stat["stime"] + stat["cutime"] + stat["cstime"],
+    })
+
+
+def _load_status(pid, values):
+    data = _read(pid, "status", 8192)
+    if data is None:
+        return
+    for line in data.splitlines():
+        if line.startswith("Uid:"):
+            uids = line.split()
+            values["uid"], values["euid"] = int(uids[1]), int(uids[2])
+            values["user"] = user_name(values["uid"])
+        elif line.startswith("Gid:"):
+            values["gid"] = int(line.split()[1])
+            break
+
+
+def _load_cmdline(pid, values):
+    data = _read(pid, "cmdline", 131072)
+    if data is not None:
+        values["cmdline"] = data.replace("\0", " ").strip()
+
+
+def _load_io(pid, values):
+    data = _read(pid, "io")
+    if data is not None:
+        lines = data.split("\n", 2)
+        try:
+            values["read_bytes"], values["write_bytes"] = int(lines[0].split(":")[1]), int(lines[1].split(":")[1])
+        except (ValueError, IndexError):  # 内容不完整, 与无权限读取相同 (字段为空)
+            pass
+
+
+def _load_exe(pid, values):
+    try:
+        values["exe"] = os.readlink(proc_path(pid, "exe"))
+    except OSError:  # 无权限或内核线程
+        if not os.path.exists(proc_path(pid)):
+            raise ProcessGone(pid)
+
+
+_LOADERS = {"stat": _load_stat, "status": _load_status, "cmdline": _load_cmdline, "io": _load_io,
+            "exe": _load_exe}
+
+
+class ProcessFilter(object):
+    """编译后的过滤表达式"""
+
+    def __init__(self, text, table_fields=tuple(_TABLE_FIELDS)):
+        """:param table_fields: 可以从进程表中获取的字段 (影响判断顺序)"""
+        self.text = text
+        self.tree = _Parser(text).parse()
+        self.predicate, self.cost, self.fields = _compile(self.tree, set(table_fields))
+        self.sources = set(FIELD_SOURCE[field] for field in self.fields)
+
+    def match(self, record):
+        """进程记录是否满足条件 (进程已退出时抛出 ProcessGone)"""
+        return self.predicate(record)
+
+    def filter(self, pids=None, table=None, fields=()):
+        """
+        过滤进程
+        :param pids: 进程列表 (None - 进程表中的进程或所有进程)
+        :param table: 进程表 (sampler.ProcessTable), 表中已有的字段不再读取
+        :param fields: 需要返回的字段 (空 - 只返回pid)
+        :return: [pid, ...] 或 [{字段: 值}, ...] (过程中退出的进程不包含在结果中)
+        """
+        for field in fields:
+            if field not in FIELD_SOURCE:
+                raise FilterSyntaxError("unknown field : {}".format(field))
+        if pids is None:
+            pids = table.pids if table is not None else get_all_pid()
+        index = table.index if table is not None else {}
+        predicate = self.predicate
+        res = []
+        for pid in pids:
+            pid = str(pid)
+            row = index.get(pid)
+            record = ProcessRecord(pid, table if row is not None else None, row)
+            try:
+                if not predicate(record):
+                    continue
+                if fields:
+                    item = dict((field, record.get(field)) for field in fields)
+                    item["pid"] = int(pid)
+                    res.append(item)
+                else:
+                    res.append(pid)
+            except ProcessGone:
+                continue
+        return res
+
+
+_compiled = {}
+
+
+def compile_filter(text):
+    """编译过滤表达式 (缓存编译结果)"""
+    compiled = _compiled.get(text)
+    if compiled is None:
+        if len(_compiled) > 256:
+            _compiled.clear()
+        compiled = _compiled[text] = ProcessFilter(text)
+    return compiled
+
+
+def filter_processes(text, pids=None, table=None, fields=()):
+    """按过滤表达式查找进程, 如 filter_processes("user=app and rss > 2G and cmdline ~ /java.*kafka/")"""
+    return compile_filter(text).filter(pids, table, fields)
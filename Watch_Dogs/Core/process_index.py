@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# encoding:utf-8
+
+"""
+进程监测核心功能实现 - 进程名称索引
+
+主要包括
+- 缓存所有进程的进程名(pid -> cmdline,cmdline为空时使用comm)
+- 增量刷新:只读取新出现进程的进程名,删除已经退出的进程
+- 按 pid+starttime 识别进程 : 每次刷新读取各进程的 starttime, pid 被新进程复用时重新读取进程名
+  (搜索结果用于结束/重启进程, 不能返回复用pid的旧进程名)
+- 按关键词搜索进程(包含/完全匹配/前缀/正则,多关键词 AND/OR)
+
+进程名读取逻辑与 process_manage.get_all_pid_name 一致
+"""
+
+import os
+import re
+import threading
+from time import time
+
+from proc_root import proc_path, get_proc_root, use_proc_root
+
+# 两次刷新的最小间隔(秒),间隔内的搜索直接使用缓存
+INDEX_REFRESH_INTERVAL = 0.5
+# 完整重建索引的间隔(秒),用于修正进程自行修改的进程名
+INDEX_REBUILD_INTERVAL = 60
+# 新出现的进程在该时间(秒)内每次刷新都重新读取进程名 (fork 之后 exec 会改变进程名)
+INDEX_RECHECK_YOUNG = 3
+
+SEARCH_TYPES = ("contain", "match", "prefix", "regex")
+
+
+def read_process_name(pid):
+    """读取进程名 - /proc/[pid]/cmdline, 为空时(内核线程,僵尸进程)使用 /proc/[pid]/comm (进程不存在返回None)"""
+    try:
+        with open(proc_path(pid, "cmdline"), "r") as p_cmdline:
+            name = p_cmdline.read().replace("\0", " ").strip()
+        if name:
+            return name
+        with open(proc_path(pid, "comm"), "r") as p_comm:
+            return p_comm.read().strip()
+    except (OSError, IOError):
+        return None
+
+
+def read_process_starttime(pid):
+    """读取进程启动时间 - /proc/[pid]/stat 第22个字段 (进程不存在返回None)"""
+    try:
+        with open(proc_path(pid, "stat"), "r") as p_stat:
+            data = p_stat.read()
+        return int(data[data.rfind(")") + 2:].split()[19])  # 进程名可能包含空格和括号
+    except (OSError, IOError, ValueError, IndexError):
+        return None
+
+
+class ProcessNameIndex(object):
+    """进程名称索引 (线程安全)"""
+
+    def __init__(self, refresh_interval=INDEX_REFRESH_INTERVAL, rebuild_interval=INDEX_REBUILD_INTERVAL,
+                 recheck_young=INDEX_RECHECK_YOUNG, proc_root=None):
+        """:param proc_root: 索引的 proc 根目录 (None - 刷新时的当前根目录)"""
+        self.proc_root = proc_root
+        self.refresh_interval = refresh_interval
+        self.rebuild_interval = rebuild_interval
+        self.recheck_young = recheck_young
+        self._names = {}  # pid(str) -> 进程名
+        self._first_seen = {}  # pid(str) -> 首次发现时间
+        self._starttimes = {}  # pid(str) -> 进程启动时间
+        self._last_refresh = 0
+        self._last_rebuild = 0
+        self._lock = threading.Lock()
+
+    def refresh(self, force=False):
+        """刷新索引 (返回新增进程数, 退出进程数)"""
+        with self._lock, use_proc_root(self.proc_root):
+            now = time()
+            if not force and now - self._last_refresh < self.refresh_interval:
+                return 0, 0
+            if now - self._last_rebuild >= self.rebuild_interval:
+                self._names.clear()
+                self._first_seen.clear()
+                self._starttimes.clear()
+                self._last_rebuild = now
+
+            current = {}  # pid -> starttime
+            for pid in os.listdir(proc_path()):
+                if pid.isdigit():
+                    starttime = read_process_starttime(pid)
+                    if starttime is not None:
+                        current[pid] = starttime
+            known = set(self._names)
+            # 已退出的进程, 以及pid已被新进程复用的进程
+            gone = set(pid for pid in known if current.get(pid) != self._starttimes[pid])
+            known -= gone
+            appeared = set(current) - known
+
+            for pid in gone:
+                del self._names[pid]
+                del self._first_seen[pid]
+                del self._starttimes[pid]
+            # 刚出现的进程可能还未 exec,需要重新读取
+            young = [pid for pid in known if now - self._first_seen[pid] < self.recheck_young]
+            for pid in young:
+                name = read_process_name(pid)
+                if name is not None:
+                    self._names[pid] = name
+            for pid in appeared:
+                name = read_process_name(pid)
+                if name is None:  # 读取过程中进程已退出
+                    continue
+                self._names[pid] = name
+                self._first_seen[pid] = now
+                self._starttimes[pid] = current[pid]
+
+            self._last_refresh = now
+            return len(appeared), len(gone)
+
+    def get_all(self):
+        """获取 pid -> 进程名 (副本)"""
+        self.refresh()
+        with self._lock:
+            return dict(self._names)
+
+    def search(self, keywords, search_type="contain", logic="and", ignore_case=False):
+        """
+        按关键词搜索进程
+        :param keywords: 关键词(字符串)或关键词列表
+        :param search_type: contain-包含关键词, match-完全匹配, prefix-前缀匹配, regex-正则匹配(re.search)
+        :param logic: 多个关键词之间的关系 and/or
+        :return: [(pid, 进程名), ...] 按pid排序
+        """
+        if search_type not in SEARCH_TYPES:
+            raise ValueError("unknown search type : {}".format(search_type))
+        if logic not in ("and", "or"):
+            raise ValueError("unknown logic : {}".format(logic))
+        if isinstance(keywords, basestring):
+            keywords = [keywords]
+        match = self._compile(keywords, search_type, ignore_case)
+        combine = all if logic == "and" else any
+
+        self.refresh()
+        with self._lock:
+            items = self._names.items()
+
+        res = []
+        if len(match) == 1:  # 单个关键词,避免 all/any 的额外开销
+            m = match[0]
+            for pid, name in items:
+                if m(name):
+                    res.append((pid, name))
+        else:
+            for pid, name in items:
+                if combine(m(name) for m in match):
+                    res.append((pid, name))
+
+        return sorted(res, key=lambda r: int(r[0]))
+
+    @staticmethod
+    def _compile(keywords, search_type, ignore_case):
+        """将关键词编译为匹配函数列表"""
+        if search_type == "regex":
+            flags = re.IGNORECASE if ignore_case else 0
+            return [re.compile(k, flags).search for k in keywords]
+
+        if ignore_case:
+            keywords = [k.lower() for k in keywords]
+
+        def make(k):
+            if search_type == "contain":
+                func = lambda name: k in name
+            elif search_type == "match":
+                func = lambda name: k == name
+            else:  # prefix
+                func = lambda name: name.startswith(k)
+            if ignore_case:
+                return lambda name: func(name.lower())
+            return func
+
+        return [make(k) for k in keywords]
+
+
+# 默认索引(模块内共享)
+process_name_index = ProcessNameIndex()
+
+_root_indexes = {}  # proc 根目录 -> ProcessNameIndex
+_root_indexes_lock = threading.Lock()
+
+
+def get_name_index(proc_root=None):
+    """获取某一 proc 根目录的进程名索引 (每个根目录一个, None - 当前根目录)"""
+    root = proc_root or get_proc_root()
+    with _root_indexes_lock:
+        index = _root_indexes.get(root)
+        if index is None:
+            index = _root_indexes[root] = ProcessNameIndex(proc_root=root)
+        return index
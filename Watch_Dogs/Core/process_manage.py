@@ -9,47 +9,70 @@
 - 按进程名称搜索进程
 - 关闭进程
 - 关闭进程(连同相关进程)
+- 优雅关闭进程树(SIGTERM,超时后SIGKILL)
 - 获取同组进程
 - 获取所有子进程
 - 获取进程执行文件地址
 - 后台创建一个新的进程(不随主进程退出,返回创建的进程号)
+- 后台启动任意可执行文件(参数,环境变量,工作目录,资源限制,日志重定向 - 见 process_spawn)
 - 重启进程
+- 批量滚动重启(并发窗口,健康检查,失败后停止)
 """
 
-from process_monitor import get_all_pid, get_process_info
-from prcess_exception import wrap_process_exceptions, NoSuchProcess, ZombieProcess, AccessDenied
+from process_monitor import get_process_info
+from bulk_collect import bulk_get_process_stat, bulk_get_pid_name
+from process_index import get_name_index
+from pidfd import is_pidfd_supported, pidfd_open, pidfd_send_signal
+from process_spawn import launch_process, is_launched_process, reap_process
+from proc_root import proc_path, get_proc_root, is_own_pid_namespace
+from prcess_exception import wrap_process_exceptions, ProcessException, NoSuchProcess, ZombieProcess, AccessDenied
 
 import os
+import re
+import errno
+import shlex
+import select
 import signal
-import subprocess
+import threading
+from collections import deque
+from functools import wraps
+from time import time, sleep
 
 
 def get_all_pid_name(name_type="cmdline"):
     """获取所有进程名"""
-    res = {}
     # 按照命令ps -ef的逻辑,以 cmdline 作为进程名称,当然也可以选择 comm 作为备选
-    for pid in get_all_pid():
-        process_info = get_process_info(pid)
-        process_name = process_info[name_type] if get_process_info(pid)[name_type].strip() else process_info['comm']
-        res[pid] = process_name
+    # 遍历过程中退出的进程直接忽略
+    return bulk_get_pid_name(name_type=name_type)["data"]
 
-    return res
 
+def search_pid_by_keyword(keyword, search_type='contain', logic='and', ignore_case=False):
+    """
+    按进程名搜索进程号
+    search_type : contain-包含关键词, match-完全匹配, prefix-前缀匹配, regex-正则匹配
+    keyword 可以为关键词列表, logic 指定多个关键词之间的关系 (and/or)
+    """
+    # 使用增量刷新的进程名索引,避免每次搜索都重新读取所有进程信息
+    return get_name_index().search(keyword, search_type, logic, ignore_case)
+
+
+def require_own_pid_namespace(func):
+    """
+    装饰器 - 发送信号/等待进程的接口只在 proc 根目录与监控进程在同一pid命名空间时可用
+    (根目录为宿主机 /proc 时, 其中的pid在容器内可能指向其他进程)
+    """
 
-def search_pid_by_keyword(keyword, search_type='contain'):
-    """按进程名搜索进程号 (搜索类型 contain-包含关键词,match-完全匹配)"""
-    res = []
-    for pid, process_name in get_all_pid_name().items():
-        if search_type == 'contain':
-            if keyword in process_name:
-                res.append((pid, process_name))
-        elif search_type == 'match':
-            if keyword == process_name:
-                res.append((pid, process_name))
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not is_own_pid_namespace():
+            raise ProcessException("process management is disabled : proc root {} is in a different pid namespace"
+                                   .format(get_proc_root()))
+        return func(*args, **kwargs)
 
-    return res
+    return wrapper
 
 
+@require_own_pid_namespace
 def kill_process(pid):
     """关闭进程"""
     try:
@@ -63,6 +86,7 @@ def kill_process(pid):
             raise NoSuchProcess(pid)
 
 
+@require_own_pid_namespace
 def kill_all_process(pid, kill_child=True, kill_process_gourp=True):
     """关闭进程 (pid所指进程, 该进程的子进程, 该进程的同组进程)"""
     # 获取需要关闭的进程
@@ -86,6 +110,191 @@ def kill_all_process(pid, kill_child=True, kill_process_gourp=True):
     return True
 
 
+def _read_process_tree_table():
+    """一次遍历 /proc 获取所有进程的 ppid, pgrp, starttime, state (用于构造进程树)"""
+    table = {}
+    for p, stat in bulk_get_process_stat()["data"].items():
+        table[int(p)] = (stat["ppid"], stat["pgrp"], stat["starttime"], stat["state"])
+    return table
+
+
+def get_process_tree(pid, include_process_group=False, table=None):
+    """获取进程树 (pid所指进程及其所有后代进程,可选同组进程),返回 {pid: starttime}"""
+    pid = int(pid)
+    if table is None:  # 批量操作时可以复用同一次 /proc 遍历的结果
+        table = _read_process_tree_table()
+    if pid not in table:
+        raise NoSuchProcess(pid)
+
+    children = {}
+    for p, (ppid, pgrp, starttime, state) in table.items():
+        children.setdefault(ppid, []).append(p)
+
+    tree = {}
+    stack = [pid]
+    while stack:
+        p = stack.pop()
+        if p in tree:
+            continue
+        tree[p] = table[p][2]
+        stack.extend(children.get(p, []))
+
+    if include_process_group:
+        pgrp = table[pid][1]
+        self_pgrp = table.get(os.getpid(), (None, None))[1]
+        if pgrp != self_pgrp:
+            for p, (ppid, p_pgrp, starttime, state) in table.items():
+                if p_pgrp == pgrp:
+                    tree[p] = starttime
+
+    tree.pop(os.getpid(), None)  # 不关闭监控进程本身
+    return tree
+
+
+def _is_same_process_alive(pid, starttime):
+    """进程是否仍然存活 (已退出,僵尸进程,pid被复用均视为已退出)"""
+    try:
+        with open(proc_path(pid, "stat"), "r") as p_stat:
+            p_data = p_stat.readline()
+    except (OSError, IOError):
+        return False
+    fields = p_data[p_data.rindex(")") + 2:].split(" ")
+    return fields[0] not in ("Z", "X") and int(fields[19]) == starttime
+
+
+def _reap_child(pid):
+    """回收监控进程自己的子进程,避免其成为僵尸进程 (launch_process 启动的进程交给 process_spawn 回收并保存返回码)"""
+    if is_launched_process(pid):
+        reap_process(pid)
+        return
+    try:
+        os.waitpid(pid, os.WNOHANG)
+    except OSError:  # 不是当前进程的子进程
+        pass
+
+
+def _wait_processes_exit(members, deadline, poll_interval):
+    """
+    等待一组进程退出,直到全部退出或超时
+    members : {pid: {"starttime":..., "pidfd":...}}
+    返回 {pid: 退出时间}
+    """
+    exited = {}
+    pending = dict((pid, m) for pid, m in members.items() if m["pidfd"] is None)
+    fd_map = dict((m["pidfd"], pid) for pid, m in members.items() if m["pidfd"] is not None)
+
+    epoll = select.epoll() if fd_map else None
+    try:
+        for fd in fd_map:
+            epoll.register(fd, select.EPOLLIN)
+        while (fd_map or pending) and time() < deadline:
+            remaining = max(0, deadline - time())
+            timeout = min(remaining, poll_interval) if pending else remaining
+            if fd_map:
+                for fd, event in epoll.poll(timeout):
+                    pid = fd_map.pop(fd)
+                    epoll.unregister(fd)
+                    exited[pid] = time()
+                    _reap_child(pid)
+            else:
+                sleep(timeout)
+            # 不支持pidfd的进程轮询检查
+            for pid, m in pending.items():
+                _reap_child(pid)
+                if not _is_same_process_alive(pid, m["starttime"]):
+                    del pending[pid]
+                    exited[pid] = time()
+    finally:
+        if epoll is not None:
+            epoll.close()
+
+    return exited
+
+
+def _send_signal(pid, member, sig, result):
+    """向进程发送信号 (优先使用pidfd),发送失败时将结果写入 result"""
+    try:
+        if member["pidfd"] is not None:
+            pidfd_send_signal(member["pidfd"], sig)
+        else:
+            os.kill(pid, sig)
+        if member["sent_time"] is None:
+            member["sent_time"] = time()
+    except OSError as e:
+        if e.errno == errno.ESRCH:
+            result[pid] = {"result": "gone", "signal": None, "time": 0}
+        elif e.errno == errno.EPERM:
+            result[pid] = {"result": "access_denied", "signal": sig, "time": 0}
+        else:
+            raise
+
+
+@require_own_pid_namespace
+def terminate_process_tree(pid, timeout=5, kill_timeout=2, include_process_group=False, sig=signal.SIGTERM,
+                           poll_interval=0.05, table=None):
+    """
+    优雅关闭进程树
+
+    向进程树中所有进程同时发送 SIGTERM,并同时等待所有进程退出(基于pidfd+epoll,内核不支持时轮询),
+    超过 timeout 秒仍未退出的进程发送 SIGKILL, 再等待最多 kill_timeout 秒.
+
+    返回 {pid: {"result": ..., "signal": ..., "time": 发送信号到退出的耗时(秒)}}
+    result : terminated - 收到sig后退出, killed - 收到SIGKILL后退出, gone - 发送信号前已退出,
+             access_denied - 无权限, alive - SIGKILL后仍未退出(如D状态进程)
+    table 为 _read_process_tree_table 的结果(可选)
+    """
+    tree = get_process_tree(pid, include_process_group, table)
+    use_pidfd = is_pidfd_supported()
+    members = {}
+    result = {}
+
+    try:
+        # 1. 获取pidfd并发送信号
+        for p, starttime in tree.items():
+            m = {"starttime": starttime, "pidfd": None, "sent_time": None}
+            if use_pidfd:
+                try:
+                    m["pidfd"] = pidfd_open(p)
+                except OSError as e:
+                    if e.errno == errno.ESRCH:
+                        result[p] = {"result": "gone", "signal": None, "time": 0}
+                        continue
+                    # 其他错误(如文件描述符耗尽)时该进程退回到轮询方式
+            # 获取pidfd之后再确认starttime,避免pid已被复用
+            if not _is_same_process_alive(p, starttime):
+                result[p] = {"result": "gone", "signal": None, "time": 0}
+                if m["pidfd"] is not None:
+                    os.close(m["pidfd"])
+                continue
+            members[p] = m
+            _send_signal(p, m, sig, result)
+
+        # 2. 同时等待所有进程退出
+        alive = dict((p, m) for p, m in members.items() if p not in result)
+        deadline = time() + timeout
+        for p, exit_time in _wait_processes_exit(alive, deadline, poll_interval).items():
+            result[p] = {"result": "terminated", "signal": sig, "time": exit_time - members[p]["sent_time"]}
+
+        # 3. 超时未退出的进程 SIGKILL
+        alive = dict((p, m) for p, m in members.items() if p not in result)
+        for p, m in alive.items():
+            _send_signal(p, m, signal.SIGKILL, result)
+        alive = dict((p, m) for p, m in alive.items() if p not in result)
+        deadline = time() + kill_timeout
+        for p, exit_time in _wait_processes_exit(alive, deadline, poll_interval).items():
+            result[p] = {"result": "killed", "signal": signal.SIGKILL, "time": exit_time - members[p]["sent_time"]}
+
+        for p in alive:
+            if p not in result:
+                result[p] = {"result": "alive", "signal": signal.SIGKILL, "time": time() - members[p]["sent_time"]}
+    finally:
+        for m in members.values():
+            if m["pidfd"] is not None:
+                os.close(m["pidfd"])
+
+    return result
+
+
 def get_process_parent_pid(pid):
     """获取进程父进程id - ppid"""
     return get_process_info(pid)['ppid']
@@ -98,25 +307,16 @@ def get_process_group_id(pid):
 
 def get_same_group_process(pid):
     """获取同组进程"""
-    result = []
     pgrp = get_process_group_id(pid)
-
-    for p in get_all_pid():
-        if pgrp == get_process_group_id(p):
-            result.append(p)
+    result = [p for p, stat in bulk_get_process_stat()["data"].items() if stat["pgrp"] == pgrp]
     # 一般最小的pid为组id和整个进程的父pid
-    return sorted(result, reverse=False)
+    return sorted(result, key=int)
 
 
 def get_all_child_process(pid):
     """获取所有子进程"""
-    result = []
-
-    for p in get_all_pid():
-        if pid == get_process_parent_pid(p):
-            result.append(p)
-
-    return sorted(result, reverse=False)
+    result = [p for p, stat in bulk_get_process_stat()["data"].items() if stat["ppid"] == int(pid)]
+    return sorted(result, key=int)
 
 
 @wrap_process_exceptions
@@ -140,11 +340,11 @@ def get_process_execute_path(pid):
         ptrace access mode PTRACE_MODE_READ_FSCREDS check; see ptrace(2).
     """
 
-    cwd_path = "/proc/{}/cwd".format(pid)
+    cwd_path = proc_path(pid, "cwd")
     return os.readlink(cwd_path)
 
 
-def start_process(execute_file_full_path):
+def start_process(execute_file_full_path, args=(), log_path=None):
     """后台创建一个新的进程(不随主进程退出,返回创建的进程号)"""
     # reference : https://stackoverflow.com/questions/1605520/how-to-launch-and-run-external-script-in-background
     # reference : https://www.cnblogs.com/zhoug2020/p/5079407.html
@@ -152,23 +352,172 @@ def start_process(execute_file_full_path):
     # reference : https://stackoverflow.com/questions/1196074/how-to-start-a-background-process-in-python
 
     # 获取执行文件相关地址
-    cwd = execute_file_full_path[:execute_file_full_path.rindex("/")]
-    execute_file = execute_file_full_path[execute_file_full_path.rindex("/") + 1:]
+    cwd = os.path.dirname(execute_file_full_path)
     # 启动进程
-    if execute_file.endswith('.py'):  # python
-        p = subprocess.Popen(["nohup", "python", execute_file_full_path],
-                             cwd=cwd,
-                             close_fds=True,
-                             stderr=subprocess.STDOUT)
-        return p.pid
-    # todo : support more execute file
+    if execute_file_full_path.endswith('.py'):  # python
+        command = ["python", execute_file_full_path]
+    elif os.access(execute_file_full_path, os.X_OK):  # 可执行文件
+        command = [execute_file_full_path]
     else:
         return False
+    # 与 nohup 一致,默认输出到工作目录下的 nohup.out
+    if log_path is None:
+        log_path = os.path.join(cwd, "nohup.out")
+
+    return launch_process(command + list(args), cwd=cwd, stdout=log_path)["pid"]
 
 
+@require_own_pid_namespace
 def restart_process(pid, execute_file_full_path):
     """重启进程"""
     # 关闭
-    kill_all_process(pid)
+    terminate_process_tree(pid, include_process_group=True)
     # 启动
     return start_process(execute_file_full_path)
+
+
+def _wait_process_healthy(pid, starttime, healthy_seconds, log_path=None, log_pattern=None, log_offset=0,
+                          timeout=60, poll_interval=0.1):
+    """
+    健康检查 - 进程持续存活 healthy_seconds 秒, 且(指定时)日志文件中出现 log_pattern
+    返回 (是否健康, 失败原因)
+    """
+    start = time()
+    pattern = re.compile(log_pattern) if log_pattern else None
+    pattern_seen = pattern is None
+    buf = ""
+    while True:
+        _reap_child(pid)
+        if not _is_same_process_alive(pid, starttime):
+            return False, "process exited"
+        if not pattern_seen and log_path and os.path.exists(log_path):
+            with open(log_path, "r") as log_f:
+                log_f.seek(log_offset)
+                data = log_f.read()
+            log_offset += len(data)
+            text = buf + data
+            pattern_seen = bool(pattern.search(text))
+            # 保留最后一行不完整的内容,避免关键词被两次读取截断
+            buf = text[text.rfind("\n") + 1:]
+        elapsed = time() - start
+        if pattern_seen and elapsed >= healthy_seconds:
+            return True, None
+        if elapsed >= timeout:
+            return False, "log pattern not seen" if not pattern_seen else "timeout"
+        sleep(poll_interval)
+
+
+def _restart_report(pid, result="failed", error=None):
+    """批量重启 - 单个进程的结果"""
+    return {"pid": pid, "new_pid": None, "starttime": None, "result": result, "error": error,
+            "stop_time": 0, "start_time": 0, "health_time": 0, "total_time": 0}
+
+
+# 关闭原进程时视为已退出的结果 (其他结果如 access_denied / alive 时不启动新进程, 避免同时运行两个实例)
+_STOPPED_RESULTS = ("terminated", "killed", "gone")
+
+
+def _restart_one(pid, command, options, healthy_seconds, log_pattern, health_timeout, stop_timeout):
+    """批量重启 - 重启单个进程并等待健康检查 (log_pattern 为已编译的正则或None)"""
+    report = _restart_report(pid)
+    begin = time()
+    try:
+        # 1. 关闭原进程树
+        if pid is not None:
+            try:  # 关闭前重新读取进程表, 包含等待期间新创建的子进程
+                terminated = terminate_process_tree(pid, timeout=stop_timeout, include_process_group=True)
+            except NoSuchProcess:
+                terminated = {}
+            survivors = dict((p, r["result"]) for p, r in terminated.items() if r["result"] not in _STOPPED_RESULTS)
+            if survivors:
+                report["error"] = "failed to stop process : {}".format(survivors)
+                return report
+        report["stop_time"] = time() - begin
+
+        # 2. 启动新进程
+        if isinstance(command, basestring):
+            command = shlex.split(command)
+        log_path = options.get("log_path")
+        log_offset = os.path.getsize(log_path) if log_path and os.path.exists(log_path) else 0
+        t = time()
+        info = launch_process(command, env=options.get("env"), cwd=options.get("cwd"),
+                              rlimits=options.get("rlimits"), stdout=options.get("stdout", log_path))
+        report["new_pid"], report["starttime"] = info["pid"], info["starttime"]
+        report["start_time"] = time() - t
+
+        # 3. 健康检查
+        t = time()
+        healthy, error = _wait_process_healthy(info["pid"], info["starttime"], healthy_seconds, log_path,
+                                               log_pattern, log_offset, max(health_timeout, healthy_seconds))
+        report["health_time"] = time() - t
+        report["result"] = "ok" if healthy else "failed"
+        report["error"] = error
+    except (OSError, IOError, ProcessException) as e:
+        report["error"] = str(e)
+    finally:
+        report["total_time"] = time() - begin
+
+    return report
+
+
+@require_own_pid_namespace
+def batch_restart_process(items, concurrency=4, healthy_seconds=5, log_pattern=None, health_timeout=60,
+                          stop_timeout=10, stop_on_failure=True):
+    """
+    批量滚动重启
+
+    :param items: [(pid, command), ...] 或 [(pid, command, options), ...]
+                  command 为命令参数列表或命令字符串, pid为None时只启动
+                  options : cwd, env, rlimits, stdout, log_path(健康检查日志文件), log_pattern
+    :param concurrency: 同时重启的进程数量
+    :param healthy_seconds: 新进程需要持续存活的时间(秒)
+    :param log_pattern: 健康检查 - 日志文件(options["log_path"])中需要出现的内容(正则),
+                        指定时必须有 log_path, 正则无效或缺少 log_path 时在启动任何进程之前抛出 ValueError
+    :param health_timeout: 健康检查超时时间(秒)
+    :param stop_timeout: 关闭原进程时 SIGTERM 后等待的时间(秒)
+    :param stop_on_failure: 出现失败后不再开始新的重启
+    :return: 与 items 顺序一致的重启结果列表,
+             result : ok - 重启成功, failed - 失败, skipped - 因前面的失败而未执行
+    """
+    items = [(item[0], item[1], item[2] if len(item) > 2 else {}) for item in items]
+    # 启动任何进程之前检查健康检查配置
+    patterns = []
+    for pid, command, options in items:
+        pattern = options.get("log_pattern", log_pattern)
+        if pattern and not options.get("log_path"):
+            raise ValueError("log_pattern requires log_path (pid={})".format(pid))
+        try:
+            patterns.append(re.compile(pattern) if pattern else None)
+        except re.error as e:
+            raise ValueError("invalid log_pattern {!r} : {}".format(pattern, e))
+    reports = [None] * len(items)
+    pending = deque(enumerate(items))
+    lock = threading.Lock()
+    failed = threading.Event()
+
+    def worker():
+        while True:
+            with lock:
+                if not pending or (stop_on_failure and failed.is_set()):
+                    return
+                i, (pid, command, options) = pending.popleft()
+            try:
+                report = _restart_one(int(pid) if pid is not None else None, command, options, healthy_seconds,
+                                      patterns[i], health_timeout, stop_timeout)
+            except Exception as e:  # 工作线程不能退出, 否则该进程会被记为 skipped
+                report = _restart_report(pid, error="{}: {}".format(type(e).__name__, e))
+            reports[i] = report
+            if report["result"] != "ok":
+                failed.set()
+
+    workers = [threading.Thread(target=worker) for _ in range(max(1, min(concurrency, len(items))))]
+    for w in workers:
+        w.daemon = True
+        w.start()
+    for w in workers:
+        w.join()
+
+    for i, (pid, command, options) in enumerate(items):
+        if reports[i] is None:
+            reports[i] = _restart_report(pid, "skipped")
+    return reports
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# encoding:utf-8
+
+"""
+进程监测核心功能实现 - 进程内存明细 (PSS/USS/Swap)
+
+主要包括
+- /proc/[pid]/smaps_rollup (Linux 4.14+) : 一次读取得到整个进程的汇总数据
+    - pss  : 按共享进程数分摊后的内存 (多进程服务的各进程 pss 之和才是实际占用)
+    - uss  : 进程独占的内存 (Private_Clean + Private_Dirty), 进程退出后可以释放的部分
+    - swap : 被换出的内存, swap_pss 为分摊后的值
+- 没有 smaps_rollup 或无权限读取(需要与进程相同用户或root)时使用 /proc/[pid]/statm
+    - 不能得到 pss/swap (为None), uss 近似为 resident - shared (匿名内存)
+- 内存页大小从系统获取 (os.sysconf), 不假设为4KB
+- smaps_rollup 需要遍历进程的全部内存映射, 开销较大 : 明细按 (pid, starttime) 缓存,
+  每 MEMORY_DETAIL_INTERVAL 秒刷新一次; rss 每次从 /proc/[pid]/stat 读取
+
+结果单位均为字节.
+
+reference   :   http://man7.org/linux/man-pages/man5/proc.5.html (/proc/[pid]/smaps_rollup, /proc/[pid]/statm)
+"""
+
+import threading
+from time import time
+
+from bulk_collect import read_proc_file, parse_process_stat, collect_per_pid, OK, NO_SUCH_PROCESS, ACCESS_DENIED, \
+    OTHER_ERROR
+from process_monitor import PAGE_SIZE
+from proc_root import proc_path
+from prcess_exception import NoSuchProcess, AccessDenied, ProcessException
+from self_monitor import instrument
+
+# 内存明细(smaps_rollup)的刷新间隔(秒)
+MEMORY_DETAIL_INTERVAL = 30
+
+# smaps_rollup 字段 -> 结果字段
+_SMAPS_FIELDS = {
+    "Rss": "rss",
+    "Pss": "pss",
+    "Pss_Anon": "pss_anon",  # Linux 5.0+
+    "Pss_File": "pss_file",
+    "Pss_Shmem": "pss_shmem",
+    "Shared_Clean": "shared_clean",
+    "Shared_Dirty": "shared_dirty",
+    "Private_Clean": "private_clean",
+    "Private_Dirty": "private_dirty",
+    "Anonymous": "anonymous",
+    "Swap": "swap",
+    "SwapPss": "swap_pss",
+}
+
+
+def parse_smaps_rollup(data):
+    """解析 /proc/[pid]/smaps_rollup 内容, 返回 {字段: 字节数} (字段见 _SMAPS_FIELDS)"""
+    res = {}
+    for line in data.splitlines():
+        name, sep, value = line.partition(":")
+        field = _SMAPS_FIELDS.get(name)
+        if field is not None and sep:
+            res[field] = int(value.split()[0]) * 1024  # kB
+    return res
+
+
+def parse_statm(data):
+    """解析 /proc/[pid]/statm 内容, 返回 {"size", "resident", "shared", "text", "data"} (字节)"""
+    size, resident, shared, text, lib, data_, dt = map(int, data.split()[:7])
+    return {"size": size * PAGE_SIZE, "resident": resident * PAGE_SIZE, "shared": shared * PAGE_SIZE,
+            "text": text * PAGE_SIZE, "data": data_ * PAGE_SIZE}
+
+
+def read_memory_detail(pid):
+    """
+    读取进程内存明细, 返回 (数据, 错误码)
+    数据 : {"source": "smaps_rollup"/"statm", "pss", "uss", "swap", "swap_pss", "shared", "anonymous", ...}
+    """
+    data, code = read_proc_file(proc_path(pid, "smaps_rollup"))
+    if code == OK and data:  # 内核线程的 smaps_rollup 为空
+        smaps = parse_smaps_rollup(data)
+        if "pss" in smaps:
+            smaps["source"] = "smaps_rollup"
+            smaps["uss"] = smaps.get("private_clean", 0) + smaps.get("private_dirty", 0)
+            smaps["shared"] = smaps.get("shared_clean", 0) + smaps.get("shared_dirty", 0)
+            return smaps, OK
+
+    # 旧内核(没有 smaps_rollup) / 无权限 / 内核线程 -> statm
+    data, code = read_proc_file(proc_path(pid, "statm"))
+    if code != OK:
+        return None, code
+    try:
+        statm = parse_statm(data)
+    except ValueError:
+        return None, OTHER_ERROR
+    return {
+        "source": "statm",
+        "rss": statm["resident"],
+        "pss": None,
+        "uss": statm["resident"] - statm["shared"],  # 近似值 (匿名内存)
+        "swap": None,
+        "swap_pss": None,
+        "shared": statm["shared"],
+        "anonymous": None,
+    }, OK
+
+
+class MemoryCache(object):
+    """进程内存明细缓存 - 按 (pid, starttime) 缓存 smaps_rollup 数据 (线程安全)"""
+
+    def __init__(self, interval=MEMORY_DETAIL_INTERVAL):
+        """:param interval: 明细刷新间隔(秒), rss 每次查询时读取"""
+        self.interval = interval
+        self._cache = {}  # pid -> (starttime, 读取时间, 明细)
+        self._purge_time = time()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, pid):
+        """
+        进程内存, 返回 (数据, 错误码)
+        数据 : 明细(见 read_memory_detail) 另外包括 "rss" (最新值), "vms", "detail_age" (明细距今的秒数)
+        """
+        pid = str(pid)
+        data, code = read_proc_file(proc_path(pid, "stat"))
+        if code != OK:
+            return None, code
+        try:
+            stat = parse_process_stat(data)
+        except (ValueError, IndexError):
+            return None, OTHER_ERROR
+
+        now = time()
+        with self._lock:
+            cached = self._cache.get(pid)
+            fresh = cached is not None and cached[0] == stat["starttime"] and now - cached[1] < self.interval
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if fresh:
+            read_time, detail = cached[1], cached[2]
+        else:  # 在锁外读取 smaps_rollup
+            detail, code = read_memory_detail(pid)
+            if code != OK:
+                return None, code
+            read_time = now
+            with self._lock:
+                self._cache[pid] = (stat["starttime"], now, detail)
+                if now - self._purge_time > self.interval:
+                    self._purge(now)
+
+        res = dict(detail)
+        res["rss"] = stat["rss"] * PAGE_SIZE
+        res["vms"] = stat["vsize"]
+        res["detail_age"] = now - read_time
+        return res, OK
+
+    def _purge(self, now):
+        """删除长时间没有刷新的缓存 (进程已退出或不再查询, 需持有锁)"""
+        for pid, (starttime, read_time, detail) in self._cache.items():
+            if now - read_time > self.interval * 2:
+                del self._cache[pid]
+        self._purge_time = now
+
+    def invalidate(self, pid=None):
+        """清除缓存 (None - 全部), 下一次查询重新读取明细"""
+        with self._lock:
+            if pid is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(str(pid), None)
+
+    def get_status(self):
+        with self._lock:
+            return {"interval": self.interval, "cached": len(self._cache), "hits": self.hits, "misses": self.misses}
+
+
+memory_cache = MemoryCache()
+
+
+@instrument
+def get_process_memory_detail(pid):
+    """获取进程内存明细 - rss/pss/uss/swap (字节), 明细每 MEMORY_DETAIL_INTERVAL 秒刷新"""
+    res, code = memory_cache.get(pid)
+    if code == NO_SUCH_PROCESS:
+        raise NoSuchProcess(pid)
+    if code == ACCESS_DENIED:
+        raise AccessDenied(pid)
+    if code != OK:
+        raise ProcessException("cannot read memory of process {}".format(pid))
+    return res
+
+
+@instrument
+def bulk_get_process_memory_detail(pids=None):
+    """批量获取进程内存明细 (与 get_process_memory_detail 一致, 共用缓存)"""
+    return collect_per_pid(pids, memory_cache.get)
@@ -8,11 +8,13 @@
 - 获取所有进程号
 - 获取进程基本信息
 - 获取进程CPU占用率
+- 获取进程启动时间
 - 获取路径文件夹总大小
 - 获取路径可用大小
 - 获取进程占用内存大小
 - 获取进程磁盘占用(需要root权限)
 - 获取进程网络监控(基于libnethogs,需要读写net文件权限)
+- 获取进程网络流量历史统计(基于libnethogs)
 - 判断日志文件是否存在
 - 获取日志文件前n行
 - 获取日志文件最后n行
@@ -26,12 +28,13 @@ reference   :   https://github.com/raboof/nethogs
 
 import os
 import ctypes
-import signal
 import datetime
 import threading
 from copy import deepcopy
 from time import time, sleep, localtime, strftime
 
+from net_history import NetHistory
+from proc_root import proc_path
 from prcess_exception import wrap_process_exceptions
 from sys_monitor import get_total_cpu_time, get_default_net_device
 
@@ -43,10 +46,10 @@ all_process_info_dict["watch_pid"] = set()  # 关注的进程pid
 all_process_info_dict["process_info"] = {}  # 关注进程的相关信息
 all_process_info_dict["prev_cpu_total_time"] = 0  # 上次记录的总CPU时间片
 # nethogs相关
-all_process_info_dict["libnethogs_thread"] = None  # nethogs进程流量监控线程
+all_process_info_dict["libnethogs_service"] = None  # nethogs进程流量监控服务(管理监控线程)
 all_process_info_dict["libnethogs_thread_install"] = False  # libnethogs是否安装成功
-all_process_info_dict["libnethogs"] = None  # nethogs动态链接库对象
-all_process_info_dict["libnethogs_data"] = {}  # nethogs监测进程流量数据
+all_process_info_dict["libnethogs_data"] = {}  # nethogs监测进程流量数据(最新一条)
+all_process_info_dict["libnethogs_history"] = NetHistory()  # nethogs监测进程流量历史数据
 
 # 标准进程相关信息数据结构
 process_info_dict = {}
@@ -55,7 +58,8 @@ process_info_dict["prev_cpu_time"] = None
 process_info_dict["prev_io"] = None
 
 # 系统内核数据
-MEM_PAGE_SIZE = 4  # KB
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")  # 字节 (x86 为4KB, 部分arm64内核为16KB/64KB)
+MEM_PAGE_SIZE = PAGE_SIZE // 1024  # KB
 
 # Libnethogs 数据
 # 动态链接库名称
@@ -76,13 +80,13 @@ def get_all_pid():
         except ValueError:
             return False
 
-    return filter(isDigit, os.listdir("/proc"))
+    return filter(isDigit, os.listdir(proc_path()))
 
 
 @wrap_process_exceptions
 def get_process_info(pid):
     """获取进程信息 - /proc/[pid]/stat"""
-    with open("/proc/{}/stat".format(pid), "r") as p_stat:
+    with open(proc_path(pid, "stat"), "r") as p_stat:
         p_data = p_stat.readline()
 
     p_data = p_data.split(" ")
@@ -115,7 +119,7 @@ def get_process_info(pid):
 
     """
 
-    with open("/proc/{}/cmdline".format(pid), "r") as p_cmdline:
+    with open(proc_path(pid, "cmdline"), "r") as p_cmdline:
         p_cmdline = p_cmdline.readline().replace('\0', ' ').strip()
 
     return {
@@ -124,7 +128,7 @@ def get_process_info(pid):
         "state": p_data[2],
         "ppid": int(p_data[3]),
         "pgrp": int(p_data[4]),
-        "thread num": len(os.listdir("/proc/{}/task".format(pid))),
+        "thread num": len(os.listdir(proc_path(pid, "task"))),
         "cmdline": p_cmdline
     }
 
@@ -339,12 +343,22 @@ def get_process_cpu_time(pid):
         The thread"s exit status in the form reported by waitpid(2).
     """
 
-    with open("/proc/{}/stat".format(pid), "r") as p_stat:
+    with open(proc_path(pid, "stat"), "r") as p_stat:
         p_data = p_stat.readline()
 
     return sum(map(int, p_data.split(" ")[13:17]))  # 进程cpu时间片 = utime+stime+cutime+cstime
 
 
+@wrap_process_exceptions
+def get_process_start_time(pid):
+    """获取进程启动时间 - /proc/[pid]/stat (系统启动后的时钟滴答数,与pid一起可以唯一确定一个进程)"""
+    with open(proc_path(pid, "stat"), "r") as p_stat:
+        p_data = p_stat.readline()
+
+    # comm 中可能包含空格,从最后一个 ')' 之后开始解析, (22) starttime
+    return int(p_data[p_data.rindex(")") + 2:].split(" ")[19])
+
+
 def calc_process_cpu_percent(pid, interval=calc_func_interval):
     """计算进程CPU使用率 (计算的cpu总体占用率)"""
     global all_process_info_dict, process_info_dict
@@ -420,7 +434,7 @@ def get_process_mem(pid, style="M"):
         This does not include pages which have not been  demand-loaded  in,  or which are swapped out.
     """
 
-    with open("/proc/{}/stat".format(pid), "r") as p_stat:
+    with open(proc_path(pid, "stat"), "r") as p_stat:
         p_data = p_stat.readline()
 
     global MEM_PAGE_SIZE
@@ -559,7 +573,7 @@ def get_process_io(pid):
     # 通过PyInstaller将核心内容打包成可执行文件后,用setcap提权(看起来是最优雅的,待完成所有功能后试一下,如何交互呢?)
     # ...待完善
 
-    with open("/proc/{}/io".format(pid), "r") as p_io:
+    with open(proc_path(pid, "io"), "r") as p_io:
         rchar = p_io.readline().split(":")[1].strip()
         wchar = p_io.readline().split(":")[1].strip()
 
@@ -691,13 +705,6 @@ class NethogsMonitorRecord(ctypes.Structure):
                 )
 
 
-def signal_handler(signal, frame):
-    """nethogs进程流量监控线程 - 退出信号处理"""
-    global all_process_info_dict
-    all_process_info_dict["libnethogs"].nethogsmonitor_breakloop()
-    all_process_info_dict["libnethogs_thread"] = None
-
-
 def dev_args(devnames):
     """
     nethogs进程流量监控线程 - 退出信号处理
@@ -721,52 +728,40 @@ def dev_args(devnames):
     )
 
 
-def run_monitor_loop(lib, devnames):
-    """nethogs进程流量监控线程 - 主循环"""
-    global all_process_info_dict
-
-    # Create a type for my callback func. The callback func returns void (None), and accepts as
-    # params an int and a pointer to a NethogsMonitorRecord instance.
-    # The params and return type of the callback function are mandated by nethogsmonitor_loop().
-    # See libnethogs.h.
-    CALLBACK_FUNC_TYPE = ctypes.CFUNCTYPE(
-        ctypes.c_void_p, ctypes.c_int, ctypes.POINTER(NethogsMonitorRecord)
-    )
-
+def run_monitor_loop(lib, devnames, callback):
+    """nethogs进程流量监控线程 - 主循环 (阻塞直至 nethogsmonitor_breakloop 或出错,返回循环状态码)"""
     filter_arg = FILTER
     if filter_arg is not None:
         filter_arg = ctypes.c_char_p(filter_arg.encode("ascii"))
 
     if len(devnames) < 1:
         # monitor all devices
-        rc = lib.nethogsmonitor_loop(
-            CALLBACK_FUNC_TYPE(network_activity_callback),
-            filter_arg
-        )
-
-    else:
-        devc, devicenames = dev_args(devnames)
-        rc = lib.nethogsmonitor_loop_devices(
-            CALLBACK_FUNC_TYPE(network_activity_callback),
-            filter_arg,
-            devc,
-            devicenames,
-            ctypes.c_bool(False)
-        )
-
-    if rc != LoopStatus.OK:
-        print("nethogsmonitor loop returned {}".format(LoopStatus.MAP[rc]))
-    else:
-        print("exiting nethogsmonitor loop")
+        return lib.nethogsmonitor_loop(callback, filter_arg)
+
+    devc, devicenames = dev_args(devnames)
+    return lib.nethogsmonitor_loop_devices(
+        callback,
+        filter_arg,
+        devc,
+        devicenames,
+        ctypes.c_bool(False)
+    )
 
 
 def network_activity_callback(action, data):
     """nethogs进程流量监控线程 - 回掉函数"""
     global all_process_info_dict
-    if data.contents.pid in all_process_info_dict["watch_pid"]:
+    pid = data.contents.pid
+    # nethogs 判定连接或进程已经结束
+    if action == Action.REMOVE:
+        all_process_info_dict["libnethogs_data"].pop(str(pid), None)
+        all_process_info_dict["libnethogs_history"].remove(pid)
+        return
+
+    if pid in all_process_info_dict["watch_pid"]:
         # 初始化一个新的进程网络监控数据,并替代原来的
         process_net_data = {}
-        process_net_data["pid"] = data.contents.pid
+        process_net_data["pid"] = pid
         process_net_data["uid"] = data.contents.uid
         process_net_data["action"] = Action.MAP.get(action, "Unknown")
         process_net_data["pid_name"] = data.contents.name
@@ -778,27 +773,175 @@ def network_activity_callback(action, data):
         process_net_data["sent_kbs"] = round(data.contents.sent_kbs, 2)
         process_net_data["recv_kbs"] = round(data.contents.recv_kbs, 2)
 
-        all_process_info_dict["libnethogs_data"][str(data.contents.pid)] = process_net_data
+        all_process_info_dict["libnethogs_data"][str(pid)] = process_net_data
+
+        # 记录历史数据,并清除已经退出的进程
+        dead_pids = all_process_info_dict["libnethogs_history"].update(
+            pid, data.contents.record_id, data.contents.sent_bytes, data.contents.recv_bytes,
+            data.contents.sent_kbs, data.contents.recv_kbs)
+        for dead_pid in dead_pids:
+            all_process_info_dict["libnethogs_data"].pop(str(dead_pid), None)
 
 
-def init_nethogs_thread():
-    """nethogs进程流量监控线程 - 初始化"""
+# Create a type for my callback func. The callback func returns void (None), and accepts as
+# params an int and a pointer to a NethogsMonitorRecord instance.
+# The params and return type of the callback function are mandated by nethogsmonitor_loop().
+# See libnethogs.h.
+CALLBACK_FUNC_TYPE = ctypes.CFUNCTYPE(
+    ctypes.c_void_p, ctypes.c_int, ctypes.POINTER(NethogsMonitorRecord)
+)
+
+
+class NethogsService(object):
+    """
+    nethogs进程流量监控服务 - 管理监控线程的启动/停止/重启
+
+    - 不注册任何信号处理函数,退出由宿主程序调用 stop() 完成
+    - 监控线程为守护线程,不会阻塞宿主程序退出
+    - nethogsmonitor_loop 返回 FAILURE 时按指数退避自动重启
+    """
+
+    # 服务状态
+    STOPPED = "stopped"
+    RUNNING = "running"
+    BACKOFF = "backoff"
+    FAILED = "failed"
+
+    def __init__(self, devnames=None, backoff_base=1, backoff_max=60):
+        self.devnames = devnames  # None - 使用默认网卡, [] - 监控所有网卡
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._lib = None
+        self._callback = CALLBACK_FUNC_TYPE(network_activity_callback)  # 保持引用,避免回调被回收
+        self._thread = None
+        self._stop_event = threading.Event()
+        self._lock = threading.Lock()
+        self._status = {
+            "state": self.STOPPED,
+            "devices": [],
+            "start_time": None,  # 本次监控循环启动时间
+            "restart_count": 0,  # 自动重启次数
+            "last_status": None,  # 最近一次监控循环的返回状态
+            "last_error": None,
+            "next_restart_time": None,
+        }
+
+    def start(self):
+        """启动监控线程 (已在运行则直接返回)"""
+        with self._lock:
+            if self.is_running():
+                return False
+            if self._lib is None:
+                self._lib = ctypes.CDLL(LIBRARY_NAME)
+            devnames = self.devnames
+            if devnames is None:
+                devnames = [get_default_net_device()]
+            self._status["devices"] = list(devnames)
+            self._status["restart_count"] = 0
+            self._status["last_error"] = None
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, args=(devnames,), name="nethogs-monitor")
+            self._thread.daemon = True
+            self._thread.start()
+            return True
+
+    def stop(self, timeout=5):
+        """停止监控线程 (返回线程是否已经退出)"""
+        with self._lock:
+            thread = self._thread
+            self._stop_event.set()
+            if thread is None:
+                return True
+            # breakloop 只对已进入的循环有效,线程退出前需要重复调用以避免错过
+            deadline = time() + timeout
+            while thread.is_alive() and time() < deadline:
+                self._lib.nethogsmonitor_breakloop()
+                thread.join(0.1)
+            if thread.is_alive():
+                return False
+            self._thread = None
+            return True
+
+    def restart(self, timeout=5):
+        """重启监控线程"""
+        if not self.stop(timeout):
+            return False
+        return self.start()
+
+    def is_running(self):
+        """监控线程是否存活"""
+        return self._thread is not None and self._thread.is_alive()
+
+    def get_status(self):
+        """获取服务健康状态"""
+        status = dict(self._status)
+        status["alive"] = self.is_running()
+        return status
+
+    def _run(self, devnames):
+        """监控线程 - 运行监控循环,失败时退避重启"""
+        backoff = self.backoff_base
+        while not self._stop_event.is_set():
+            self._status["state"] = self.RUNNING
+            self._status["start_time"] = time()
+            self._status["next_restart_time"] = None
+            try:
+                rc = run_monitor_loop(self._lib, devnames, self._callback)
+            except Exception as e:
+                rc = LoopStatus.FAILURE
+                self._status["last_error"] = repr(e)
+            self._status["last_status"] = LoopStatus.MAP.get(rc, rc)
+
+            if self._stop_event.is_set() or rc == LoopStatus.OK:
+                break
+            if rc != LoopStatus.FAILURE:  # NO_DEVICE 等无法通过重启恢复
+                self._status["state"] = self.FAILED
+                return
+            # 运行足够长时间后失败,视为偶发故障,重置退避时间
+            if time() - self._status["start_time"] > self.backoff_max:
+                backoff = self.backoff_base
+            self._status["state"] = self.BACKOFF
+            self._status["restart_count"] += 1
+            self._status["next_restart_time"] = time() + backoff
+            if self._stop_event.wait(backoff):
+                break
+            backoff = min(backoff * 2, self.backoff_max)
+
+        self._status["state"] = self.STOPPED
+
+
+def init_nethogs_thread(devnames=None):
+    """nethogs进程流量监控线程 - 初始化并启动"""
     global all_process_info_dict
-    # 处理退出信号
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
-    # 调用动态链接库
-    all_process_info_dict["libnethogs"] = ctypes.CDLL(LIBRARY_NAME)
-    # 初始化并创建监控线程
-    monitor_thread = threading.Thread(
-        target=run_monitor_loop, args=(all_process_info_dict["libnethogs"],
-                                       [get_default_net_device()],)
-    )
-    all_process_info_dict["libnethogs_thread"] = monitor_thread
-    monitor_thread.start()
-    monitor_thread.join(0.5)
+    if all_process_info_dict["libnethogs_service"] is None:
+        all_process_info_dict["libnethogs_service"] = NethogsService(devnames)
+    all_process_info_dict["libnethogs_service"].start()
 
-    return
+    return all_process_info_dict["libnethogs_service"]
+
+
+def stop_nethogs_thread(timeout=5):
+    """nethogs进程流量监控线程 - 停止"""
+    global all_process_info_dict
+    if all_process_info_dict["libnethogs_service"] is None:
+        return True
+    return all_process_info_dict["libnethogs_service"].stop(timeout)
+
+
+def restart_nethogs_thread(timeout=5):
+    """nethogs进程流量监控线程 - 重启"""
+    global all_process_info_dict
+    if all_process_info_dict["libnethogs_service"] is None:
+        return init_nethogs_thread() is not None
+    return all_process_info_dict["libnethogs_service"].restart(timeout)
+
+
+def get_nethogs_status():
+    """nethogs进程流量监控线程 - 获取健康状态"""
+    global all_process_info_dict
+    if all_process_info_dict["libnethogs_service"] is None:
+        return {"state": NethogsService.STOPPED, "alive": False}
+    return all_process_info_dict["libnethogs_service"].get_status()
 
 
 def get_process_net_info(pid):
@@ -812,12 +955,18 @@ def get_process_net_info(pid):
             exit(-1)
 
     all_process_info_dict["watch_pid"].add(int(pid))
-    if not all_process_info_dict["libnethogs_thread"]:
+    if all_process_info_dict["libnethogs_service"] is None:
         init_nethogs_thread()
 
     return all_process_info_dict["libnethogs_data"].get(str(pid), {})
 
 
+def get_process_net_history(pid, minutes=5):
+    """获取进程最近N分钟的网络流量统计 (上传/下载速度 min/avg/max 及累计流量,基于nethogs)"""
+    global all_process_info_dict
+    return all_process_info_dict["libnethogs_history"].query(int(pid), minutes)
+
+
 def is_log_exist(path):
     """判断日志文件是否存在 (输入绝对路径)"""
     return os.path.exists(path) and os.path.isfile(path) and os.access(path, os.R_OK)
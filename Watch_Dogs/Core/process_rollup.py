@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# encoding:utf-8
+
+"""
+进程监测核心功能实现 - 按用户/程序汇总
+
+主要包括
+- 订阅采样器的全部进程表(sampler.enable_table), 每次采样后一次遍历同时按 用户/进程名/可执行文件 汇总
+    - 进程数, 线程数, 常驻内存, CPU占用率, 读写速度 (读写数据需要 enable_table(io=True))
+- 汇总的累计值(CPU时间, 读写字节数)按分组保存, 进程退出后分组仍然保留(ROLLUP_GROUP_TTL),
+  分组的速率不会因为pid变化而中断; 两次采样之间启动的进程, 从启动到采样时的消耗全部计入本次增量
+- 两次采样之间启动并退出的进程(如编译器)不会出现在进程表中, 其CPU时间在被回收时计入父进程的 cutime/cstime :
+  父进程 cutime+cstime 的增量减去上一次采样中属于该父进程、之后退出的子进程的全部CPU时间, 计入父进程所在分组
+- 用户和可执行文件按 (pid, starttime, 进程名) 缓存, 每个进程只在第一次出现(或exec后进程名变化)时读取
+  /proc/[pid]/status 和 /proc/[pid]/exe, 之后每次采样不需要额外读取文件
+
+CPU时间按进程自身的 utime+stime 统计, cutime/cstime 只计入上述未被采样到的部分, 避免重复计算.
+限制 : 未被采样到的进程计入父进程所在分组 (如 make 启动的 gcc 计入 make 的进程名分组, 用户分组不受影响);
+父进程先于子进程退出(子进程被 init 回收)时, 子进程最后一次采样之后的消耗无法获取.
+"""
+
+import os
+import threading
+from itertools import izip
+from time import time
+
+from bulk_collect import read_proc_file, OK
+from process_filter import user_name
+from process_monitor import MEM_PAGE_SIZE
+from proc_root import proc_path, use_proc_root
+
+ROLLUP_KEYS = ("user", "comm", "exe")
+# 分组中没有进程后保留的时间(秒)
+ROLLUP_GROUP_TTL = 300
+# 汇总结果的排序字段
+ROLLUP_ORDERS = {"cpu": "cpu_percent", "rss": "rss", "processes": "processes", "threads": "threads",
+                 "read": "read_bytes_per_sec", "write": "write_bytes_per_sec"}
+
+_CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+def read_process_owner(pid):
+    """进程的 (用户名, 可执行文件), 无法读取的为None"""
+    user = exe = None
+    data, code = read_proc_file(proc_path(pid, "status"), 8192)
+    if code == OK:
+        for line in data.splitlines():
+            if line.startswith("Uid:"):
+                user = user_name(int(line.split()[1]))
+                break
+    try:
+        exe = os.readlink(proc_path(pid, "exe"))
+    except OSError:  # 无权限或内核线程
+        pass
+    return user, exe
+
+
+class _Group(object):
+    """一个分组的汇总数据"""
+    __slots__ = ("processes", "threads", "rss", "cpu", "read", "write", "cpu_total", "read_total", "write_total",
+                 "first_seen", "last_seen")
+
+    def __init__(self, now):
+        self.processes = self.threads = self.rss = 0  # 当前值
+        self.cpu = self.read = self.write = 0  # 本次采样的增量
+        self.cpu_total = self.read_total = self.write_total = 0  # 累计值
+        self.first_seen = self.last_seen = now
+
+
+class ProcessRollup(object):
+    """按用户/进程名/可执行文件汇总进程资源占用 (线程安全)"""
+
+    def __init__(self, sampler=None, keys=ROLLUP_KEYS, ttl=ROLLUP_GROUP_TTL, io=False):
+        """
+        :param keys: 汇总方式, ROLLUP_KEYS 的子集 (不需要 user/exe 时不读取 status/exe)
+        :param io: 是否汇总读写速度 (采样器需要读取所有进程的 /proc/[pid]/io)
+        """
+        for key in keys:
+            if key not in ROLLUP_KEYS:
+                raise ValueError("unknown rollup key : {} (available : {})".format(key, ", ".join(ROLLUP_KEYS)))
+        self.sampler = sampler
+        self.keys = tuple(keys)
+        self.ttl = ttl
+        self.io = io
+        self._owners = {}  # pid -> (starttime, 进程名, 用户名, 可执行文件)
+        self._groups = dict((key, {}) for key in self.keys)  # 汇总方式 -> {分组名: _Group}
+        self._seconds = None  # 最近两次采样的时间间隔
+        self._cpu_total = None  # 最近两次采样的系统总cpu时间片
+        self._lock = threading.Condition()
+        self.seq = 0
+
+    def attach(self, sampler=None, ttl=None):
+        """
+        订阅采样器并开启进程表采集
+        :param ttl: 进程表的使用时间(秒), 按需使用时每次查询前调用以延长 (None - 直到 detach)
+        """
+        if sampler is not None:
+            self.sampler = sampler
+        self.sampler.enable_table(io=self.io, owner=self, ttl=ttl)
+        self.sampler.subscribe(self.update)
+
+    def detach(self):
+        """取消订阅并释放进程表"""
+        self.sampler.unsubscribe(self.update)
+        self.sampler.release_table(self)
+
+    def _owner(self, pid, starttime, comm):
+        """进程的 (用户名, 可执行文件), 按 pid+starttime+进程名 缓存"""
+        cached = self._owners.get(pid)
+        if cached is not None and cached[0] == starttime and cached[1] == comm:
+            return cached
+        if "user" in self.keys or "exe" in self.keys:
+            user, exe = read_process_owner(pid)
+        else:
+            user = exe = None
+        return starttime, comm, user, exe
+
+    def update(self, prev, last):
+        """采样回调 - 一次遍历进程表, 更新所有汇总方式的分组"""
+        table = last.table
+        if table is None:  # 进程表已停止采集, 重新开始后需要再等待两次采样才能计算增量
+            with self._lock:
+                self._seconds = self._cpu_total = None
+            return
+        old = prev.table if prev is not None else None
+        now = last.time
+        with self._lock:
+            for groups in self._groups.values():
+                for group in groups.values():
+                    group.processes = group.threads = group.rss = group.cpu = group.read = group.write = 0
+
+            owners = {}
+            old_index = old.index if old is not None else {}
+            reaped = {}  # 父进程pid -> 上一次采样中该进程之后退出的子进程的全部CPU时间片 (已统计过的部分)
+            if old is not None:
+                index, starttimes = table.index, table.starttime
+                for k, (pid, starttime) in enumerate(izip(old.pids, old.starttime)):
+                    i = index.get(pid)
+                    if i is None or starttimes[i] != starttime:
+                        ppid = str(old.ppid[k])
+                        reaped[ppid] = reaped.get(ppid, 0) + old.cpu[k]
+            has_io = table.read is not None and old is not None and old.read is not None
+            group_maps = [(key, self._groups[key]) for key in self.keys]
+            with use_proc_root(self.sampler.proc_root if self.sampler is not None else None):
+                for i, (pid, comm, starttime) in enumerate(izip(table.pids, table.comm, table.starttime)):
+                    owner = owners[pid] = self._owner(pid, starttime, comm)
+                    j = old_index.get(pid)
+                    if j is not None and old.starttime[j] != starttime:
+                        j = None  # pid被复用
+                    cpu = read = write = 0
+                    if old is not None:  # 两次采样之间启动的进程, 增量为全部消耗
+                        children = table.cpu[i] - table.own_cpu[i]  # 已回收子进程的CPU时间片
+                        if j is not None:
+                            cpu = table.own_cpu[i] - old.own_cpu[j]
+                            children -= old.cpu[j] - old.own_cpu[j] + reaped.get(pid, 0)
+                        else:
+                            cpu = table.own_cpu[i]
+                        cpu += max(children, 0)  # 未被采样到的子进程
+                        if has_io and table.read[i] is not None:
+                            if j is not None and old.read[j] is not None:
+                                read, write = table.read[i] - old.read[j], table.write[i] - old.write[j]
+                            elif j is None:
+                                read, write = table.read[i], table.write[i]
+                    for key, groups in group_maps:
+                        name = comm if key == "comm" else owner[2] if key == "user" else owner[3]
+                        if name is None:
+                            name = "<unknown>"
+                        group = groups.get(name)
+                        if group is None:
+                            group = groups[name] = _Group(now)
+                        group.processes += 1
+                        group.threads += table.threads[i]
+                        group.rss += table.rss[i]
+                        group.cpu += cpu
+                        group.read += read
+                        group.write += write
+                        group.last_seen = now
+            self._owners = owners
+
+            for groups in self._groups.values():
+                for name, group in groups.items():
+                    group.cpu_total += group.cpu
+                    group.read_total += group.read
+                    group.write_total += group.write
+                    if now - group.last_seen > self.ttl:
+                        del groups[name]
+            self._seconds = last.time - prev.time if prev is not None else None
+            self._cpu_total = last.cpu[0] - prev.cpu[0] if prev is not None else None
+            self.seq = last.seq
+            self._lock.notify_all()
+
+    def wait_ready(self, timeout=None):
+        """等待第一次计算出增量 (订阅后需要两次包含进程表的采样), 超时返回False"""
+        deadline = None if timeout is None else time() + timeout
+        with self._lock:
+            while self._seconds is None or self._cpu_total is None:
+                remaining = None if deadline is None else deadline - time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._lock.wait(remaining)
+            return True
+
+    def get_groups(self, key="user", n=None, by="cpu"):
+        """
+        汇总结果
+        :param key: 汇总方式 user/comm/exe
+        :param n: 返回数量 (None - 全部)
+        :param by: 排序字段 cpu/rss/processes/threads/read/write
+        :return: [{"name", "processes", "threads", "rss", "cpu_percent", "cpu_seconds",
+                   "read_bytes_per_sec", "write_bytes_per_sec", "read_bytes", "write_bytes", "first_seen", "last_seen"}]
+        """
+        if key not in self._groups:
+            raise ValueError("rollup key is not enabled : {}".format(key))
+        if by not in ROLLUP_ORDERS:
+            raise ValueError("unknown order : {} (available : {})".format(by, ", ".join(sorted(ROLLUP_ORDERS))))
+        with self._lock:
+            seconds, cpu_total = self._seconds, self._cpu_total
+            res = []
+            for name, g in self._groups[key].items():
+                res.append({
+                    "name": name,
+                    "processes": g.processes,
+                    "threads": g.threads,
+                    "rss": g.rss * MEM_PAGE_SIZE * 1024,
+                    "cpu_percent": g.cpu * 100.0 / cpu_total if cpu_total else 0.0,
+                    "cpu_seconds": float(g.cpu_total) / _CLOCK_TICKS,
+                    "read_bytes_per_sec": g.read / seconds if seconds and self.io else None,
+                    "write_bytes_per_sec": g.write / seconds if seconds and self.io else None,
+                    "read_bytes": g.read_total if self.io else None,
+                    "write_bytes": g.write_total if self.io else None,
+                    "first_seen": g.first_seen,
+                    "last_seen": g.last_seen,
+                })
+        field = ROLLUP_ORDERS[by]
+        res.sort(key=lambda item: item[field], reverse=True)
+        return res[:n] if n is not None else res
+
+    def get_status(self):
+        with self._lock:
+            return {"seq": self.seq, "keys": self.keys, "io": self.io, "processes": len(self._owners),
+                    "groups": dict((key, len(groups)) for key, groups in self._groups.items())}
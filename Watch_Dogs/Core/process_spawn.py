@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+# encoding:utf-8
+
+"""
+进程监测核心功能实现 - 进程启动
+
+主要包括
+- 启动任意可执行文件(参数,环境变量,工作目录,资源限制,日志重定向)
+- 新进程通过 setsid 脱离监控进程的会话和进程组(不随监控进程退出)
+- 返回进程号及进程启动时间 (pid + starttime 可以唯一确定进程,避免pid复用)
+- 回收已退出的后台进程 : auto_reap 启动的进程由后台线程在退出后立即回收
+  (pidfd 在进程退出时可读, 放入 epoll 等待; 内核不支持时每 REAP_INTERVAL 秒检查), 没有需要回收的进程时线程退出
+- 启动的进程只由本模块 waitpid (其他模块通过 reap_process 回收), 调用方自行回收(auto_reap=False)的进程
+  返回码在回收后保存, 先被其他调用方(如 process_manage 等待进程退出时)回收也可以通过 reap_process 获取
+
+启动方式
+- posix_spawn : 通过ctypes调用glibc的posix_spawnp (glibc 2.24+ 内部使用 clone(CLONE_VM|CLONE_VFORK),
+                不复制监控进程的页表,监控进程内存越大优势越明显)
+- fork        : subprocess.Popen (fork+exec), 需要在exec之前设置资源限制或glibc不支持时使用
+
+reference   :   http://man7.org/linux/man-pages/man3/posix_spawn.3.html
+reference   :   https://sourceware.org/git/?p=glibc.git;a=blob;f=posix/spawn.h
+"""
+
+import os
+import errno
+import select
+import signal
+import ctypes
+import ctypes.util
+import resource
+import threading
+import subprocess
+from time import sleep
+from collections import OrderedDict
+
+from pidfd import is_pidfd_supported, pidfd_open
+from process_monitor import get_process_start_time
+from proc_root import use_proc_root
+from prcess_exception import NoSuchProcess
+
+# glibc posix_spawn 标志位 (posix/spawn.h)
+POSIX_SPAWN_SETSIGDEF = 0x04
+POSIX_SPAWN_SETSID = 0x80
+
+# posix_spawn_file_actions_t / posix_spawnattr_t / sigset_t 在 x86_64 上分别为 80/336/128 字节,预留足够空间
+_FILE_ACTIONS_SIZE = 256
+_SPAWNATTR_SIZE = 512
+_SIGSET_SIZE = 256
+
+# Python 会忽略 SIGPIPE/SIGXFSZ, 忽略状态会被exec继承, 需要在子进程中恢复为默认处理
+_RESTORE_SIGNALS = [getattr(signal, name) for name in ("SIGPIPE", "SIGXFSZ", "SIGXFZ") if hasattr(signal, name)]
+
+# 不支持pidfd时后台回收线程的检查间隔(秒)
+REAP_INTERVAL = 1
+# 保存返回码的已回收进程数量 (auto_reap=False 启动的进程)
+REAPED_KEEP = 1024
+
+_libc = None
+_launched = {}  # 已启动但尚未回收的进程 pid -> (Popen对象(fork方式)或None, 是否统一回收, pidfd或None)
+_launched_lock = threading.Lock()
+_reaper = None  # 后台回收线程
+_epoll = None  # 后台回收线程等待的 pidfd
+_reaped = OrderedDict()  # 已回收进程(auto_reap=False) pid -> 返回码 (无法获取时为None)
+
+
+def _get_libc():
+    """加载 libc (不支持posix_spawn所需接口时返回None)"""
+    global _libc
+    if _libc is None:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            for name in ("posix_spawnp", "posix_spawnattr_setsigdefault",
+                         "posix_spawn_file_actions_addclosefrom_np", "posix_spawn_file_actions_addchdir_np"):
+                getattr(libc, name)
+            _libc = libc
+        except (OSError, AttributeError):
+            _libc = False
+    return _libc or None
+
+
+def is_posix_spawn_supported():
+    """当前环境是否可以使用 posix_spawn 启动进程 (需要 glibc 2.34+)"""
+    return _get_libc() is not None
+
+
+def _to_bytes(s):
+    """参数转换为 bytes (ctypes c_char_p)"""
+    if isinstance(s, bytes):
+        return s
+    return s.encode("utf-8")
+
+
+def _c_string_array(strings):
+    """以 NULL 结尾的 char* 数组"""
+    arr = (ctypes.c_char_p * (len(strings) + 1))()
+    arr[:-1] = [_to_bytes(s) for s in strings]
+    arr[-1] = None
+    return arr
+
+
+def _open_flags(path, append):
+    """日志文件打开方式"""
+    return os.O_WRONLY | os.O_CREAT | (os.O_APPEND if append else os.O_TRUNC)
+
+
+def _spawn_posix(args, env, cwd, stdout, stderr, append):
+    """通过 glibc posix_spawnp 启动进程"""
+    libc = _get_libc()
+    file_actions = ctypes.create_string_buffer(_FILE_ACTIONS_SIZE)
+    attr = ctypes.create_string_buffer(_SPAWNATTR_SIZE)
+    sigset = ctypes.create_string_buffer(_SIGSET_SIZE)
+
+    libc.posix_spawn_file_actions_init(file_actions)
+    libc.posix_spawnattr_init(attr)
+    try:
+        # 标准输入输出重定向
+        libc.posix_spawn_file_actions_addopen(file_actions, 0, b"/dev/null", os.O_RDONLY, 0)
+        libc.posix_spawn_file_actions_addopen(file_actions, 1, _to_bytes(stdout or os.devnull),
+                                              _open_flags(stdout, append), 0o644)
+        if stderr == subprocess.STDOUT:
+            libc.posix_spawn_file_actions_adddup2(file_actions, 1, 2)
+        else:
+            libc.posix_spawn_file_actions_addopen(file_actions, 2, _to_bytes(stderr or os.devnull),
+                                                  _open_flags(stderr, append), 0o644)
+        # 关闭继承自监控进程的其他文件描述符
+        libc.posix_spawn_file_actions_addclosefrom_np(file_actions, 3)
+        if cwd:
+            libc.posix_spawn_file_actions_addchdir_np(file_actions, _to_bytes(cwd))
+
+        # 新会话 + 恢复信号默认处理
+        libc.sigemptyset(sigset)
+        for sig in _RESTORE_SIGNALS:
+            libc.sigaddset(sigset, sig)
+        libc.posix_spawnattr_setsigdefault(attr, sigset)
+        libc.posix_spawnattr_setflags(attr, ctypes.c_short(POSIX_SPAWN_SETSID | POSIX_SPAWN_SETSIGDEF))
+
+        env = os.environ if env is None else env
+        envp = _c_string_array(["{}={}".format(k, v) for k, v in env.items()])
+        argv = _c_string_array(args)
+        pid = ctypes.c_int(0)
+        # posix_spawn 直接返回错误码,不设置 errno
+        err = libc.posix_spawnp(ctypes.byref(pid), argv[0], file_actions, attr, argv, envp)
+        if err:
+            raise OSError(err, "{}: {}".format(os.strerror(err), args[0]))
+        return pid.value
+    finally:
+        libc.posix_spawn_file_actions_destroy(file_actions)
+        libc.posix_spawnattr_destroy(attr)
+
+
+def _spawn_fork(args, env, cwd, stdout, stderr, append, rlimits):
+    """通过 fork+exec 启动进程 (在exec之前设置资源限制)"""
+
+    def child_setup():
+        """子进程exec之前执行"""
+        os.setsid()
+        for sig in _RESTORE_SIGNALS:
+            signal.signal(sig, signal.SIG_DFL)
+        for res, limit in rlimits.items():
+            resource.setrlimit(res, limit)
+
+    mode = "a" if append else "w"
+    out_f = open(stdout, mode) if stdout else open(os.devnull, "w")
+    err_f = None
+    try:
+        if stderr == subprocess.STDOUT:
+            err_target = subprocess.STDOUT
+        else:
+            err_f = open(stderr, mode) if stderr else open(os.devnull, "w")
+            err_target = err_f
+        with open(os.devnull, "r") as in_f:
+            p = subprocess.Popen(args, env=env, cwd=cwd, stdin=in_f, stdout=out_f, stderr=err_target,
+                                 close_fds=True, preexec_fn=child_setup)
+    finally:
+        out_f.close()
+        if err_f is not None:
+            err_f.close()
+    return p
+
+
+def parse_rlimits(rlimits):
+    """
+    资源限制 {"nofile": (soft, hard)} 或 {resource.RLIMIT_NOFILE: (soft, hard)} -> {RLIMIT_*: (soft, hard)}
+    未知的资源名或格式错误时抛出 ValueError
+    """
+    res = {}
+    for name, limit in (rlimits or {}).items():
+        key = getattr(resource, "RLIMIT_" + name.upper(), None) if isinstance(name, basestring) else name
+        if not isinstance(key, (int, long)):
+            raise ValueError("unknown rlimit : {}".format(name))
+        if isinstance(limit, (int, long)):
+            limit = (limit, limit)
+        try:
+            soft, hard = limit
+            res[key] = (int(soft), int(hard))
+        except (TypeError, ValueError):
+            raise ValueError("invalid rlimit {} : {!r} (expected limit or (soft, hard))".format(name, limit))
+    return res
+
+
+def launch_process(args, env=None, cwd=None, rlimits=None, stdout=None, stderr=subprocess.STDOUT, append=True,
+                   auto_reap=True):
+    """
+    后台启动一个新进程 (setsid脱离监控进程会话,不随监控进程退出)
+
+    :param args: 命令参数列表, 如 ["java", "-jar", "app.jar"]
+    :param env: 环境变量(None - 继承监控进程)
+    :param cwd: 工作目录
+    :param rlimits: 资源限制 {"nofile": (soft, hard), "core": 0}
+    :param stdout: 标准输出日志文件(None - /dev/null)
+    :param stderr: 标准错误日志文件(subprocess.STDOUT - 与标准输出相同, None - /dev/null)
+    :param append: 日志文件追加写入
+    :param auto_reap: 是否由 reap_launched_processes 统一回收(调用方自行通过 reap_process 获取返回码时为False)
+    :return: {"pid": 进程号, "starttime": 进程启动时间, "method": 启动方式}
+    """
+    if isinstance(args, basestring):
+        args = [args]
+    args = list(args)
+    rlimits = parse_rlimits(rlimits)
+
+    reap_launched_processes()
+    if not rlimits and is_posix_spawn_supported():
+        method = "posix_spawn"
+        popen = None
+        pid = _spawn_posix(args, env, cwd, stdout, stderr, append)
+    else:
+        method = "fork"
+        popen = _spawn_fork(args, env, cwd, stdout, stderr, append, rlimits)
+        pid = popen.pid
+
+    _register(pid, popen, auto_reap)
+    try:
+        with use_proc_root("/proc"):  # 子进程在监控进程自身的pid命名空间中
+            starttime = get_process_start_time(pid)
+    except NoSuchProcess:
+        starttime = None
+
+    return {"pid": pid, "starttime": starttime, "method": method}
+
+
+def _returncode(status):
+    """waitpid 状态转换为返回码 (与subprocess一致,被信号终止时为负的信号值)"""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _register(pid, popen, auto_reap):
+    """记录已启动的进程, auto_reap 的进程交给后台回收线程"""
+    global _epoll, _reaper
+    pidfd = None
+    if auto_reap and is_pidfd_supported():
+        try:
+            pidfd = pidfd_open(pid)
+        except OSError:  # 如文件描述符耗尽, 退回到定时检查
+            pidfd = None
+    with _launched_lock:
+        # 保留Popen对象,避免其被回收时由subprocess在后台waitpid
+        _launched[pid] = (popen, auto_reap, pidfd)
+        _reaped.pop(pid, None)  # pid 复用
+        if pidfd is not None:
+            if _epoll is None:
+                _epoll = select.epoll()
+            _epoll.register(pidfd, select.EPOLLIN)
+        if auto_reap and (_reaper is None or not _reaper.is_alive()):
+            _reaper = threading.Thread(target=_reap_loop, name="watch_dogs_reaper")
+            _reaper.daemon = True
+            _reaper.start()
+
+
+def _forget(pid, entry, returncode):
+    """删除已回收进程的记录并关闭其pidfd, 保存返回码 (需持有 _launched_lock)"""
+    del _launched[pid]
+    if not entry[1]:
+        _reaped[pid] = returncode
+        while len(_reaped) > REAPED_KEEP:
+            _reaped.popitem(last=False)
+    if entry[2] is not None:
+        _epoll.unregister(entry[2])
+        os.close(entry[2])
+
+
+def _reap_loop():
+    """后台回收线程 - 等待 auto_reap 进程退出并回收, 没有需要回收的进程时退出"""
+    global _reaper
+    while True:
+        with _launched_lock:
+            if not any(auto_reap for popen, auto_reap, pidfd in _launched.values()):
+                _reaper = None
+                return
+            epoll = _epoll
+        try:
+            if epoll is not None:
+                epoll.poll(REAP_INTERVAL)  # 进程退出时立即返回, 同时兼顾没有pidfd的进程
+            else:
+                sleep(REAP_INTERVAL)
+            reap_launched_processes()
+        except Exception as err:  # 回收失败不能让线程退出
+            print "Error : reaper - {}".format(err)
+            sleep(REAP_INTERVAL)
+
+
+def is_launched_process(pid):
+    """是否为 launch_process 启动且尚未回收的进程 (需要通过 reap_process 回收)"""
+    with _launched_lock:
+        return int(pid) in _launched
+
+
+def reap_process(pid):
+    """
+    回收某一个已启动的进程 (仍在运行返回None,已退出返回返回码, 线程安全)
+    auto_reap=False 启动的进程已被回收后再次调用返回保存的返回码
+    """
+    pid = int(pid)
+    with _launched_lock:  # waitpid(WNOHANG) 不阻塞, 在锁内执行, 同一进程只由一个线程回收并记录返回码
+        entry = _launched.get(pid)
+        if entry is None:
+            return _reaped.get(pid)
+        popen = entry[0]
+        if popen is not None:
+            returncode = popen.poll()
+            if returncode is None:
+                return None
+        else:
+            try:
+                p, status = os.waitpid(pid, os.WNOHANG)
+            except OSError as e:
+                if e.errno != errno.ECHILD:
+                    raise
+                p, status = pid, None  # 已被本模块之外的代码回收,无法获取返回码
+            if not p:
+                return None
+            returncode = _returncode(status) if status is not None else None
+        _forget(pid, entry, returncode)
+        return returncode
+
+
+def reap_launched_processes():
+    """回收所有已经退出的后台进程(auto_reap=True启动的进程),返回 {pid: 返回码}"""
+    with _launched_lock:
+        pids = [pid for pid, (popen, auto_reap, pidfd) in _launched.items() if auto_reap]
+    res = {}
+    for pid in pids:
+        returncode = reap_process(pid)
+        if returncode is not None:
+            res[pid] = returncode
+    return res
@@ -0,0 +1,427 @@
+#!/usr/bin/env python
+# encoding:utf-8
+
+"""
+进程监测核心功能实现 - 进程守护
+
+主要包括
+- 在一个事件循环线程中管理多个子进程(启动,停止,重启)
+- 通过 pidfd + epoll 获知子进程退出(内核不支持pidfd时定时 waitpid)
+- 重启策略 always/on-failure/never, 指数退避重启
+- 短时间内多次崩溃视为崩溃循环(crash loop),停止自动重启
+- 记录每个程序的启动/退出历史
+
+空闲时事件循环阻塞在 epoll 上,受管进程数量与空闲CPU占用无关.
+不注册任何信号处理函数 (不使用SIGCHLD).
+某个程序的处理出错(如启动失败)只影响该程序(记录到历史), 事件循环继续管理其他程序.
+"""
+
+import os
+import errno
+import heapq
+import select
+import signal
+import threading
+from collections import deque
+from time import time
+
+from pidfd import is_pidfd_supported, pidfd_open, pidfd_send_signal
+from process_spawn import launch_process, reap_process, parse_rlimits
+
+# 重启策略
+RESTART_ALWAYS = "always"
+RESTART_ON_FAILURE = "on-failure"
+RESTART_NEVER = "never"
+
+# 程序状态
+STOPPED = "stopped"  # 未启动或被手动停止
+RUNNING = "running"
+STOPPING = "stopping"  # 已发送SIGTERM,等待退出
+BACKOFF = "backoff"  # 等待重启
+EXITED = "exited"  # 已退出且按重启策略不再重启
+CRASH_LOOP = "crash_loop"  # 崩溃循环,停止自动重启
+FATAL = "fatal"  # 无法启动(如可执行文件不存在)
+
+# 默认配置
+DEFAULT_PROGRAM_CONFIG = {
+    "env": None,
+    "cwd": None,
+    "rlimits": None,
+    "stdout": None,
+    "stderr": None,
+    "restart": RESTART_ALWAYS,
+    "backoff_base": 1,  # 首次重启等待时间(秒)
+    "backoff_max": 60,  # 最大重启等待时间(秒)
+    "min_uptime": 10,  # 运行超过该时间(秒)后退出视为正常运行后退出,重置退避时间
+    "crash_loop_count": 5,  # crash_loop_window 秒内退出 crash_loop_count 次视为崩溃循环
+    "crash_loop_window": 60,
+    "stop_timeout": 10,  # 停止时 SIGTERM 后等待多久(秒)发送 SIGKILL
+    "history_size": 100,  # 保留的启动/退出记录数量
+}
+# 不支持pidfd时检查子进程退出的间隔(秒)
+SUPERVISOR_POLL_INTERVAL = 1
+
+
+class ProcessSupervisor(object):
+    """进程守护 (所有进程操作都在事件循环线程中执行,对外接口线程安全)"""
+
+    def __init__(self, poll_interval=SUPERVISOR_POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self.use_pidfd = is_pidfd_supported()
+        self._programs = {}  # name -> program
+        self._fd_map = {}  # pidfd -> name
+        self._timers = []  # 堆 (时间, 序号, name, 动作, token)
+        self._timer_seq = 0
+        self._commands = deque()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._running = False
+        self._epoll = None
+        self._wake_r, self._wake_w = None, None
+
+    # ---------------------------------- 对外接口 ----------------------------------
+
+    def start(self):
+        """启动事件循环线程"""
+        if self._thread is not None and self._thread.is_alive():
+            return False
+        self._epoll = select.epoll()
+        self._wake_r, self._wake_w = os.pipe()
+        self._epoll.register(self._wake_r, select.EPOLLIN)
+        self._running = True
+        self._thread = threading.Thread(target=self._loop, name="process-supervisor")
+        self._thread.daemon = True
+        self._thread.start()
+        return True
+
+    def shutdown(self, stop_programs=True, timeout=30):
+        """停止事件循环 (stop_programs - 同时停止所有受管进程)"""
+        if self._thread is None:
+            return True
+        if stop_programs:
+            for name in list(self._programs):
+                self.stop_program(name)
+            deadline = time() + timeout
+            while time() < deadline and any(p["pid"] for p in self._programs.values()):
+                self._thread.join(0.05)
+        self._submit(("shutdown", None, None))
+        self._thread.join(timeout)
+        alive = self._thread.is_alive()
+        if not alive:
+            self._thread = None
+        return not alive
+
+    def add_program(self, name, command, autostart=True, **config):
+        """添加受管程序 (command 为命令参数列表,其他配置见 DEFAULT_PROGRAM_CONFIG)"""
+        unknown = set(config) - set(DEFAULT_PROGRAM_CONFIG)
+        if unknown:
+            raise ValueError("unknown program config : {}".format(", ".join(sorted(unknown))))
+        if config.get("restart", RESTART_ALWAYS) not in (RESTART_ALWAYS, RESTART_ON_FAILURE, RESTART_NEVER):
+            raise ValueError("unknown restart policy : {}".format(config["restart"]))
+        if name in self._programs:
+            raise ValueError("program already exists : {}".format(name))
+        parse_rlimits(config.get("rlimits"))  # 资源限制格式错误时在添加时抛出 ValueError
+        program_config = dict(DEFAULT_PROGRAM_CONFIG)
+        program_config.update(config)
+        program_config["command"] = list(command)
+        self._submit(("add", name, (program_config, autostart)))
+
+    def remove_program(self, name):
+        """停止并移除受管程序"""
+        self._submit(("remove", name, None))
+
+    def start_program(self, name):
+        """启动程序 (同时清除崩溃循环状态)"""
+        self._submit(("start", name, None))
+
+    def stop_program(self, name):
+        """停止程序 (SIGTERM, 超过 stop_timeout 后 SIGKILL),停止后不再自动重启"""
+        self._submit(("stop", name, None))
+
+    def restart_program(self, name):
+        """重启程序"""
+        self._submit(("restart", name, None))
+
+    def get_status(self, name=None):
+        """获取程序状态 (name为None时返回所有程序)"""
+        with self._lock:
+            if name is not None:
+                return self._program_status(self._programs[name]) if name in self._programs else None
+            return dict((n, self._program_status(p)) for n, p in self._programs.items())
+
+    def get_history(self, name):
+        """获取程序启动/退出历史"""
+        with self._lock:
+            if name not in self._programs:
+                return []
+            return list(self._programs[name]["history"])
+
+    # ---------------------------------- 事件循环 ----------------------------------
+
+    def _submit(self, command):
+        """提交命令到事件循环线程"""
+        self._commands.append(command)
+        if self._wake_w is not None:
+            os.write(self._wake_w, b"x")
+
+    def _loop(self):
+        """事件循环"""
+        last_poll = time()
+        try:
+            while self._running:
+                timeout = self._next_timeout()
+                try:
+                    events = self._epoll.poll(timeout)
+                except IOError as e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+                for fd, event in events:
+                    if fd == self._wake_r:
+                        os.read(self._wake_r, 4096)
+                    elif fd in self._fd_map:
+                        self._guard(self._fd_map[fd], self._on_exit, self._fd_map[fd])
+                while self._commands:
+                    command = self._commands.popleft()
+                    self._guard(command[1], self._handle_command, *command)
+                self._run_timers()
+                # 没有pidfd的子进程(内核不支持或打开失败)定时检查是否退出
+                if time() - last_poll >= self.poll_interval:
+                    last_poll = time()
+                    for name, program in list(self._programs.items()):
+                        if program["pid"] and program["pidfd"] is None:
+                            self._guard(name, self._poll_exit, name)
+        finally:
+            self._epoll.close()
+            os.close(self._wake_r)
+            os.close(self._wake_w)
+            self._wake_r, self._wake_w = None, None
+
+    def _guard(self, name, func, *args):
+        """执行一个程序的处理, 出错时记录到该程序的历史 (不影响事件循环及其他程序)"""
+        try:
+            func(*args)
+        except Exception as err:
+            print "Error : supervisor - {} ({}: {})".format(name, type(err).__name__, err)
+            program = self._programs.get(name)
+            if program is None:
+                return
+            program["history"].append({"event": "error", "time": time(), "error": "{}: {}".format(
+                type(err).__name__, err)})
+            if func == self._on_exit:  # 退出处理出错, 不再监听该进程(避免pidfd反复触发), 标记为 FATAL
+                self._release_pidfd(program)
+                with self._lock:
+                    program["pid"] = None
+                self._set_state(program, FATAL)
+
+    def _poll_exit(self, name):
+        """没有pidfd时检查程序是否退出"""
+        program = self._programs[name]
+        returncode = reap_process(program["pid"])
+        if returncode is not None:
+            program["returncode"] = returncode
+            self._on_exit(name)
+
+    def _release_pidfd(self, program):
+        """取消监听并关闭程序的pidfd"""
+        pidfd = program["pidfd"]
+        if pidfd is None:
+            return
+        program["pidfd"] = None
+        self._fd_map.pop(pidfd, None)
+        try:
+            self._epoll.unregister(pidfd)
+        except (IOError, OSError, ValueError):
+            pass
+        os.close(pidfd)
+
+    def _next_timeout(self):
+        """距离下一个定时任务的时间 (-1 表示无限等待)"""
+        timeout = -1
+        if self._timers:
+            timeout = max(0, self._timers[0][0] - time())
+        if any(p["pid"] and p["pidfd"] is None for p in self._programs.values()):
+            timeout = self.poll_interval if timeout < 0 else min(timeout, self.poll_interval)
+        return timeout
+
+    def _add_timer(self, delay, name, action):
+        """添加定时任务 (程序状态变化后旧的定时任务通过token失效)"""
+        self._timer_seq += 1
+        heapq.heappush(self._timers, (time() + delay, self._timer_seq, name, action,
+                                      self._programs[name]["timer_token"]))
+
+    def _run_timers(self):
+        """执行到期的定时任务"""
+        now = time()
+        while self._timers and self._timers[0][0] <= now:
+            when, seq, name, action, token = heapq.heappop(self._timers)
+            program = self._programs.get(name)
+            if program is None or program["timer_token"] != token:
+                continue
+            if action == "start":
+                self._guard(name, self._spawn, name)
+            elif action == "kill" and program["pid"]:
+                self._guard(name, self._signal, program, signal.SIGKILL)
+
+    def _handle_command(self, command, name, args):
+        """处理命令"""
+        if command == "shutdown":
+            self._running = False
+            return
+        if command == "add":
+            program_config, autostart = args
+            if name in self._programs:
+                return
+            with self._lock:
+                self._programs[name] = self._new_program(name, program_config)
+            if autostart:
+                self._spawn(name)
+            return
+
+        program = self._programs.get(name)
+        if program is None:
+            return
+        program["timer_token"] += 1  # 取消等待中的重启/强制关闭
+        if command == "start":
+            program["recent_exits"].clear()
+            program["failures"] = 0
+            if not program["pid"]:
+                self._spawn(name)
+            elif program["state"] == STOPPING:
+                program["restart_after_stop"] = True
+        elif command in ("stop", "remove", "restart"):
+            program["restart_after_stop"] = command == "restart"
+            program["remove_after_stop"] = command == "remove"
+            if program["pid"]:
+                self._set_state(program, STOPPING)
+                self._signal(program, signal.SIGTERM)
+                self._add_timer(program["config"]["stop_timeout"], name, "kill")
+            elif command == "restart":
+                self._spawn(name)
+            else:
+                self._set_state(program, STOPPED)
+                if command == "remove":
+                    with self._lock:
+                        del self._programs[name]
+
+    @staticmethod
+    def _new_program(name, config):
+        """程序数据结构"""
+        return {
+            "name": name,
+            "config": config,
+            "state": STOPPED,
+            "pid": None,
+            "starttime": None,
+            "pidfd": None,
+            "start_time": None,  # 本次启动时间
+            "returncode": None,
+            "failures": 0,  # 连续失败次数(用于计算退避时间)
+            "restart_count": 0,
+            "next_start_time": None,
+            "restart_after_stop": False,
+            "remove_after_stop": False,
+            "timer_token": 0,
+            "recent_exits": deque(),  # crash_loop_window 内的退出时间
+            "history": deque(maxlen=config["history_size"]),
+        }
+
+    @staticmethod
+    def _program_status(program):
+        """程序状态(对外)"""
+        return dict((k, program[k]) for k in ("name", "state", "pid", "starttime", "start_time", "returncode",
+                                              "restart_count", "next_start_time"))
+
+    def _set_state(self, program, state):
+        with self._lock:
+            program["state"] = state
+
+    def _spawn(self, name):
+        """启动程序"""
+        program = self._programs[name]
+        config = program["config"]
+        try:
+            info = launch_process(config["command"], env=config["env"], cwd=config["cwd"],
+                                  rlimits=config["rlimits"], stdout=config["stdout"], stderr=config["stderr"],
+                                  auto_reap=False)
+        except Exception as e:  # 如可执行文件不存在, 参数错误
+            program["history"].append({"event": "spawn_error", "time": time(), "error": "{}: {}".format(
+                type(e).__name__, e)})
+            self._set_state(program, FATAL)
+            return
+
+        with self._lock:
+            program.update(pid=info["pid"], starttime=info["starttime"], start_time=time(), returncode=None,
+                           state=RUNNING, next_start_time=None)
+        program["history"].append({"event": "start", "time": program["start_time"], "pid": info["pid"]})
+        if self.use_pidfd:
+            try:
+                program["pidfd"] = pidfd_open(info["pid"])
+            except OSError:  # 如文件描述符耗尽,该进程退回到定时检查
+                program["pidfd"] = None
+            if program["pidfd"] is not None:
+                self._fd_map[program["pidfd"]] = name
+                self._epoll.register(program["pidfd"], select.EPOLLIN)
+
+    def _signal(self, program, sig):
+        """向程序发送信号"""
+        try:
+            if program["pidfd"] is not None:
+                pidfd_send_signal(program["pidfd"], sig)
+            else:
+                os.kill(program["pid"], sig)
+        except OSError as e:
+            if e.errno != errno.ESRCH:  # 如无权限, 记录后等待 stop_timeout 后的 SIGKILL / 进程退出
+                program["history"].append({"event": "signal_error", "time": time(), "signal": sig, "error": str(e)})
+
+    def _on_exit(self, name):
+        """程序退出处理"""
+        program = self._programs[name]
+        config = program["config"]
+        self._release_pidfd(program)
+        if program["returncode"] is None:
+            program["returncode"] = reap_process(program["pid"])
+
+        now = time()
+        uptime = now - program["start_time"]
+        program["history"].append({"event": "exit", "time": now, "pid": program["pid"],
+                                   "returncode": program["returncode"], "uptime": uptime})
+        with self._lock:
+            program["pid"] = None
+        program["timer_token"] += 1
+
+        # 手动停止
+        if program["state"] == STOPPING:
+            if program["remove_after_stop"]:
+                with self._lock:
+                    del self._programs[name]
+            elif program["restart_after_stop"]:
+                self._spawn(name)
+            else:
+                self._set_state(program, STOPPED)
+            return
+
+        # 按重启策略判断是否需要重启
+        failed = program["returncode"] != 0
+        if config["restart"] == RESTART_NEVER or (config["restart"] == RESTART_ON_FAILURE and not failed):
+            self._set_state(program, EXITED)
+            return
+
+        # 崩溃循环检测
+        recent_exits = program["recent_exits"]
+        recent_exits.append(now)
+        while recent_exits and now - recent_exits[0] > config["crash_loop_window"]:
+            recent_exits.popleft()
+        if len(recent_exits) >= config["crash_loop_count"]:
+            program["history"].append({"event": "crash_loop", "time": now, "exits": len(recent_exits)})
+            self._set_state(program, CRASH_LOOP)
+            return
+
+        # 指数退避
+        program["failures"] = 1 if uptime >= config["min_uptime"] else program["failures"] + 1
+        delay = min(config["backoff_base"] * 2 ** (program["failures"] - 1), config["backoff_max"])
+        with self._lock:
+            program["state"] = BACKOFF
+            program["restart_count"] += 1
+            program["next_start_time"] = now + delay
+        self._add_timer(delay, name, "start")
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# encoding:utf-8
+
+"""
+进程监测核心功能实现 - 进程排行 (top-N)
+
+主要包括
+- 根据采样器最近两次的全部进程表(sampler.enable_table) 计算进程排行, 不需要逐个进程调用 get_* 接口
+- 排序指标
+    - cpu     : CPU占用率 (%)
+    - rss     : 常驻内存 (字节)
+    - read    : 读速度 (字节/秒, rchar)
+    - write   : 写速度 (字节/秒, wchar)
+    - io      : 读写速度之和
+    - threads : 线程数
+- 组合排序 : {"cpu": 1, "rss": 0.5} 各指标除以所有进程中的最大值(归一化到0~1)后加权求和
+- 部分选择 : 先从等间隔抽样中选出第n大的值作为阈值 (抽样中的值都在全部数据中, 至少有n个进程不小于阈值),
+  只对不小于阈值的进程使用 heapq 选择, 不对全部进程排序; 只对选出的n个进程计算完整数据和进程名
+- 两次采样之间的差值(CPU时间片/读写字节数)按列计算后缓存在进程表中, 同一次采样的多次查询只计算一次
+- TopTracker : 订阅采样器, 每次采样后在采样线程中更新排行并缓存, 查询时直接返回
+
+读写速度需要进程表包含读写数据 (enable_table(io=True), 每个进程多读取 /proc/[pid]/io, 需要root权限)
+"""
+
+import heapq
+import threading
+from itertools import izip
+
+from bulk_collect import bulk_get_pid_name
+from process_monitor import MEM_PAGE_SIZE
+
+TOP_METRICS = ("cpu", "rss", "read", "write", "io", "threads")
+# 默认排行数量
+TOP_N = 20
+
+_IO_METRICS = ("read", "write", "io")
+
+
+def parse_order(by):
+    """
+    排序方式 -> {指标: 权重}
+    :param by: 指标名 "cpu", 组合 "cpu+rss" 或 {"cpu": 1, "rss": 0.5}
+    """
+    if isinstance(by, basestring):
+        weights = dict((name.strip(), 1.0) for name in by.split("+"))
+    else:
+        weights = dict((name, float(weight)) for name, weight in dict(by).items())
+    if not weights:
+        raise ValueError("empty order")
+    for name in weights:
+        if name not in TOP_METRICS:
+            raise ValueError("unknown metric : {} (available : {})".format(name, ", ".join(TOP_METRICS)))
+    return weights
+
+
+def need_io(by):
+    """排序方式是否需要读写数据"""
+    return any(name in _IO_METRICS for name in parse_order(by))
+
+
+def _aligned(prev, last):
+    """last 中每个进程在 prev 中的下标 (不存在或pid被复用为None)"""
+    get = prev.index.get
+    res = map(get, last.pids)
+    starttime = prev.starttime
+    return [j if j is not None and starttime[j] == s else None for j, s in izip(res, last.starttime)]
+
+
+def _delta(prev, last, column):
+    """
+    两次采样某一列的差值 (结果缓存在 last.cache 中)
+    上一次采样时不存在的进程在两次采样之间启动, 差值为当前值; 无权限读取的数据差值为0
+    """
+    cache = last.cache
+    if cache.get("prev") is not prev:  # 只缓存与一个进程表(通常是上一次采样)的差值
+        cache.clear()
+        cache["prev"] = prev
+        cache["aligned"] = _aligned(prev, last)
+    res = cache.get(column)
+    if res is not None:
+        return res
+    aligned = cache["aligned"]
+    before = getattr(prev, column)
+    after = getattr(last, column)
+    if column == "cpu":
+        res = [v - before[j] if j is not None else v for v, j in izip(after, aligned)]
+    else:  # read / write, 可能为None
+        res = [0 if v is None else v - before[j] if j is not None and before[j] is not None else v
+               for v, j in izip(after, aligned)]
+    cache[column] = res
+    return res
+
+
+def metric_column(prev, last, metric):
+    """
+    所有进程某一指标的值 (与 last.pids 顺序一致)
+    cpu 为CPU时间片变化量, read/write/io 为字节数变化量 (与占用率/速度成正比, 用于排序)
+    """
+    if metric == "rss":
+        return last.rss
+    if metric == "threads":
+        return last.threads
+    if metric in _IO_METRICS and (last.read is None or prev.read is None):
+        raise ValueError("process table does not include io data (sampler.enable_table(io=True))")
+    if metric == "io":
+        return [r + w for r, w in izip(_delta(prev, last, "read"), _delta(prev, last, "write"))]
+    return _delta(prev, last, {"cpu": "cpu", "read": "read", "write": "write"}[metric])
+
+
+def nlargest(n, values, keys):
+    """
+    部分选择 - 最大的n个 (值, 键), 从大到小
+    阈值取等间隔抽样(约 sqrt(n*N) 个)中第n大的值, 预计只有约 sqrt(n*N) 个值不小于阈值
+    """
+    size = len(values)
+    if n <= 0:
+        return []
+    stride = int(size / (n * size) ** 0.5) if size > n else 1
+    if stride > 1:
+        sample = values[::stride]
+        if len(sample) > n:
+            threshold = heapq.nlargest(n, sample)[-1]
+            return heapq.nlargest(n, [(v, k) for v, k in izip(values, keys) if v >= threshold])
+    return heapq.nlargest(n, izip(values, keys))
+
+
+def select_top(prev, last, n=TOP_N, by="cpu"):
+    """
+    进程排行 - 返回 [(排序值, pid), ...] (从大到小)
+    :param prev: 上一次采样的进程表 (ProcessTable)
+    :param last: 最近一次采样的进程表
+    """
+    weights = parse_order(by)
+    if len(weights) == 1:
+        return nlargest(n, metric_column(prev, last, list(weights)[0]), last.pids)
+
+    scores = None
+    for metric, weight in sorted(weights.items()):
+        values = metric_column(prev, last, metric)
+        peak = max(values) if values else 0
+        if peak <= 0 or not weight:
+            continue
+        factor = weight / float(peak)
+        if scores is None:
+            scores = [v * factor for v in values]
+        else:
+            scores = [score + v * factor for score, v in izip(scores, values)]
+    if scores is None:
+        scores = [0.0] * len(last)
+    return nlargest(n, scores, last.pids)
+
+
+def process_metrics(prev, last, pid):
+    """单个进程的全部指标 (prev / last 为 Sample)"""
+    old, new = prev.table, last.table
+    i = new.index[pid]
+    j = old.index.get(pid)
+    if j is not None and old.starttime[j] != new.starttime[i]:
+        j = None
+    total = last.cpu[0] - prev.cpu[0]
+    seconds = last.time - prev.time
+    cpu = new.cpu[i] - old.cpu[j] if j is not None else new.cpu[i]
+    res = {
+        "pid": int(pid),
+        "cpu_percent": cpu * 100.0 / total if total > 0 else 0.0,
+        "rss": new.rss[i] * MEM_PAGE_SIZE * 1024,
+        "threads": new.threads[i],
+        "read_bytes_per_sec": None,
+        "write_bytes_per_sec": None,
+    }
+    if new.read is not None and new.read[i] is not None and seconds > 0:
+        has_prev = j is not None and old.read is not None and old.read[j] is not None
+        res["read_bytes_per_sec"] = (new.read[i] - (old.read[j] if has_prev else 0)) / seconds
+        res["write_bytes_per_sec"] = (new.write[i] - (old.write[j] if has_prev else 0)) / seconds
+    return res
+
+
+def top_processes(prev, last, n=TOP_N, by="cpu", with_name=True):
+    """
+    进程排行 (prev / last 为包含进程表的两次采样)
+    :param by: 指标名, "cpu+rss" 或 {指标: 权重}
+    :return: [{"pid", "name", "score", "cpu_percent", "rss", "threads", "read_bytes_per_sec", "write_bytes_per_sec"}]
+    """
+    if prev is None or last is None or prev.table is None or last.table is None:
+        raise ValueError("process table is not sampled yet")
+    selected = select_top(prev.table, last.table, n, by)
+    names = bulk_get_pid_name([pid for score, pid in selected], "comm")["data"] if with_name else {}
+    res = []
+    for score, pid in selected:
+        item = process_metrics(prev, last, pid)
+        item["score"] = score
+        if with_name:
+            item["name"] = names.get(pid)
+        res.append(item)
+    return res
+
+
+class TopTracker(object):
+    """订阅采样器, 每次采样后更新进程排行 (线程安全)"""
+
+    def __init__(self, sampler, n=TOP_N, by="cpu", with_name=True):
+        self.sampler = sampler
+        self.n = n
+        self.by = by
+        self.with_name = with_name
+        parse_order(by)  # 检查排序方式
+        self._top = None
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def attach(self):
+        """订阅采样器并开启进程表采集"""
+        self.sampler.enable_table(io=need_io(self.by), owner=self)
+        self.sampler.subscribe(self.update)
+
+    def detach(self):
+        """取消订阅并释放进程表 (其他使用者仍需要时继续采集)"""
+        self.sampler.unsubscribe(self.update)
+        self.sampler.release_table(self)
+
+    def update(self, prev, last):
+        """采样回调"""
+        if prev is None or prev.table is None or last.table is None:
+            return
+        top = top_processes(prev, last, self.n, self.by, self.with_name)
+        with self._lock:
+            self._top = top
+            self._seq = last.seq
+
+    def get_top(self):
+        """最近一次排行 (采样序号, 排行), 还没有结果时排行为None"""
+        with self._lock:
+            return self._seq, self._top
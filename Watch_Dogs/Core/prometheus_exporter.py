@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# encoding:utf-8
+
+"""
+进程监测核心功能实现 - Prometheus 数据导出
+
+主要包括
+- 订阅后台采样器(sampler), 每次采样后将数据生成 Prometheus 文本格式, 保存在缓存中
+- /metrics 请求直接返回缓存内容, 不论有多少个 Prometheus 实例抓取, 每次采样只生成一次
+- 支持 Prometheus 文本格式(0.0.4) 和 OpenMetrics 格式 (按 Accept 请求头选择), 支持 gzip 压缩
+- 进程指标的标签可以配置 (pid / name), 并限制导出的进程数量, 控制序列数量(cardinality)
+    - ("pid", "name") : 每个进程一组序列
+    - ("name",)       : 同名进程合并(求和)为一组序列, 进程重启不会产生新序列
+    - ()              : 不导出进程指标
+- 进程计数器(CPU时间/读写字节)按标签分组单调累加 (与 process_rollup 的 cpu_total 相同):
+  累加每个进程两次采样间的增量, 成员进程退出或因数量限制不再导出时不会减少 (Prometheus 不会误判为计数器重置);
+  新分组的初始值为其进程的当前值, 加入已有分组的进程从加入时开始累加
+
+导出的进程为采样器关注的进程 (sampler.watch_process)
+同时导出监测程序自身的CPU/内存占用及各采集函数的调用次数/错误次数/耗时 (见 self_monitor)
+
+reference   :   https://prometheus.io/docs/instrumenting/exposition_formats/
+reference   :   https://github.com/OpenObservability/OpenMetrics/blob/main/specification/OpenMetrics.md
+"""
+
+import os
+import gzip
+import threading
+from StringIO import StringIO
+
+from bulk_collect import bulk_get_pid_name
+from metrics_store import sample_values
+from process_monitor import MEM_PAGE_SIZE
+from self_monitor import collect_stats, read_agent_usage
+
+# 指标名前缀
+PROMETHEUS_PREFIX = "watchdogs_"
+# 进程指标的标签
+PROMETHEUS_PROCESS_LABELS = ("pid", "name")
+# 导出的进程(分组)数量上限 (按CPU占用率从高到低)
+PROMETHEUS_MAX_PROCESSES = 200
+# 没有成员进程的分组保留累加值的时间(秒), 期间重新出现时计数器继续累加
+PROMETHEUS_GROUP_TTL = 600
+
+CONTENT_TYPE_TEXT = "text/plain; version=0.0.4; charset=utf-8"
+CONTENT_TYPE_OPENMETRICS = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+_CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+_PROCESS_LABELS = ("pid", "name")
+
+
+def escape_label(value):
+    """标签值转义 (反斜杠, 双引号, 换行)"""
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_labels(labels):
+    """标签 ((名, 值), ...) -> {名="值",...}"""
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, escape_label(v)) for k, v in labels) + "}"
+
+
+class PrometheusExporter(object):
+    """Prometheus 数据导出 (线程安全)"""
+
+    def __init__(self, sampler=None, process_labels=PROMETHEUS_PROCESS_LABELS, max_processes=PROMETHEUS_MAX_PROCESSES,
+                 prefix=PROMETHEUS_PREFIX):
+        """
+        :param process_labels: 进程指标的标签, pid/name 的子集
+        :param max_processes: 导出的进程(分组)数量上限 (None - 不限制)
+        """
+        for label in process_labels:
+            if label not in _PROCESS_LABELS:
+                raise ValueError("unknown process label : {}".format(label))
+        self.sampler = sampler
+        self.process_labels = tuple(process_labels)
+        self.max_processes = max_processes
+        self.prefix = prefix
+        self._names = {}  # pid -> (starttime, 进程名)
+        self._members = {}  # pid -> (starttime, 标签, cpu时间(秒), 读字节, 写字节) 上一次采样的值
+        self._totals = {}  # 标签 -> [cpu时间(秒), 读字节, 写字节, 最后有成员的时间] 单调累加的计数器
+        self._families = None  # 最近一次采样生成的指标 [(名称, 类型, 说明, [(标签, 数值), ...]), ...]
+        self._cache = {}  # (是否OpenMetrics, 是否gzip) -> 生成的内容
+        self._lock = threading.Lock()
+        self.seq = 0  # 最近一次生成使用的采样序号
+        self.renders = 0  # 生成次数
+        self.scrapes = 0  # 请求次数
+
+    def attach(self, sampler=None):
+        """订阅采样器 (采样器需要另外启动)"""
+        if sampler is not None:
+            self.sampler = sampler
+        self.sampler.subscribe(self.update)
+
+    def detach(self):
+        """取消订阅采样器"""
+        self.sampler.unsubscribe(self.update)
+
+    def _process_names(self, last):
+        """进程名 (按 pid+starttime 缓存, 只读取新进程的)"""
+        names = {}
+        missing = []
+        for pid, data in last.process.items():
+            cached = self._names.get(pid)
+            if cached is not None and cached[0] == data[0]:
+                names[pid] = cached
+            else:
+                missing.append(pid)
+        if missing:
+            res = bulk_get_pid_name(missing, "comm")["data"]
+            for pid, name in res.items():
+                names[pid] = (last.process[pid][0], name)
+        self._names = names
+        return dict((pid, name) for pid, (starttime, name) in names.items())
+
+    def _collect(self, prev, last):
+        """根据两次采样生成指标"""
+        p = self.prefix
+        values = sample_values(prev, last)
+        families = []
+
+        def family(name, typ, doc, samples):
+            if samples:
+                families.append((p + name, typ, doc, samples))
+
+        family("cpu_percent", "gauge", "CPU usage percent",
+               [((), values["sys.cpu_percent"])] if "sys.cpu_percent" in values else [])
+        cores = []
+        for core in sorted(last.cores):
+            if core in prev.cores and last.cores[core][0] > prev.cores[core][0]:
+                before, after = prev.cores[core], last.cores[core]
+                cores.append(((("core", core),), (after[1] - before[1]) * 100.0 / (after[0] - before[0])))
+        family("cpu_core_percent", "gauge", "CPU usage percent by core", cores)
+        family("memory_percent", "gauge", "Memory usage percent", [((), values["sys.mem_percent"])])
+        family("memory_available_bytes", "gauge", "Available memory in bytes",
+               [((), values["sys.mem_available"] * 1024)])
+        devices = sorted(last.net)
+        family("network_receive_bytes_total", "counter", "Network bytes received",
+               [((("device", d),), last.net[d][0]) for d in devices])
+        family("network_transmit_bytes_total", "counter", "Network bytes transmitted",
+               [((("device", d),), last.net[d][1]) for d in devices])
+
+        if self.process_labels:
+            self._collect_process(last, values, family)
+        self._collect_self(family)
+        family("sampler_seq", "gauge", "Sampler sequence number", [((), last.seq)])
+        family("sampler_timestamp_seconds", "gauge", "Time of the last sample", [((), last.time)])
+        return families
+
+    def _collect_process(self, last, values, family):
+        """进程指标 (按配置的标签分组, 计数器单调累加, 限制导出的分组数量)"""
+        names = self._process_names(last) if "name" in self.process_labels else {}
+        members = {}
+        created = set()  # 本次新建的分组, 其所有进程都计入初始值
+        groups = {}  # 标签 -> [cpu占用率, rss]
+        for pid, (starttime, cpu_time, io, rss) in last.process.items():
+            labels = []
+            if "pid" in self.process_labels:
+                labels.append(("pid", pid))
+            if "name" in self.process_labels:
+                labels.append(("name", names.get(pid, "")))
+            labels = tuple(labels)
+            seconds = float(cpu_time) / _CLOCK_TICKS
+            read, write = io if io is not None else (None, None)
+
+            total = self._totals.get(labels)
+            old = self._members.get(pid)
+            if total is None or labels in created:
+                if total is None:
+                    total = self._totals[labels] = [0.0, 0, 0, last.time]
+                    created.add(labels)
+                total[0] += seconds
+                total[1] += read or 0
+                total[2] += write or 0
+            elif old is not None and old[0] == starttime and old[1] == labels:  # 同一进程, 累加增量
+                total[0] += max(seconds - old[2], 0)
+                if read is not None and old[3] is not None:
+                    total[1] += max(read - old[3], 0)
+                    total[2] += max(write - old[4], 0)
+            total[3] = last.time
+            members[pid] = (starttime, labels, seconds, read, write)
+
+            group = groups.setdefault(labels, [0.0, 0])
+            group[0] += values.get("process.{}.cpu_percent".format(pid), 0.0)
+            group[1] += rss * MEM_PAGE_SIZE * 1024
+        self._members = members
+        for labels, total in self._totals.items():
+            if labels not in groups and last.time - total[3] > PROMETHEUS_GROUP_TTL:
+                del self._totals[labels]
+
+        exported = list(groups)
+        if self.max_processes is not None and len(exported) > self.max_processes:
+            exported = sorted(exported, key=lambda labels: -groups[labels][0])[:self.max_processes]
+        exported.sort()
+        family("process_cpu_percent", "gauge", "Process CPU usage percent", [(k, groups[k][0]) for k in exported])
+        family("process_resident_memory_bytes", "gauge", "Process resident memory in bytes",
+               [(k, groups[k][1]) for k in exported])
+        family("process_cpu_seconds_total", "counter", "Process CPU time (including children) in seconds",
+               [(k, self._totals[k][0]) for k in exported])
+        family("process_read_bytes_total", "counter", "Process bytes read (rchar)",
+               [(k, self._totals[k][1]) for k in exported])
+        family("process_written_bytes_total", "counter", "Process bytes written (wchar)",
+               [(k, self._totals[k][2]) for k in exported])
+
+    @staticmethod
+    def _collect_self(family):
+        """监测程序自身的指标"""
+        usage = read_agent_usage()
+        family("agent_cpu_seconds_total", "counter", "Agent CPU time in seconds",
+               [((("mode", "user"),), usage["cpu_user"]), ((("mode", "system"),), usage["cpu_system"])])
+        family("agent_resident_memory_bytes", "gauge", "Agent resident memory in bytes",
+               [((), usage["rss"])] if usage["rss"] is not None else [])
+        family("agent_threads", "gauge", "Agent thread count", [((), usage["threads"])])
+        stats = sorted(collect_stats().items())
+        family("collector_calls_total", "counter", "Collector function calls",
+               [((("function", name),), s.calls) for name, s in stats])
+        family("collector_errors_total", "counter", "Collector function errors",
+               [((("function", name),), sum(s.errors.values())) for name, s in stats])
+        family("collector_duration_seconds_total", "counter", "Collector function time in seconds",
+               [((("function", name),), s.total) for name, s in stats])
+
+    def update(self, prev, last):
+        """采样回调 - 重新生成指标及文本格式内容, 清空缓存"""
+        if prev is None:
+            return
+        families = self._collect(prev, last)
+        body = self._render(families)
+        with self._lock:
+            self._families = families
+            self._cache = {(False, False): body}
+            self.seq = last.seq
+            self.renders += 1
+
+    @staticmethod
+    def _render(families, openmetrics=False):
+        """生成文本"""
+        lines = []
+        for name, typ, doc, samples in families:
+            # OpenMetrics 中计数器的指标族名称不包含 _total 后缀
+            base = name[:-6] if openmetrics and typ == "counter" and name.endswith("_total") else name
+            lines.append("# HELP {} {}".format(base, doc))
+            lines.append("# TYPE {} {}".format(base, typ))
+            for labels, value in samples:
+                lines.append("{}{} {}".format(name, format_labels(labels), repr(float(value))))
+        if openmetrics:
+            lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def get_metrics(self, accept="", accept_encoding=""):
+        """
+        获取导出内容 (每次采样后每种格式只生成一次)
+        :param accept: HTTP Accept 请求头
+        :param accept_encoding: HTTP Accept-Encoding 请求头
+        :return: (内容, Content-Type, Content-Encoding 或 None)
+        """
+        openmetrics = "application/openmetrics-text" in (accept or "")
+        compress = "gzip" in (accept_encoding or "")
+        key = (openmetrics, compress)
+        with self._lock:
+            self.scrapes += 1
+            body = self._cache.get(key)
+            if body is None:
+                body = self._cache.get((openmetrics, False))
+                if body is None:
+                    body = self._cache[(openmetrics, False)] = self._render(self._families or [], openmetrics)
+                if compress:
+                    buf = StringIO()
+                    with gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=6, mtime=0) as f:
+                        f.write(body)
+                    body = self._cache[key] = buf.getvalue()
+        content_type = CONTENT_TYPE_OPENMETRICS if openmetrics else CONTENT_TYPE_TEXT
+        return body, content_type, "gzip" if compress else None
+
+    def get_status(self):
+        """导出状态"""
+        with self._lock:
+            return {"seq": self.seq, "renders": self.renders, "scrapes": self.scrapes,
+                    "families": len(self._families or []), "process_labels": self.process_labels}
@@ -0,0 +1,810 @@
+#!/usr/bin/env python
+# encoding:utf-8
+
+"""
+进程监测核心功能实现 - RPC服务
+
+主要包括
+- 通过 XML-RPC 对外提供 sys_monitor / process_monitor / process_manage 的接口(多线程处理请求)
+- multicall : 一次请求执行多个查询,共享同一份进程快照,所有结果一次返回
+- 相同请求合并(single-flight) : 同时发生的相同调用只执行一次,结果按方法在短时间内复用,
+  多个客户端同时查询时不会重复读取 /proc
+
+multicall 调用格式 (与 system.multicall 一致)
+    multicall([{"methodName": "get_process_mem", "params": [1234]}, ...])
+    -> [[结果], {"faultCode": 错误码, "faultString": 错误信息}, ...]
+
+访问控制 : 默认只监听 127.0.0.1, 并只接受本机客户端
+    - WATCH_DOGS_RPC_HOST : 监听地址 (如 0.0.0.0, 需要同时配置令牌或客户端白名单)
+    - WATCH_DOGS_RPC_TOKEN : 共享令牌, 客户端通过 HTTP Basic 密码 (http://watch_dogs:令牌@host:7080/),
+      "Authorization: Bearer 令牌" 或 "X-Watch-Dogs-Token: 令牌" 传递
+    - WATCH_DOGS_RPC_ALLOW : 允许的客户端地址, 逗号分隔
+    - 进程管理接口(启动/重启/结束进程)默认不注册, WATCH_DOGS_RPC_MANAGE=1 或 run_agent(manage=True) 开启
+    - 读取文件/目录的接口(get_log_* / is_log_exist / get_path_*) 及 log 告警规则只能访问
+      WATCH_DOGS_RPC_PATHS 中的目录 (逗号分隔, 如 /var/log,/data/app), 默认不允许访问任何路径
+      (服务以root运行, 否则本机任意用户都可以读取 /etc/shadow 等文件)
+    - calc_* 接口的 interval 参数限制在 RPC_CALC_INTERVAL 范围内 (第一次调用时在锁内等待)
+
+快照 : 一次 multicall 中所有按pid查询的 stat/cmdline/io 数据通过 bulk_collect 各批量读取一次,
+      相同的调用(方法名+参数)只执行一次.
+
+历史数据 : 启动时指定存储目录后, 后台采样器的数据写入 metrics_store,
+          通过 query_metrics / summarize_metrics / top_metrics 查询 (见 metrics_query)
+
+二进制快照 : get_snapshot_frame(last_seq) 返回 snapshot_codec 编码的进程表,
+           接收方按顺序调用时只返回相对上一帧的增量帧.
+
+Prometheus : GET /metrics 返回 prometheus_exporter 每次采样后生成的内容 (见 prometheus_exporter)
+
+告警 : add_alert_rule / remove_alert_rule 管理告警规则(见 alert_engine), 每次采样后计算,
+      通过 get_alerts / get_alert_history 查询当前告警及告警事件.
+
+采集调度 : 启动时运行 collect_scheduler 默认采集项(各自的间隔, CPU时间预算), 通过 get_collected 获取最近一次结果
+          cpu / cpu_cores / net 取自采样器, CPU时间预算只包括调度线程执行的其他采集项
+
+进程过滤 : filter_processes("user=app and rss > 2G and cmdline ~ /java/") 编译过滤表达式, 只读取用到的字段 (见 process_filter)
+
+进程排行 : top_processes(n, by) 第一次调用时开启采样器的全部进程表采集, 之后每次根据最近两次采样计算 (见 process_top)
+          top_processes / get_rollup / get_cgroups 最后一次调用 SAMPLER_TABLE_TTL 秒后停止采集进程表
+
+汇总 : get_rollup(key, n, by) 按用户/进程名/可执行文件汇总, 第一次调用时开始订阅采样器 (见 process_rollup)
+
+容器 : get_cgroups(n, by, containers_only) / get_cgroup(路径或容器id) 按 cgroup v2 统计CPU/内存/读写/压力/限流,
+      第一次调用时开始订阅采样器 (见 cgroup_monitor)
+
+内存明细 : get_process_memory_detail(pid) 返回 rss/pss/uss/swap (smaps_rollup, 按 pid+starttime 缓存, 见 process_memory)
+
+自身监测 : get_self_stats 返回各采集函数及RPC接口的调用次数/耗时直方图/错误数/读取字节数,
+          以及RPC服务自身的CPU和内存占用 (见 self_monitor)
+
+reference   :   https://docs.python.org/2/library/simplexmlrpcserver.html
+"""
+
+import os
+import sys
+import hmac
+import base64
+import threading
+import xmlrpclib
+from time import time
+from SocketServer import ThreadingMixIn
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+
+import sys_monitor
+import process_monitor
+import process_manage
+import process_memory
+from bulk_collect import bulk_get_process_stat, bulk_get_process_info, bulk_get_process_io, \
+    NO_SUCH_PROCESS, ACCESS_DENIED
+from single_flight import SingleFlight, make_key
+from snapshot_codec import SnapshotEncoder, collect_snapshot
+from sampler import sampler, SAMPLER_TABLE_TTL
+from metrics_store import MetricsStore, MetricsRecorder, METRICS_STORE_PATH
+import metrics_query
+from alert_engine import AlertEngine
+from collect_scheduler import create_scheduler
+import process_top
+from process_filter import filter_processes, FilterSyntaxError
+from process_rollup import ProcessRollup
+from cgroup_monitor import CgroupMonitor
+from proc_root import get_proc_root, get_sys_root
+from prometheus_exporter import PrometheusExporter
+from self_monitor import record, get_self_stats, get_agent_usage
+from prcess_exception import ProcessException, NoSuchProcess, AccessDenied
+
+RPC_AGENT_HOST = os.environ.get("WATCH_DOGS_RPC_HOST", "127.0.0.1")
+RPC_AGENT_PORT = 7080
+# 共享令牌 (None - 不检查令牌)
+RPC_AGENT_TOKEN = os.environ.get("WATCH_DOGS_RPC_TOKEN") or None
+# 允许的客户端地址 (空 - 不检查地址; 令牌和白名单都没有配置时只接受本机客户端)
+RPC_AGENT_ALLOW = tuple(addr.strip() for addr in os.environ.get("WATCH_DOGS_RPC_ALLOW", "").split(",")
+                        if addr.strip())
+# 是否注册进程管理接口 (启动/重启/结束进程)
+RPC_AGENT_MANAGE = os.environ.get("WATCH_DOGS_RPC_MANAGE", "0") == "1"
+# 允许读取的目录 (空 - 不允许读取任何文件/目录)
+RPC_AGENT_PATHS = tuple(path.strip() for path in os.environ.get("WATCH_DOGS_RPC_PATHS", "").split(",")
+                        if path.strip())
+# calc_* 接口的 interval 参数范围(秒)
+RPC_CALC_INTERVAL = (0.5, 5)
+
+_LOOPBACK = ("127.0.0.1", "::1", "::ffff:127.0.0.1")
+
+# 对外提供的接口
+RPC_METHODS = {}
+for _module, _names in (
+        (sys_monitor, (
+                "get_total_cpu_time", "calc_cpu_percent", "get_cpu_total_time_by_cores", "calc_cpu_percent_by_cores",
+                "get_mem_info", "calc_mem_percent", "get_all_net_device", "get_default_net_device",
+                "get_net_dev_data", "calc_net_speed", "get_cpu_info", "get_sys_info", "get_sys_total_mem",
+                "get_sys_loadavg", "get_sys_uptime", "get_disk_stat")),
+        (process_monitor, (
+                "get_all_pid", "get_process_info", "get_process_cpu_time", "get_process_start_time",
+                "calc_process_cpu_percent", "get_path_total_size", "get_path_avail_size", "get_process_mem",
+                "get_process_io", "calc_process_cpu_io", "get_process_net_info", "get_process_net_history",
+                "get_nethogs_status", "is_log_exist", "get_log_head", "get_log_tail", "get_log_last_update_time",
+                "get_log_keyword_lines")),
+        (process_manage, (
+                "get_all_pid_name", "search_pid_by_keyword", "get_process_tree", "get_process_parent_pid",
+                "get_process_group_id", "get_same_group_process", "get_all_child_process",
+                "get_process_execute_path")),
+        (process_memory, (
+                "get_process_memory_detail",))):
+    for _name in _names:
+        RPC_METHODS[_name] = getattr(_module, _name)
+
+# 进程管理接口 (有副作用, 需要开启 RPC_AGENT_MANAGE 才注册)
+MANAGE_METHODS = dict((_name, getattr(process_manage, _name)) for _name in (
+    "kill_process", "kill_all_process", "terminate_process_tree", "start_process", "restart_process",
+    "batch_restart_process"))
+
+# 结果复用时间(秒), 不在其中的方法只合并同时发生的调用
+RPC_RESULT_FRESHNESS = {
+    # 系统
+    "get_total_cpu_time": 0.5,
+    "calc_cpu_percent": 1,
+    "get_cpu_total_time_by_cores": 0.5,
+    "calc_cpu_percent_by_cores": 1,
+    "get_mem_info": 1,
+    "calc_mem_percent": 1,
+    "get_all_net_device": 10,
+    "get_default_net_device": 10,
+    "get_net_dev_data": 0.5,
+    "calc_net_speed": 1,
+    "get_cpu_info": 60,
+    "get_sys_info": 60,
+    "get_sys_total_mem": 60,
+    "get_sys_loadavg": 1,
+    "get_sys_uptime": 1,
+    "get_disk_stat": 5,
+    # 进程
+    "get_all_pid": 0.5,
+    "get_process_info": 1,
+    "get_process_cpu_time": 0.5,
+    "get_process_start_time": 1,
+    "calc_process_cpu_percent": 1,
+    "get_path_total_size": 10,
+    "get_path_avail_size": 5,
+    "get_process_mem": 1,
+    "get_process_memory_detail": 1,
+    "get_process_io": 0.5,
+    "calc_process_cpu_io": 1,
+    "get_process_net_info": 1,
+    "get_process_net_history": 1,
+    "get_nethogs_status": 1,
+    "is_log_exist": 1,
+    "get_log_head": 1,
+    "get_log_tail": 1,
+    "get_log_last_update_time": 1,
+    "get_log_keyword_lines": 2,
+    "get_all_pid_name": 1,
+    "search_pid_by_keyword": 1,
+    "get_process_tree": 0.5,
+    "get_process_parent_pid": 1,
+    "get_process_group_id": 1,
+    "get_same_group_process": 1,
+    "get_all_child_process": 1,
+    "get_process_execute_path": 1,
+}
+
+# 有副作用的进程管理接口, 每次调用都需要实际执行(不合并,不复用)
+SIDE_EFFECT_METHODS = ("kill_process", "kill_all_process", "terminate_process_tree", "start_process",
+                       "restart_process", "batch_restart_process")
+
+# 第一个参数为文件/目录路径的方法, 只能访问允许的目录
+PATH_METHODS = ("get_path_total_size", "get_path_avail_size", "is_log_exist", "get_log_head", "get_log_tail",
+                "get_log_last_update_time", "get_log_keyword_lines")
+
+# calc_* 方法 -> interval 参数的位置
+INTERVAL_PARAMS = {"calc_cpu_percent": 0, "calc_cpu_percent_by_cores": 0, "calc_net_speed": 1,
+                   "calc_process_cpu_percent": 1, "calc_process_cpu_io": 1}
+
+# calc_* 使用模块全局变量保存上一次的数据,同一方法的调用需要串行执行
+STATEFUL_METHODS = ("calc_cpu_percent", "calc_cpu_percent_by_cores", "calc_net_speed", "calc_process_cpu_percent",
+                    "calc_process_cpu_io")
+
+# 二进制快照的最短采集间隔(秒)
+SNAPSHOT_FRAME_INTERVAL = 1
+
+# XML-RPC 错误码
+FAULT_NO_SUCH_PROCESS = 1
+FAULT_ACCESS_DENIED = 2
+FAULT_PROCESS_ERROR = 3
+FAULT_METHOD_NOT_FOUND = 4
+FAULT_INVALID_CALL = 5
+FAULT_INTERNAL_ERROR = 6
+FAULT_NO_METRICS_STORE = 7
+
+# XML-RPC 整数为32位有符号整数
+_MAX_INT = 2 ** 31 - 1
+_MIN_INT = -2 ** 31
+
+
+def to_rpc_value(value):
+    """将结果转换为 XML-RPC 可以传输的类型 (字典键转为字符串,超出32位的整数转为浮点数,集合/元组转为列表)"""
+    if isinstance(value, dict):
+        return dict((str(k), to_rpc_value(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return [to_rpc_value(v) for v in value]
+    if isinstance(value, (int, long)) and not isinstance(value, bool):
+        if value > _MAX_INT or value < _MIN_INT:
+            return float(value)
+        return int(value)
+    return value
+
+
+def to_fault(err):
+    """异常转换为 XML-RPC Fault"""
+    if isinstance(err, xmlrpclib.Fault):
+        return err
+    if isinstance(err, NoSuchProcess):
+        return xmlrpclib.Fault(FAULT_NO_SUCH_PROCESS, err.msg)
+    if isinstance(err, AccessDenied):
+        return xmlrpclib.Fault(FAULT_ACCESS_DENIED, err.msg)
+    if isinstance(err, ProcessException):
+        return xmlrpclib.Fault(FAULT_PROCESS_ERROR, err.msg)
+    return xmlrpclib.Fault(FAULT_INTERNAL_ERROR, "{}: {}".format(type(err).__name__, err))
+
+
+def is_allowed_path(path, prefixes):
+    """路径(解析符号链接后)是否在允许的目录中"""
+    if not isinstance(path, basestring) or not path:
+        return False
+    path = os.path.realpath(path)
+    for prefix in prefixes:
+        prefix = os.path.realpath(prefix)
+        if path == prefix or path.startswith(prefix.rstrip("/") + "/"):
+            return True
+    return False
+
+
+def clamp_interval(name, params):
+    """将 calc_* 方法的 interval 参数限制在 RPC_CALC_INTERVAL 范围内, 返回新的参数"""
+    index = INTERVAL_PARAMS.get(name)
+    if index is None or len(params) <= index:
+        return params
+    interval = params[index]
+    if isinstance(interval, bool) or not isinstance(interval, (int, long, float)):
+        raise xmlrpclib.Fault(FAULT_INVALID_CALL, "interval must be a number : {!r}".format(interval))
+    low, high = RPC_CALC_INTERVAL
+    return params[:index] + (min(max(interval, low), high),) + params[index + 1:]
+
+
+def _cpu_time_from_stat(stat):
+    """进程cpu时间片 (与 get_process_cpu_time 一致)"""
+    return stat["utime"] + stat["stime"] + stat["cutime"] + stat["cstime"]
+
+
+def _mem_from_stat(stat, style="M"):
+    """进程占用内存 (与 get_process_mem 一致)"""
+    kb = stat["rss"] * process_monitor.MEM_PAGE_SIZE
+    if style == "M":
+        return round(kb / 1024., 2)
+    elif style == "G":
+        return round(kb / 1024. ** 2, 2)
+    return kb
+
+
+# 可以从快照中获取结果的按pid查询方法 : 方法名 -> (快照数据表, 取值函数(数据, *其余参数))
+SNAPSHOT_METHODS = {
+    "get_process_info": ("info", lambda info: info),
+    "get_process_cpu_time": ("stat", _cpu_time_from_stat),
+    "get_process_start_time": ("stat", lambda stat: stat["starttime"]),
+    "get_process_parent_pid": ("stat", lambda stat: stat["ppid"]),
+    "get_process_group_id": ("stat", lambda stat: stat["pgrp"]),
+    "get_process_mem": ("stat", _mem_from_stat),
+    "get_process_io": ("io", lambda io: io),
+}
+
+# 需要所有进程stat数据的方法
+SNAPSHOT_ALL_STAT_METHODS = ("get_all_pid", "get_all_child_process", "get_same_group_process")
+
+_SNAPSHOT_COLLECTORS = {
+    "stat": bulk_get_process_stat,
+    "info": bulk_get_process_info,
+    "io": bulk_get_process_io,
+}
+
+
+class Snapshot(object):
+    """一次 multicall 共享的进程快照 (每张数据表只批量采集一次, 相同调用只执行一次)"""
+
+    def __init__(self, calls):
+        self._wanted = {}  # 数据表 -> 需要采集的pid集合 (None - 所有进程)
+        self._tables = {}  # 数据表 -> bulk_collect 结果
+        self._memo = {}  # (方法名, 参数) -> 结果或异常
+        for name, params in calls:
+            if not self._in_snapshot(name, params):
+                continue
+            if name in SNAPSHOT_METHODS:
+                table = SNAPSHOT_METHODS[name][0]
+                if table not in self._wanted:
+                    self._wanted[table] = set()
+                if self._wanted[table] is not None:
+                    self._wanted[table].add(str(params[0]))
+            else:
+                self._wanted["stat"] = None
+
+    def _table(self, table, pid=None):
+        """获取快照数据表 (首次使用时采集)"""
+        if table not in self._tables:
+            wanted = self._wanted.get(table, set())
+            self._tables[table] = _SNAPSHOT_COLLECTORS[table](None if wanted is None else list(wanted))
+        res = self._tables[table]
+        if pid is not None and pid not in res["data"] and pid not in res["errors"]:
+            # 未预先采集的pid, 单独采集后合并
+            extra = _SNAPSHOT_COLLECTORS[table]([pid])
+            res["data"].update(extra["data"])
+            res["errors"].update(extra["errors"])
+        return res
+
+    def _lookup(self, name, params):
+        """从快照中获取结果"""
+        if name in SNAPSHOT_METHODS:
+            table, extract = SNAPSHOT_METHODS[name]
+            pid = str(params[0])
+            res = self._table(table, pid)
+            if pid in res["errors"]:
+                code = res["errors"][pid]
+                if code == NO_SUCH_PROCESS:
+                    raise NoSuchProcess(pid)
+                if code == ACCESS_DENIED:
+                    raise AccessDenied(pid)
+                raise ProcessException("failed to read process data (pid={})".format(pid))
+            return extract(res["data"][pid], *params[1:])
+
+        stats = self._table("stat")["data"]
+        if name == "get_all_pid":
+            return sorted(stats, key=int)
+        pid = str(params[0])
+        if pid not in stats:
+            raise NoSuchProcess(pid)
+        if name == "get_all_child_process":
+            ppid = int(pid)
+            return sorted((p for p, stat in stats.items() if stat["ppid"] == ppid), key=int)
+        # get_same_group_process
+        pgrp = stats[pid]["pgrp"]
+        return sorted((p for p, stat in stats.items() if stat["pgrp"] == pgrp), key=int)
+
+    @staticmethod
+    def _in_snapshot(name, params):
+        """调用是否可以从快照中获取结果"""
+        if name in SNAPSHOT_METHODS:
+            return len(params) >= 1
+        if name == "get_all_pid":
+            return not params
+        return name in SNAPSHOT_ALL_STAT_METHODS and len(params) == 1
+
+    def call(self, name, params, func):
+        """执行调用 (可以从快照获取的直接获取,其余通过 func 执行,结果在本次快照中复用)"""
+        key = (name, params)
+        if key not in self._memo:
+            try:
+                if self._in_snapshot(name, params):
+                    self._memo[key] = (True, self._lookup(name, params))
+                else:
+                    self._memo[key] = (True, func())
+            except Exception as err:
+                self._memo[key] = (False, err)
+        ok, res = self._memo[key]
+        if not ok:
+            raise res
+        return res
+
+
+class RPCAgent(object):
+    """RPC服务接口 (注册到 SimpleXMLRPCServer)"""
+
+    # RPC服务自身提供的接口
+    agent_methods = ("multicall", "get_agent_status", "get_snapshot_frame", "query_metrics", "summarize_metrics",
+                     "top_metrics", "add_alert_rule", "remove_alert_rule", "get_alert_rules", "get_alerts",
+                     "get_alert_history", "get_self_stats", "get_collected", "top_processes",
+                     "filter_processes", "get_rollup", "get_cgroups", "get_cgroup")
+
+    def __init__(self, methods=None, freshness=None, store=None, alerts=None, scheduler=None, manage=None,
+                 paths=None):
+        """
+        :param manage: 是否提供进程管理接口 (None - RPC_AGENT_MANAGE), 只在 methods 为 None 时生效
+        :param paths: PATH_METHODS 及 log 告警规则允许访问的目录 (None - RPC_AGENT_PATHS)
+        """
+        self.paths = tuple(RPC_AGENT_PATHS if paths is None else paths)
+        if methods is None:
+            methods = dict(RPC_METHODS)
+            if RPC_AGENT_MANAGE if manage is None else manage:
+                methods.update(MANAGE_METHODS)
+        self.methods = methods
+        self.flight = SingleFlight(RPC_RESULT_FRESHNESS if freshness is None else freshness)
+        self._stateful_locks = dict((name, threading.Lock()) for name in STATEFUL_METHODS)
+        self.start_time = time()
+        self.request_count = 0
+        self._encoder = SnapshotEncoder()
+        self._frame = None
+        self._frame_time = 0
+        self._frame_lock = threading.Lock()
+        self.store = store  # 历史数据存储 (None - 不提供历史数据查询)
+        self.alerts = AlertEngine() if alerts is None else alerts
+        self.scheduler = scheduler  # 采集调度 (None - 不提供 get_collected)
+        self.rollup = None  # 按用户/程序汇总 (第一次调用 get_rollup 时创建)
+        self.cgroups = None  # cgroup 统计 (第一次调用 get_cgroups 时创建)
+        self._lazy_lock = threading.Lock()  # 按需创建 rollup / cgroups
+
+    def _call(self, name, params, snapshot=None):
+        """执行一次调用 (相同调用合并/复用 -> 快照 -> 实际调用), 返回转换后的结果"""
+        func = self.methods.get(name)
+        if func is None:
+            raise xmlrpclib.Fault(FAULT_METHOD_NOT_FOUND, "method not found : {}".format(name))
+        if name in PATH_METHODS and params:
+            self._check_path(params[0])
+        params = clamp_interval(name, params)
+        key = make_key(name, params)
+
+        def execute():
+            lock = self._stateful_locks.get(name)
+            if lock is not None:
+                with lock:
+                    return to_rpc_value(func(*params))
+            if snapshot is not None:
+                return to_rpc_value(snapshot.call(name, key[1], lambda: func(*params)))
+            return to_rpc_value(func(*params))
+
+        if name in SIDE_EFFECT_METHODS:
+            return execute()
+        return self.flight.do(key, execute)
+
+    def _check_path(self, path):
+        """路径不在允许的目录中时抛出 Fault"""
+        if not is_allowed_path(path, self.paths):
+            raise xmlrpclib.Fault(FAULT_ACCESS_DENIED, "path is not allowed : {} (allowed : {})".format(
+                path, ", ".join(self.paths) or "-"))
+
+    def _dispatch(self, method, params):
+        """SimpleXMLRPCServer 请求分发"""
+        self.request_count += 1
+        start = time()
+        error = None
+        try:
+            if method in self.agent_methods:
+                return getattr(self, method)(*params)
+            return self._call(method, tuple(params))
+        except Exception as err:
+            error = type(err).__name__
+            raise to_fault(err)
+        finally:
+            # 未知方法名合并统计, 避免客户端随意传入的方法名占用内存
+            known = method in self.agent_methods or method in self.methods
+            record("rpc." + method if known else "rpc.<unknown>", time() - start, error)
+
+    def multicall(self, calls):
+        """批量调用 - 所有调用共享一份进程快照, 每个调用单独返回结果或错误"""
+        parsed = []
+        for call in calls:
+            if isinstance(call, dict):
+                parsed.append((call.get("methodName"), tuple(call.get("params", ()))))
+            else:
+                parsed.append((None, ()))
+        snapshot = Snapshot(parsed)
+
+        results = []
+        for name, params in parsed:
+            if name is None:
+                fault = xmlrpclib.Fault(FAULT_INVALID_CALL, "call must be a struct with methodName and params")
+            else:
+                try:
+                    results.append([self._call(name, params, snapshot)])
+                    continue
+                except Exception as err:
+                    fault = to_fault(err)
+            results.append({"faultCode": fault.faultCode, "faultString": fault.faultString})
+        return results
+
+    def get_agent_status(self):
+        """RPC服务状态"""
+        return to_rpc_value({
+            "uptime": time() - self.start_time,
+            "request_count": self.request_count,
+            "proc_root": get_proc_root(),
+            "paths": self.paths,
+            "sys_root": get_sys_root(),
+            "single_flight": self.flight.get_status(),
+            "alerts": self.alerts.get_status(),
+            "usage": get_agent_usage(),
+            "scheduler": self.scheduler.get_status() if self.scheduler is not None else None,
+        })
+
+    def get_snapshot_frame(self, last_seq=0):
+        """
+        二进制进程快照帧 (见 snapshot_codec)
+        :param last_seq: 接收方最后应用的帧序号, 与上一帧连续时返回增量帧, 否则返回完整帧
+        :return: 帧数据 (接收方已经是最新帧时为空)
+        """
+        with self._frame_lock:
+            if self._frame is None or time() - self._frame_time >= SNAPSHOT_FRAME_INTERVAL:
+                self._frame = self._encoder.encode(collect_snapshot())
+                self._frame_time = time()
+            if last_seq == self._encoder.seq:
+                frame = b""
+            elif last_seq == self._encoder.seq - 1:
+                frame = self._frame
+            else:
+                frame = self._encoder.encode_full()
+        return xmlrpclib.Binary(frame)
+
+    def _get_store(self):
+        """历史数据存储"""
+        if self.store is None:
+            raise xmlrpclib.Fault(FAULT_NO_METRICS_STORE, "metrics store is not enabled")
+        return self.store
+
+    def query_metrics(self, name, start=None, end=None, resolution="auto", step=None, func="avg", as_rate=False,
+                      counter=False):
+        """历史数据查询 - 时间范围/降采样/变化速率 (start为负数时表示相对当前时间, 见 metrics_query.query_metrics)"""
+        try:
+            return to_rpc_value(metrics_query.query_metrics(self._get_store(), name, start, end, resolution, step,
+                                                            func, as_rate, counter))
+        except ValueError as err:
+            raise xmlrpclib.Fault(FAULT_INVALID_CALL, str(err))
+
+    def summarize_metrics(self, name, start=None, end=None, resolution="auto", qs=(50, 95, 99)):
+        """历史数据统计 - 平均值/最小值/最大值/百分位数 (百分位数只根据原始数据计算, 超出原始数据范围时为None)"""
+        try:
+            return to_rpc_value(metrics_query.summarize(self._get_store(), name, start, end, resolution, tuple(qs)))
+        except ValueError as err:
+            raise xmlrpclib.Fault(FAULT_INVALID_CALL, str(err))
+
+    def top_metrics(self, pattern, k=10, func="avg", start=None, end=None, resolution="auto"):
+        """按聚合值排序的前k个序列, 如 top_metrics("process.*.cpu_percent", 10, "p95", -3600)"""
+        return to_rpc_value(metrics_query.top_k(self._get_store(), pattern, k, func, start, end, resolution))
+
+    def add_alert_rule(self, text, severity="warning"):
+        """添加告警规则, 返回规则id, 如 add_alert_rule("sys.cpu_percent > 90 for 5m clear 80")"""
+        fields = text.split() if isinstance(text, basestring) else ()
+        if len(fields) > 1 and fields[0] == "log":  # 日志规则读取文件, 与 PATH_METHODS 相同限制
+            self._check_path(fields[1])
+        try:
+            return self.alerts.add_rule(text, severity)
+        except ValueError as err:
+            raise xmlrpclib.Fault(FAULT_INVALID_CALL, str(err))
+
+    def remove_alert_rule(self, rule_id):
+        """删除告警规则"""
+        return self.alerts.remove_rule(rule_id)
+
+    def get_alert_rules(self):
+        """所有告警规则"""
+        return to_rpc_value(self.alerts.get_rules())
+
+    def get_alerts(self):
+        """未恢复的告警"""
+        return to_rpc_value(self.alerts.get_alerts())
+
+    def get_alert_history(self, count=100):
+        """最近的告警事件"""
+        return to_rpc_value(self.alerts.get_history(count))
+
+    def get_collected(self, name):
+        """采集调度中某个采集项最近一次的结果 [时间, 数值], 如 get_collected("mem")"""
+        if self.scheduler is None:
+            raise xmlrpclib.Fault(FAULT_INVALID_CALL, "collect scheduler is not enabled")
+        try:
+            return to_rpc_value(self.scheduler.get_result(name))
+        except KeyError:
+            raise xmlrpclib.Fault(FAULT_METHOD_NOT_FOUND, "unknown collector : {}".format(name))
+
+    def top_processes(self, n=process_top.TOP_N, by="cpu"):
+        """
+        进程排行, by 为 cpu/rss/read/write/io/threads, 组合如 "cpu+rss" 或 {"cpu": 1, "rss": 0.5}
+        第一次调用时需要等待两次采样
+        """
+        try:
+            io = process_top.need_io(by)
+        except ValueError as err:
+            raise xmlrpclib.Fault(FAULT_INVALID_CALL, str(err))
+        # 进程表在最后一次调用后 SAMPLER_TABLE_TTL 秒停止采集
+        sampler.enable_table(io, owner=("top_processes", io), ttl=SAMPLER_TABLE_TTL)
+        prev, last = sampler.get_samples()
+        timeout = sampler.interval * 3 + 1
+        while prev is None or prev.table is None or (io and prev.table.read is None):
+            if sampler.wait_for_sample(last.seq if last is not None else 0, timeout) is None:
+                raise xmlrpclib.Fault(FAULT_INTERNAL_ERROR, "sampler is not running")
+            prev, last = sampler.get_samples()
+        return to_rpc_value(process_top.top_processes(prev, last, n, by))
+
+    def filter_processes(self, expr, fields=()):
+        """
+        按过滤表达式查找进程, 返回pid列表 (指定 fields 时返回 [{字段: 值}])
+        如 filter_processes("user=app and state in (R,D) and rss > 2G and cmdline ~ /java.*kafka/")
+        """
+        last = sampler.get_samples()[1]
+        table = last.table if last is not None else None  # 采样器开启了进程表时直接使用表中的字段
+        try:
+            return to_rpc_value(filter_processes(expr, table=table, fields=tuple(fields)))
+        except FilterSyntaxError as err:
+            raise xmlrpclib.Fault(FAULT_INVALID_CALL, str(err))
+
+    def get_rollup(self, key="user", n=20, by="cpu"):
+        """
+        按用户(user)/进程名(comm)/可执行文件(exe)汇总的资源占用, by 为 cpu/rss/processes/threads
+        第一次调用时需要等待两次采样
+        """
+        with self._lazy_lock:
+            if self.rollup is None:
+                self.rollup = ProcessRollup()
+            self.rollup.attach(sampler, SAMPLER_TABLE_TTL)  # 每次调用延长进程表的使用时间
+        if not self.rollup.wait_ready(sampler.interval * 3 + 1):
+            raise xmlrpclib.Fault(FAULT_INTERNAL_ERROR, "sampler is not running")
+        try:
+            return to_rpc_value(self.rollup.get_groups(key, n, by))
+        except ValueError as err:
+            raise xmlrpclib.Fault(FAULT_INVALID_CALL, str(err))
+
+    def _cgroup_monitor(self):
+        """cgroup 统计 (第一次调用时订阅采样器并等待两次采样)"""
+        with self._lazy_lock:
+            if self.cgroups is None:
+                self.cgroups = CgroupMonitor()
+            self.cgroups.attach(sampler, SAMPLER_TABLE_TTL)  # 每次调用延长进程表的使用时间
+        if not self.cgroups.wait_ready(sampler.interval * 3 + 1):
+            raise xmlrpclib.Fault(FAULT_INTERNAL_ERROR, "sampler is not running")
+        return self.cgroups
+
+    def get_cgroups(self, n=20, by="cpu", containers_only=False):
+        """各 cgroup(容器) 的资源占用, by 为 cpu/memory/pids/read/write/throttled"""
+        monitor = self._cgroup_monitor()
+        try:
+            return to_rpc_value(monitor.get_groups(n, by, containers_only))
+        except ValueError as err:
+            raise xmlrpclib.Fault(FAULT_INVALID_CALL, str(err))
+
+    def get_cgroup(self, path):
+        """单个 cgroup 的资源占用, 参数为 cgroup 路径或容器id(前缀, 至少12位)"""
+        monitor = self._cgroup_monitor()
+        try:
+            return to_rpc_value(monitor.get_group(path))
+        except KeyError:
+            raise xmlrpclib.Fault(FAULT_INVALID_CALL, "no such cgroup : {}".format(path))
+
+    def get_self_stats(self, prefix=""):
+        """自身监测 - 各函数调用次数/耗时/错误/读取字节数及服务自身资源占用, 如 get_self_stats("rpc.")"""
+        return to_rpc_value(get_self_stats(prefix))
+
+    def _listMethods(self):
+        """system.listMethods"""
+        return sorted(list(self.methods) + list(self.agent_methods))
+
+    def _methodHelp(self, method):
+        """system.methodHelp"""
+        if method in self.agent_methods:
+            func = getattr(self, method)
+        else:
+            func = self.methods.get(method)
+        return (func.__doc__ or "").strip() if func is not None else ""
+
+
+def check_token(headers, token):
+    """请求头中的令牌是否正确 (Basic 密码 / Bearer / X-Watch-Dogs-Token)"""
+    given = headers.get("X-Watch-Dogs-Token")
+    auth = headers.get("Authorization", "")
+    if given is None and auth.startswith("Bearer "):
+        given = auth[7:].strip()
+    elif given is None and auth.startswith("Basic "):
+        try:
+            given = base64.b64decode(auth[6:].strip()).partition(":")[2]
+        except (TypeError, ValueError):
+            return False
+    return given is not None and hmac.compare_digest(str(given), str(token))
+
+
+class _RequestHandler(SimpleXMLRPCRequestHandler):
+    """请求处理 (XML-RPC 只响应 /RPC2 和 /, GET /metrics 为 Prometheus 数据)"""
+    rpc_paths = ("/", "/RPC2")
+    metrics_path = "/metrics"
+
+    def _check_access(self):
+        """客户端地址白名单及令牌检查, 不通过时返回 403/401"""
+        token, allow = self.server.token, self.server.allow
+        client = self.client_address[0]
+        if allow and client not in allow or not allow and token is None and client not in _LOOPBACK:
+            self.send_error(403)
+            return False
+        if token is not None and not check_token(self.headers, token):
+            self.send_response(401)
+            self.send_header("WWW-Authenticate", 'Basic realm="watch_dogs"')
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return False
+        return True
+
+    def do_POST(self):
+        """XML-RPC 调用"""
+        if self._check_access():
+            SimpleXMLRPCRequestHandler.do_POST(self)
+
+    def do_GET(self):
+        """Prometheus 抓取"""
+        if not self._check_access():
+            return
+        exporter = getattr(self.server, "exporter", None)
+        if exporter is None or self.path.split("?", 1)[0] != self.metrics_path:
+            self.report_404()
+            return
+        body, content_type, encoding = exporter.get_metrics(self.headers.get("Accept", ""),
+                                                            self.headers.get("Accept-Encoding", ""))
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        if encoding is not None:
+            self.send_header("Content-Encoding", encoding)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """不输出每个请求的访问日志"""
+        pass
+
+
+class RPCAgentServer(ThreadingMixIn, SimpleXMLRPCServer):
+    """多线程 XML-RPC 服务"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host=RPC_AGENT_HOST, port=RPC_AGENT_PORT, agent=None, exporter=None, token=RPC_AGENT_TOKEN,
+                 allow=RPC_AGENT_ALLOW):
+        """
+        :param token: 共享令牌 (None - 不检查)
+        :param allow: 允许的客户端地址 (空 - 不检查; 令牌和白名单都为空时只接受本机客户端)
+        """
+        self.token = token
+        self.allow = tuple(allow or ())
+        SimpleXMLRPCServer.__init__(self, (host, port), requestHandler=_RequestHandler, allow_none=True,
+                                    logRequests=False)
+        self.agent = RPCAgent() if agent is None else agent
+        self.exporter = exporter  # Prometheus 数据导出 (None - 不提供 /metrics)
+        self.register_instance(self.agent)
+        self.register_introspection_functions()
+
+
+def run_agent(host=RPC_AGENT_HOST, port=RPC_AGENT_PORT, metrics_path=METRICS_STORE_PATH, exporter=True,
+              manage=RPC_AGENT_MANAGE, token=RPC_AGENT_TOKEN, allow=RPC_AGENT_ALLOW, paths=RPC_AGENT_PATHS):
+    """
+    启动RPC服务 (阻塞)
+    :param manage: 是否提供进程管理接口 (启动/重启/结束进程)
+    :param paths: 日志/路径接口允许访问的目录
+    :param token: 共享令牌, allow : 允许的客户端地址 (见 RPCAgentServer)
+    :param metrics_path: 历史数据存储目录 (None - 不保存历史数据)
+    :param exporter: 是否提供 Prometheus /metrics, 也可以传入配置好的 PrometheusExporter
+    """
+    store = recorder = None
+    if metrics_path:
+        store = MetricsStore(metrics_path)
+        recorder = MetricsRecorder(store, sampler)
+        recorder.start()
+    scheduler = create_scheduler(sampler=sampler)  # cpu / net 使用采样器的数据, 不重复读取
+    agent = RPCAgent(store=store, scheduler=scheduler, manage=manage, paths=paths)
+    agent.alerts.attach(sampler)
+    if exporter is True:
+        exporter = PrometheusExporter()
+    if exporter:
+        exporter.attach(sampler)
+    sampler.start()
+    scheduler.start()
+    server = RPCAgentServer(host, port, agent, exporter or None, token, allow)
+    print "Watch_Dogs rpc agent listening on {}:{} (token : {}, allow : {}, manage : {}, paths : {})".format(
+        host, port, "on" if token else "off", ", ".join(allow) or "-", "on" if manage else "off",
+        ", ".join(paths) or "-")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        agent.alerts.detach()
+        if exporter:
+            exporter.detach()
+        if recorder is not None:
+            recorder.stop()
+            store.close()
+        scheduler.stop()
+        sampler.stop()
+
+
+if __name__ == '__main__':
+    run_agent(port=int(sys.argv[1]) if len(sys.argv) > 1 else RPC_AGENT_PORT)
@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+# encoding:utf-8
+
+"""
+进程监测核心功能实现 - 后台采样
+
+主要包括
+- 后台线程按固定间隔采样 系统CPU时间(总体/各核心), 网卡流量, 关注进程的CPU时间片和读写数据
+- 可选的全部进程表 (enable_table), 供 process_top 等需要所有进程数据的功能使用
+    - 每个使用者 (owner) 单独登记, 可以指定有效时间 (ttl, 按需查询时每次调用刷新), 所有使用者都释放或超时后
+      停止采集 (进程表需要读取每个进程的 /proc/[pid]/stat, 进程很多时开销较大)
+- 保存最近两次采样,根据两次采样计算各类速率(不需要在调用时sleep)
+- 等待下一次采样 / 采样完成回调
+
+与 sys_monitor / process_monitor 中 calc_* 系列函数计算方式一致,
+calc_* 在调用时 sleep(interval) 并使用全局变量保存上一次数据, 采样器在后台完成这部分工作.
+"""
+
+import threading
+from time import time
+
+from bulk_collect import bulk_get_process_stat, bulk_get_process_io
+from proc_root import proc_path, proc_ns_path, use_proc_root
+from prcess_exception import NoSuchProcess, AccessDenied
+from self_monitor import instrument
+
+# 采样间隔(秒)
+SAMPLER_INTERVAL = 1
+# 按需使用进程表(如RPC查询)时, 最后一次使用后继续采集的时间(秒)
+SAMPLER_TABLE_TTL = 300
+
+
+class Sample(object):
+    """一次采样数据"""
+    __slots__ = ("seq", "time", "cpu", "cores", "net", "process", "table")
+
+    def __init__(self, seq, sample_time):
+        self.seq = seq  # 采样序号
+        self.time = sample_time
+        self.cpu = None  # [总cpu时间, 工作时间]
+        self.cores = {}  # 核心名 -> [总cpu时间, 工作时间]
+        self.net = {}  # 网卡 -> (接收字节, 发送字节)
+        self.process = {}  # pid(str) -> (starttime, cpu时间片, [rchar, wchar]或None, rss页数)
+        self.table = None  # 全部进程表 ProcessTable (sampler.enable_table 后采集)
+
+
+class ProcessTable(object):
+    """全部进程表 (按列保存, 便于对所有进程批量计算)"""
+    __slots__ = ("pids", "index", "comm", "ppid", "starttime", "cpu", "own_cpu", "rss", "threads", "read", "write",
+                 "cache")
+
+    def __init__(self, stats, ios=None):
+        """
+        :param stats: bulk_get_process_stat 的数据 {pid: stat}
+        :param ios: bulk_get_process_io 的数据 {pid: [rchar, wchar]}, None - 不包含读写数据
+        """
+        self.pids = list(stats)  # pid(str)
+        self.index = dict((pid, i) for i, pid in enumerate(self.pids))
+        rows = [stats[pid] for pid in self.pids]
+        self.comm = [stat["comm"] for stat in rows]
+        self.ppid = [stat["ppid"] for stat in rows]
+        self.starttime = [stat["starttime"] for stat in rows]
+        self.cpu = [stat["utime"] + stat["stime"] + stat["cutime"] + stat["cstime"] for stat in rows]  # cpu时间片
+        self.own_cpu = [stat["utime"] + stat["stime"] for stat in rows]  # 不包含已退出子进程的cpu时间片
+        self.rss = [stat["rss"] for stat in rows]  # 页数
+        self.threads = [stat["num_threads"] for stat in rows]
+        self.read = self.write = None  # rchar / wchar, 无权限读取的进程为None
+        if ios is not None:
+            io = [ios.get(pid) for pid in self.pids]
+            self.read = [v[0] if v is not None else None for v in io]
+            self.write = [v[1] if v is not None else None for v in io]
+        self.cache = {}  # 供使用者保存计算结果 (如与上一次采样的差值)
+
+    def __len__(self):
+        return len(self.pids)
+
+
+def parse_cpu_times(data):
+    """解析 /proc/stat 内容, 返回 ([总时间, 工作时间], {核心名: [总时间, 工作时间]})"""
+    total = None
+    cores = {}
+    for line in data.splitlines():
+        if not line.startswith("cpu"):
+            break
+        fields = line.split()
+        user, nice, system, idle, iowait, irq, softirq, steal = map(int, fields[1:9])
+        times = [user + nice + system + idle + iowait + irq + softirq + steal, user + nice + system]
+        if fields[0] == "cpu":
+            total = times
+        else:
+            cores[fields[0]] = times
+    return total, cores
+
+
+def parse_net_dev(data):
+    """解析 /proc/net/dev 内容, 返回 {网卡: (接收字节, 发送字节)}"""
+    res = {}
+    for line in data.splitlines():
+        if ":" not in line:
+            continue
+        name, fields = line.split(":", 1)
+        fields = fields.split()
+        res[name.strip()] = (int(fields[0]), int(fields[8]))
+    return res
+
+
+@instrument
+def read_cpu_times():
+    """读取总体及各核心cpu时间 - /proc/stat (一次读取) , 返回 ([总时间, 工作时间], {核心名: [总时间, 工作时间]})"""
+    with open(proc_path("stat"), "r") as cpu_stat:
+        return parse_cpu_times(cpu_stat.read())
+
+
+@instrument
+def read_net_dev():
+    """读取所有网卡流量 - /proc/net/dev (一次读取), 返回 {网卡: (接收字节, 发送字节)}"""
+    with open(proc_ns_path("net/dev"), "r") as net_dev:
+        return parse_net_dev(net_dev.read())
+
+
+class Sampler(object):
+    """后台采样器 (线程安全)"""
+
+    def __init__(self, interval=SAMPLER_INTERVAL, proc_root=None):
+        """:param proc_root: 采样使用的 proc 根目录 (None - 全局配置, 见 proc_root)"""
+        self.interval = interval
+        self.proc_root = proc_root
+        self._prev = None  # 上一次采样
+        self._last = None  # 最近一次采样
+        self._seq = 0
+        self._watch = set()  # 关注的进程pid(str)
+        self._gone = set()  # 已经退出的关注进程
+        self._table = False  # 是否一直采集全部进程表 (enable_table 不指定使用者)
+        self._table_io = False  # 进程表是否包含读写数据 (每个进程多读取一个文件)
+        self._table_users = {}  # 进程表使用者 -> (是否需要读写数据, 过期时间或None)
+        self._callbacks = []  # 每次采样完成后调用 callback(prev, last)
+        self._once = []  # 下一次采样完成后调用一次
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """启动后台采样线程 (立即进行一次采样)"""
+        with self._cond:
+            if self.is_running():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="watch_dogs_sampler")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self, timeout=5):
+        """停止后台采样线程"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def is_running(self):
+        """采样线程是否运行"""
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self):
+        """采样线程"""
+        while not self._stop.is_set():
+            begin = time()
+            try:
+                self.sample_once()
+            except Exception as err:  # 采样失败不能让线程退出
+                print "Error : sampler - {}".format(err)
+            self._stop.wait(max(0, self.interval - (time() - begin)))
+
+    def watch_process(self, pid):
+        """关注进程 (下一次采样开始采集该进程数据)"""
+        with self._cond:
+            self._watch.add(str(pid))
+            self._gone.discard(str(pid))
+
+    def unwatch_process(self, pid):
+        """取消关注进程"""
+        with self._cond:
+            self._watch.discard(str(pid))
+            self._gone.discard(str(pid))
+
+    def get_watch_process(self):
+        """获取关注的进程"""
+        with self._cond:
+            return sorted(self._watch, key=int)
+
+    def enable_table(self, io=False, owner=None, ttl=None):
+        """
+        采集全部进程表 (下一次采样开始), io - 同时采集所有进程的读写数据
+        :param owner: 使用者 (None - 一直采集, 直到 disable_table), 同一使用者再次调用时更新 io 和 ttl
+        :param ttl: 使用者的有效时间(秒), 超时后自动释放 (None - 直到 release_table)
+        """
+        with self._cond:
+            if owner is None:
+                self._table = True
+                self._table_io = self._table_io or io
+            else:
+                self._table_users[owner] = (io, time() + ttl if ttl is not None else None)
+
+    def release_table(self, owner):
+        """释放使用者, 没有使用者时停止采集进程表"""
+        with self._cond:
+            self._table_users.pop(owner, None)
+
+    def disable_table(self):
+        """停止采集全部进程表 (同时释放所有使用者)"""
+        with self._cond:
+            self._table = self._table_io = False
+            self._table_users.clear()
+
+    def _table_state(self, now):
+        """(是否采集进程表, 是否包含读写数据), 同时删除已过期的使用者 (需持有锁)"""
+        for owner, (io, expire) in self._table_users.items():
+            if expire is not None and expire < now:
+                del self._table_users[owner]
+        users = self._table_users.values()
+        return self._table or bool(users), self._table_io or any(io for io, expire in users)
+
+    def subscribe(self, callback):
+        """订阅采样 - 每次采样完成后(在采样线程中)调用 callback(上一次采样, 本次采样), 重复订阅无效"""
+        with self._cond:
+            if callback not in self._callbacks:
+                self._callbacks.append(callback)
+
+    def unsubscribe(self, callback):
+        """取消订阅"""
+        with self._cond:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def call_on_next_sample(self, callback):
+        """下一次采样完成后(在采样线程中)调用一次 callback(上一次采样, 本次采样)"""
+        with self._cond:
+            self._once.append(callback)
+
+    @instrument(name="sampler.sample_once")
+    def sample_once(self):
+        """进行一次采样 (采样及回调都使用采样器的 proc 根目录)"""
+        with use_proc_root(self.proc_root):
+            return self._sample()
+
+    def _sample(self):
+        """采样"""
+        with self._cond:
+            watch = list(self._watch)
+            now = time()
+            table, table_io = self._table_state(now)
+            self._seq += 1
+            sample = Sample(self._seq, now)
+
+        sample.cpu, sample.cores = read_cpu_times()
+        sample.net = read_net_dev()
+        if table:  # 关注进程的数据直接从进程表中获取
+            stats = bulk_get_process_stat()["data"]
+            io_pids = list(stats) if table_io else [pid for pid in watch if pid in stats]
+        else:
+            stats = bulk_get_process_stat(watch)["data"] if watch else {}
+            io_pids = list(stats)
+        ios = bulk_get_process_io(io_pids)["data"] if io_pids else {}
+        if table:
+            sample.table = ProcessTable(stats, ios if table_io else None)
+        for pid in watch:
+            stat = stats.get(pid)
+            if stat is not None:
+                sample.process[pid] = (stat["starttime"], stat["utime"] + stat["stime"] + stat["cutime"] +
+                                       stat["cstime"], ios.get(pid), stat["rss"])
+
+        with self._cond:
+            prev = self._last
+            self._prev, self._last = prev, sample
+            # 关注的进程已经退出,不再采集
+            for pid in watch:
+                if pid not in sample.process and pid in self._watch:
+                    self._watch.discard(pid)
+                    self._gone.add(pid)
+            callbacks = self._callbacks + self._once
+            self._once = []
+            self._cond.notify_all()
+
+        for callback in callbacks:
+            try:
+                callback(prev, sample)
+            except Exception as err:
+                print "Error : sampler callback - {}".format(err)
+        return sample
+
+    def get_samples(self):
+        """获取 (上一次采样, 最近一次采样)"""
+        with self._cond:
+            return self._prev, self._last
+
+    def wait_for_sample(self, seq=0, timeout=None):
+        """等待序号大于seq的采样 (返回最近一次采样,超时返回None)"""
+        deadline = None if timeout is None else time() + timeout
+        with self._cond:
+            while self._last is None or self._last.seq <= seq:
+                remaining = None if deadline is None else deadline - time()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+            return self._last
+
+    # 速率计算 - 采样不足两次时返回 None
+
+    def get_cpu_percent(self):
+        """CPU总占用率 (与 calc_cpu_percent 一致)"""
+        prev, last = self.get_samples()
+        if prev is None:
+            return None
+        return _percent(prev.cpu, last.cpu)
+
+    def get_cpu_percent_by_cores(self):
+        """CPU各核占用率 (与 calc_cpu_percent_by_cores 一致)"""
+        prev, last = self.get_samples()
+        if prev is None:
+            return None
+        return dict((name, _percent(prev.cores[name], times))
+                    for name, times in last.cores.items() if name in prev.cores)
+
+    def get_net_speed(self, device):
+        """网卡速度 [下载速度,上传速度] KB/s (与 calc_net_speed 一致)"""
+        prev, last = self.get_samples()
+        if prev is None:
+            return None
+        if device not in last.net or device not in prev.net:
+            return -1, -1
+        seconds = last.time - prev.time
+        return ((last.net[device][0] - prev.net[device][0]) / 1024.0 / seconds,
+                (last.net[device][1] - prev.net[device][1]) / 1024.0 / seconds)
+
+    def _process_samples(self, pid):
+        """获取进程的前后两次采样数据 (数据不足返回None, 进程已退出抛出NoSuchProcess)"""
+        pid = str(pid)
+        with self._cond:
+            if pid in self._gone:
+                self._gone.discard(pid)
+                raise NoSuchProcess(pid)
+            if pid not in self._watch:
+                self._watch.add(pid)
+                return None
+            prev, last = self._prev, self._last
+        if prev is None or pid not in prev.process or pid not in last.process:
+            return None
+        if prev.process[pid][0] != last.process[pid][0]:  # pid 已被复用
+            return None
+        return prev, last
+
+    def get_process_cpu_percent(self, pid):
+        """进程CPU占用率 (与 calc_process_cpu_percent 一致, 未关注的进程自动关注)"""
+        samples = self._process_samples(pid)
+        if samples is None:
+            return None
+        prev, last = samples
+        pid = str(pid)
+        return _percent([prev.cpu[0], prev.process[pid][1]], [last.cpu[0], last.process[pid][1]])
+
+    def get_process_io_speed(self, pid):
+        """进程磁盘读写速度 [读, 写] MB/s (与 calc_process_cpu_io 一致, 未关注的进程自动关注)"""
+        samples = self._process_samples(pid)
+        if samples is None:
+            return None
+        prev, last = samples
+        pid = str(pid)
+        prev_io, last_io = prev.process[pid][2], last.process[pid][2]
+        if last_io is None:  # /proc/[pid]/io 需要root权限
+            raise AccessDenied(pid)
+        if prev_io is None:
+            return None
+        seconds = last.time - prev.time
+        return [round((last_io[0] - prev_io[0]) / 1000. ** 2 / seconds, 2),
+                round((last_io[1] - prev_io[1]) / 1000. ** 2 / seconds, 2)]
+
+
+def _percent(prev, last):
+    """根据前后两次 [总时间, 工作时间] 计算占用率"""
+    total = last[0] - prev[0]
+    if total <= 0:
+        return 0.0
+    return (last[1] - prev[1]) * 100.0 / total
+
+
+# 默认采样器(模块内共享, 需要调用 start 启动)
+sampler = Sampler()
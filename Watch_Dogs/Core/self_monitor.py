@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+# encoding:utf-8
+
+"""
+进程监测核心功能实现 - 自身监测
+
+主要包括
+- 采集函数的调用次数, 错误次数(按异常类型), 耗时直方图 (固定的对数分桶, 可估算 p50/p95/p99)
+- 采集函数从 /proc 读取的字节数 (每 SELF_MONITOR_IO_SAMPLE 次调用抽样一次, 按调用次数估算总量)
+- 监测程序自身的 CPU 时间/占用率, 内存(RSS), 线程数, 读写字节数
+
+开销
+- 计数器按线程保存 (threading.local), 记录时不加锁, 只在新线程第一次记录和查询汇总时加锁
+- 每次调用只有两次 time() 和一次 bisect, 读取字节数使用 /proc/thread-self/io 抽样
+- 环境变量 WATCH_DOGS_SELF_MONITOR=0 或 set_enabled(False) 关闭
+
+使用
+    @instrument
+    def get_xxx(pid): ...
+
+    record("rpc.get_xxx", seconds, error)   # 不方便使用装饰器时手动记录
+
+wrap_process_exceptions 装饰的函数, bulk_collect 批量接口及采样器会自动记录.
+
+reference   :   https://prometheus.io/docs/practices/histograms/
+reference   :   http://man7.org/linux/man-pages/man5/proc.5.html (/proc/[pid]/io)
+"""
+
+import os
+import threading
+from bisect import bisect_left
+from functools import wraps
+from time import time
+
+SELF_MONITOR_ENABLED = os.environ.get("WATCH_DOGS_SELF_MONITOR", "1") != "0"
+# 读取字节数的抽样间隔 (每N次调用抽样一次, 0 - 不统计)
+SELF_MONITOR_IO_SAMPLE = 16
+# 已退出线程的计数器超过该数量时合并 (RPC服务每个请求一个线程)
+SELF_MONITOR_FOLD_THREADS = 64
+# 耗时直方图的分桶上限(秒), 最后一个桶为 +Inf
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# 自身数据总是读取真实的 /proc (不受 proc_root 影响)
+_THREAD_IO_PATH = "/proc/thread-self/io"
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+_local = threading.local()
+_threads = {}  # id(计数器) -> (线程, {函数名: _Stats})
+_retired = {}  # 已退出线程合并后的计数器 {函数名: _Stats}
+_lock = threading.Lock()
+_last_usage = [time(), sum(os.times()[:2])]  # 上一次查询的 (时间, CPU时间), 用于计算占用率
+
+
+class _Stats(object):
+    """单个函数在单个线程中的计数"""
+    __slots__ = ("calls", "errors", "total", "max", "buckets", "io_calls", "io_bytes")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = {}  # 异常类型名 -> 次数
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.io_calls = 0  # 抽样统计读取字节数的调用次数
+        self.io_bytes = 0
+
+    def merge(self, other):
+        """合并另一个计数"""
+        self.calls += other.calls
+        for name, count in other.errors.items():
+            self.errors[name] = self.errors.get(name, 0) + count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        self.buckets = map(sum, zip(self.buckets, other.buckets))
+        self.io_calls += other.io_calls
+        self.io_bytes += other.io_bytes
+
+
+def set_enabled(enabled):
+    """开启/关闭自身监测"""
+    global SELF_MONITOR_ENABLED
+    SELF_MONITOR_ENABLED = bool(enabled)
+
+
+def _fold():
+    """将已退出线程的计数合并到 _retired (需持有锁)"""
+    for key, (thread, stats) in _threads.items():
+        if not thread.is_alive():
+            for name, s in stats.items():
+                _retired.setdefault(name, _Stats()).merge(s)
+            del _threads[key]
+
+
+def _thread_stats():
+    """当前线程的计数器 {函数名: _Stats}"""
+    stats = getattr(_local, "stats", None)
+    if stats is None:
+        stats = _local.stats = {}
+        with _lock:
+            if len(_threads) >= SELF_MONITOR_FOLD_THREADS:
+                _fold()
+            _threads[id(stats)] = (threading.current_thread(), stats)
+    return stats
+
+
+def _get(name):
+    """当前线程中某个函数的计数"""
+    stats = _thread_stats()
+    s = stats.get(name)
+    if s is None:
+        s = stats[name] = _Stats()
+    return s
+
+
+def _thread_read_bytes():
+    """当前线程读取的字节数 (rchar) 及本次读取的长度, 不支持时返回None"""
+    try:
+        with open(_THREAD_IO_PATH, "r") as f:
+            data = f.read()
+    except IOError:
+        return None
+    return int(data.split("\n", 1)[0].split()[1]), len(data)
+
+
+def record(name, seconds, error=None, read_bytes=None):
+    """
+    记录一次调用
+    :param error: 异常类型名 (None - 调用成功)
+    :param read_bytes: 本次调用读取的字节数 (None - 未统计)
+    """
+    if not SELF_MONITOR_ENABLED:
+        return
+    _add(_get(name), seconds, error, read_bytes)
+
+
+def _add(s, seconds, error, read_bytes):
+    s.calls += 1
+    s.total += seconds
+    if seconds > s.max:
+        s.max = seconds
+    s.buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+    if error is not None:
+        s.errors[error] = s.errors.get(error, 0) + 1
+    if read_bytes is not None:
+        s.io_calls += 1
+        s.io_bytes += read_bytes
+
+
+def instrument(func=None, name=None):
+    """
+    装饰器 - 记录调用次数/错误/耗时/读取字节数
+    :param name: 统计名称, 默认为 模块名.函数名
+    """
+    if func is None:
+        return lambda f: instrument(f, name)
+    name = name or "{}.{}".format(func.__module__, func.__name__)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not SELF_MONITOR_ENABLED:
+            return func(*args, **kwargs)
+        s = _get(name)
+        io_before = None
+        if SELF_MONITOR_IO_SAMPLE and s.calls % SELF_MONITOR_IO_SAMPLE == 0:
+            io_before = _thread_read_bytes()
+        error = None
+        start = time()
+        try:
+            return func(*args, **kwargs)
+        except Exception as err:
+            error = type(err).__name__
+            raise
+        finally:
+            elapsed = time() - start
+            read_bytes = None
+            if io_before is not None:
+                io_after = _thread_read_bytes()
+                if io_after is not None:  # 减去第一次读取 thread-self/io 本身的长度
+                    read_bytes = max(io_after[0] - io_before[0] - io_before[1], 0)
+            _add(s, elapsed, error, read_bytes)
+
+    return wrapper
+
+
+def histogram_quantile(q, buckets):
+    """按直方图估算分位数 (桶内线性插值, 与 Prometheus histogram_quantile 一致), q 为 0~1"""
+    total = sum(buckets)
+    if not total:
+        return None
+    rank = q * total
+    count = 0
+    for i, n in enumerate(buckets):
+        if count + n >= rank and n:
+            if i == len(LATENCY_BUCKETS):  # +Inf 桶返回最大的有限上限
+                return LATENCY_BUCKETS[-1]
+            low = LATENCY_BUCKETS[i - 1] if i else 0.0
+            return low + (LATENCY_BUCKETS[i] - low) * (rank - count) / n
+        count += n
+    return LATENCY_BUCKETS[-1]
+
+
+def collect_stats():
+    """汇总所有线程的计数 {函数名: _Stats}"""
+    res = {}
+    with _lock:
+        _fold()
+        groups = [_retired] + [stats for thread, stats in _threads.values()]
+        for stats in groups:
+            for name, s in stats.items():
+                res.setdefault(name, _Stats()).merge(s)
+    return res
+
+
+def get_function_stats(prefix=""):
+    """
+    各函数的统计数据
+    :param prefix: 只返回以此开头的函数名, 如 "process_monitor."
+    :return: {函数名: {"calls", "errors", "error_count", "total_seconds", "avg_seconds", "max_seconds",
+                      "p50", "p95", "p99", "histogram", "read_bytes", "read_bytes_per_call"}}
+    """
+    res = {}
+    for name, s in collect_stats().items():
+        if not name.startswith(prefix):
+            continue
+        per_call = float(s.io_bytes) / s.io_calls if s.io_calls else None
+        res[name] = {
+            "calls": s.calls,
+            "errors": s.errors,
+            "error_count": sum(s.errors.values()),
+            "total_seconds": s.total,
+            "avg_seconds": s.total / s.calls if s.calls else 0.0,
+            "max_seconds": s.max,
+            "p50": histogram_quantile(0.5, s.buckets),
+            "p95": histogram_quantile(0.95, s.buckets),
+            "p99": histogram_quantile(0.99, s.buckets),
+            "histogram": s.buckets,
+            # 抽样估算的总读取字节数
+            "read_bytes": int(per_call * s.calls) if per_call is not None else None,
+            "read_bytes_per_call": per_call,
+        }
+    return res
+
+
+def _read_self(name):
+    try:
+        with open("/proc/self/" + name, "r") as f:
+            return f.read()
+    except IOError:
+        return None
+
+
+def read_agent_usage():
+    """
+    监测程序自身的资源占用
+    :return: {"cpu_user", "cpu_system" (秒), "rss" (字节), "threads", "read_chars", "write_chars"}
+    """
+    user, system = os.times()[:2]
+    res = {
+        "cpu_user": user,
+        "cpu_system": system,
+        "rss": None,
+        "threads": threading.active_count(),
+        "read_chars": None,
+        "write_chars": None,
+    }
+    statm = _read_self("statm")
+    if statm is not None:
+        res["rss"] = int(statm.split()[1]) * _PAGE_SIZE
+    io = _read_self("io")
+    if io is not None:
+        fields = dict(line.split(": ") for line in io.splitlines() if ": " in line)
+        res["read_chars"] = int(fields.get("rchar", 0))
+        res["write_chars"] = int(fields.get("wchar", 0))
+    return res
+
+
+def get_agent_usage():
+    """监测程序自身的资源占用, 另外包括距上一次查询的CPU占用率 cpu_percent"""
+    res = read_agent_usage()
+    now, cpu = time(), res["cpu_user"] + res["cpu_system"]
+    with _lock:
+        last_time, last_cpu = _last_usage
+        _last_usage[:] = [now, cpu]
+    res["cpu_percent"] = (cpu - last_cpu) * 100.0 / (now - last_time) if now > last_time else 0.0
+    return res
+
+
+def get_self_stats(prefix=""):
+    """自身监测数据 (供RPC使用)"""
+    return {
+        "enabled": SELF_MONITOR_ENABLED,
+        "io_sample": SELF_MONITOR_IO_SAMPLE,
+        "buckets": list(LATENCY_BUCKETS),
+        "agent": get_agent_usage(),
+        "functions": get_function_stats(prefix),
+    }
+
+
+def reset():
+    """清空所有计数"""
+    with _lock:
+        _retired.clear()
+        for thread, stats in _threads.values():
+            stats.clear()
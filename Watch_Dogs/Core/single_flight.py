@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# encoding:utf-8
+
+"""
+进程监测核心功能实现 - 相同请求合并(single-flight)
+
+主要包括
+- 同时发生的相同调用(函数+参数相同)只执行一次,其余调用等待并共享该次执行的结果
+- 执行完成后的结果在一段时间(按函数配置)内可以直接复用
+- 装饰器 single_flight
+
+例 : 十个客户端同时调用 get_disk_stat(), 只会执行一次 statvfs 遍历.
+执行出错时等待中的调用共享该异常,但出错的结果不会被复用.
+
+reference   :   https://pkg.go.dev/golang.org/x/sync/singleflight
+"""
+
+import threading
+from time import time
+from functools import wraps
+
+
+class _Call(object):
+    """一次执行 (进行中或已完成)"""
+    __slots__ = ("event", "result", "exception", "expire")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exception = None
+        self.expire = 0
+
+
+class SingleFlight(object):
+    """相同请求合并 (线程安全)"""
+
+    # 记录超过该数量时清理过期结果
+    PURGE_SIZE = 4096
+
+    def __init__(self, freshness=None, default_freshness=0):
+        """
+        :param freshness: 函数名 -> 结果复用时间(秒)
+        :param default_freshness: 未配置的函数的结果复用时间(秒), 0 - 只合并同时发生的调用
+        """
+        self.freshness = dict(freshness or {})
+        self.default_freshness = default_freshness
+        self._calls = {}  # 键 -> _Call
+        self._lock = threading.Lock()
+        self.calls = 0  # 实际执行次数
+        self.shared = 0  # 等待进行中的执行的次数
+        self.reused = 0  # 复用已完成结果的次数
+
+    def set_freshness(self, name, seconds):
+        """设置函数的结果复用时间"""
+        with self._lock:
+            self.freshness[name] = seconds
+
+    def do(self, key, func, *args, **kwargs):
+        """
+        执行 func(*args, **kwargs), 相同键的调用合并
+        :param key: 调用键 (函数名, 参数...) - 第一项为函数名,用于查找结果复用时间
+        """
+        now = time()
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                if not call.event.is_set():
+                    self.shared += 1
+                elif call.expire > now:
+                    self.reused += 1
+                else:
+                    call = None
+            leader = call is None
+            if leader:
+                if len(self._calls) >= self.PURGE_SIZE:
+                    self._purge(now)
+                call = _Call()
+                self._calls[key] = call
+                self.calls += 1
+
+        if leader:
+            try:
+                call.result = func(*args, **kwargs)
+            except Exception as err:
+                call.exception = err
+            with self._lock:
+                freshness = self.freshness.get(key[0], self.default_freshness)
+                call.expire = time() + freshness
+                # 出错或不需要复用的结果,执行完成后立即删除
+                if (call.exception is not None or freshness <= 0) and self._calls.get(key) is call:
+                    del self._calls[key]
+                call.event.set()
+        else:
+            call.event.wait()
+
+        if call.exception is not None:
+            raise call.exception
+        return call.result
+
+    def _purge(self, now):
+        """清理过期结果 (需持有锁)"""
+        for key in [k for k, c in self._calls.items() if c.event.is_set() and c.expire <= now]:
+            del self._calls[key]
+
+    def forget(self, key):
+        """删除某一调用的结果 (下次调用重新执行)"""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None and call.event.is_set():
+                del self._calls[key]
+
+    def clear(self):
+        """删除所有已完成的结果"""
+        with self._lock:
+            for key in [k for k, c in self._calls.items() if c.event.is_set()]:
+                del self._calls[key]
+
+    def get_status(self):
+        """状态"""
+        with self._lock:
+            inflight = sum(1 for c in self._calls.values() if not c.event.is_set())
+            return {"inflight": inflight, "cached": len(self._calls) - inflight,
+                    "calls": self.calls, "shared": self.shared, "reused": self.reused}
+
+
+def make_key(name, args=(), kwargs=None):
+    """生成调用键 (参数中的 list/dict 转换为可哈希类型)"""
+
+    def hashable(value):
+        if isinstance(value, dict):
+            return tuple(sorted((k, hashable(v)) for k, v in value.items()))
+        if isinstance(value, (list, tuple)):
+            return tuple(hashable(v) for v in value)
+        if isinstance(value, set):
+            return tuple(sorted(value))
+        return value
+
+    return (name, hashable(args), hashable(kwargs or {}))
+
+
+def single_flight(freshness=0):
+    """装饰器 - 同时发生的相同调用只执行一次, 结果复用 freshness 秒"""
+
+    def decorator(func):
+        flight = SingleFlight({func.__name__: freshness})
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            return flight.do(make_key(func.__name__, args, kwargs), func, *args, **kwargs)
+
+        wrapper.single_flight = flight
+        return wrapper
+
+    return decorator
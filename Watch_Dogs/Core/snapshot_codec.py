@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# encoding:utf-8
+
+"""
+进程监测核心功能实现 - 快照二进制编码
+
+主要包括
+- 采集快照 : 系统数据 + 所有进程的stat数据及命令行
+- 快照编码为带版本号的二进制帧
+    - 完整帧 : 定长数值列(按列存放) + 字符串表(comm/cmdline)
+    - 增量帧 : 相对上一帧只包含 新增的字符串, 退出的进程, 发生变化的进程及其变化的字段
+- 解码器按顺序应用帧,还原出与编码前一致的快照
+
+快照格式
+{
+    "seq": 帧序号,
+    "time": 采集时间,
+    "system": {名称: 数值},
+    "process": {pid: {字段: 值}}
+}
+
+帧格式 (小端)
+    帧头   : magic(4s) 版本(B) 帧类型(B) 字段数(H) 序号(I) 基准序号(I) 时间(d)
+            新字符串数(I) 新字符串起始编号(I) 系统数据数(I) 进程数(I) 退出进程数(I)
+    字符串 : [长度(I) + utf-8数据] * 新字符串数
+    系统   : [名称字符串编号(I) + 数值(d)] * 系统数据数
+    完整帧 : pid列(I * 进程数) + 每个字段一列(字段类型 * 进程数)
+    增量帧 : 退出进程pid(I * 退出进程数) + [pid(I) + 变化字段位图(I) + 变化字段的值] * 进程数
+"""
+
+import struct
+from time import time
+
+from bulk_collect import bulk_get_process_stat
+from sampler import read_cpu_times
+from sys_monitor import get_mem_info, get_sys_loadavg
+
+SNAPSHOT_MAGIC = b"WDSN"
+SNAPSHOT_VERSION = 1
+
+FRAME_FULL = 0
+FRAME_DELTA = 1
+
+# 进程字段 (字段名, struct类型), S - 字符串(存放字符串表编号), 增量帧位图最多支持32个字段
+PROCESS_FIELDS = (
+    ("ppid", "I"),
+    ("pgrp", "I"),
+    ("session", "I"),
+    ("tty_nr", "i"),
+    ("state", "B"),
+    ("num_threads", "I"),
+    ("priority", "i"),
+    ("nice", "i"),
+    ("processor", "i"),
+    ("starttime", "Q"),
+    ("utime", "Q"),
+    ("stime", "Q"),
+    ("cutime", "q"),
+    ("cstime", "q"),
+    ("minflt", "Q"),
+    ("majflt", "Q"),
+    ("vsize", "Q"),
+    ("rss", "q"),
+    ("comm", "S"),
+    ("cmdline", "S"),
+)
+
+# 完整帧之间最多的增量帧数量
+SNAPSHOT_FULL_INTERVAL = 60
+# 字符串表超过该数量时发送完整帧(重建字符串表,丢弃已经不用的字符串)
+SNAPSHOT_MAX_STRINGS = 65536
+
+_HEADER = struct.Struct("<4sBBHIIdIIIII")
+_LENGTH = struct.Struct("<I")
+_SYSTEM_ITEM = struct.Struct("<Id")
+_ROW_HEAD = struct.Struct("<II")
+_FIELD_CODES = [("I" if code == "S" else code) for name, code in PROCESS_FIELDS]
+_FIELD_STRUCTS = [struct.Struct("<" + code) for code in _FIELD_CODES]
+
+
+class SnapshotCodecError(Exception):
+    """快照编解码错误 (格式/版本不匹配, 增量帧与解码器状态不连续)"""
+    pass
+
+
+def collect_snapshot(pids=None):
+    """采集快照 (系统数据 + 进程stat数据及命令行)"""
+    cpu, cores = read_cpu_times()
+    mem_total, mem_free, mem_available = get_mem_info()
+    loadavg = get_sys_loadavg()
+    load1, load5, load15 = float(loadavg["lavg_1"]), float(loadavg["lavg_5"]), float(loadavg["lavg_15"])
+    system = {
+        "cpu_total_time": cpu[0],
+        "cpu_work_time": cpu[1],
+        "mem_total": mem_total,
+        "mem_free": mem_free,
+        "mem_available": mem_available,
+        "load_1": load1,
+        "load_5": load5,
+        "load_15": load15,
+    }
+    process = {}
+    for pid, stat in bulk_get_process_stat(pids, with_cmdline=True)["data"].items():
+        process[int(pid)] = dict((name, stat[name]) for name, code in PROCESS_FIELDS)
+    return {"seq": 0, "time": time(), "system": system, "process": process}
+
+
+def _to_unicode(s):
+    """字符串转换为 unicode (用于 utf-8 编码)"""
+    if isinstance(s, unicode):
+        return s
+    return s.decode("utf-8", "replace")
+
+
+class SnapshotEncoder(object):
+    """快照编码器 (保存上一帧状态,生成增量帧)"""
+
+    def __init__(self, full_interval=SNAPSHOT_FULL_INTERVAL, max_strings=SNAPSHOT_MAX_STRINGS):
+        self.full_interval = full_interval
+        self.max_strings = max_strings
+        self.seq = 0
+        self._strings = []  # 字符串表
+        self._string_index = {}  # 字符串 -> 编号
+        self._rows = {}  # pid -> 编码后的字段值(字符串为编号)
+        self._system = {}
+        self._time = 0
+        self._since_full = 0
+
+    def _string_id(self, s):
+        """字符串编号 (新字符串加入字符串表)"""
+        index = self._string_index.get(s)
+        if index is None:
+            index = len(self._strings)
+            self._strings.append(s)
+            self._string_index[s] = index
+        return index
+
+    def _encode_row(self, row):
+        """进程数据转换为字段值元组"""
+        values = []
+        for name, code in PROCESS_FIELDS:
+            value = row[name]
+            if code == "S":
+                value = self._string_id(value)
+            elif code == "B":
+                value = ord(value)
+            values.append(value)
+        return tuple(values)
+
+    def _reset(self):
+        """重建字符串表"""
+        self._strings = []
+        self._string_index = {}
+        self._since_full = 0
+
+    def encode(self, snapshot):
+        """编码快照, 返回帧数据 (需要时生成完整帧,其余为增量帧)"""
+        full = self.seq == 0 or self._since_full >= self.full_interval or len(self._strings) >= self.max_strings
+        if full:
+            self._reset()
+        string_base = len(self._strings)
+        rows = dict((int(pid), self._encode_row(row)) for pid, row in snapshot["process"].items())
+        system = dict((name, float(value)) for name, value in snapshot["system"].items())
+        for name in system:
+            self._string_id(name)
+
+        base_seq = self.seq
+        prev_rows = self._rows
+        self.seq += 1
+        self._rows = rows
+        self._system = system
+        self._time = snapshot["time"]
+        if full:
+            return self.encode_full()
+
+        self._since_full += 1
+        removed = [pid for pid in prev_rows if pid not in rows]
+        changed = []
+        for pid, values in rows.items():
+            prev = prev_rows.get(pid)
+            if prev is None:
+                changed.append((pid, (1 << len(values)) - 1, values))
+            elif prev != values:
+                mask = 0
+                for i in range(len(values)):
+                    if values[i] != prev[i]:
+                        mask |= 1 << i
+                changed.append((pid, mask, values))
+
+        parts = [self._header(FRAME_DELTA, base_seq, string_base, len(changed), len(removed)),
+                 self._pack_strings(string_base), self._pack_system(),
+                 struct.pack("<{}I".format(len(removed)), *removed)]
+        for pid, mask, values in changed:
+            parts.append(_ROW_HEAD.pack(pid, mask))
+            parts.append(struct.pack("<" + "".join(_FIELD_CODES[i] for i in range(len(values)) if mask >> i & 1),
+                                     *[values[i] for i in range(len(values)) if mask >> i & 1]))
+        return b"".join(parts)
+
+    def encode_full(self):
+        """当前状态编码为完整帧 (不改变编码器状态,用于新的接收方同步)"""
+        pids = sorted(self._rows)
+        parts = [self._header(FRAME_FULL, self.seq, 0, len(pids), 0), self._pack_strings(0), self._pack_system(),
+                 struct.pack("<{}I".format(len(pids)), *pids)]
+        for i, code in enumerate(_FIELD_CODES):
+            parts.append(struct.pack("<{}{}".format(len(pids), code), *[self._rows[pid][i] for pid in pids]))
+        return b"".join(parts)
+
+    def _header(self, frame_type, base_seq, string_base, n_rows, n_removed):
+        """帧头"""
+        return _HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, frame_type, len(PROCESS_FIELDS), self.seq, base_seq,
+                            self._time, len(self._strings) - string_base, string_base, len(self._system), n_rows,
+                            n_removed)
+
+    def _pack_strings(self, start):
+        """字符串表(从start开始)"""
+        parts = []
+        for s in self._strings[start:]:
+            data = _to_unicode(s).encode("utf-8")
+            parts.append(_LENGTH.pack(len(data)))
+            parts.append(data)
+        return b"".join(parts)
+
+    def _pack_system(self):
+        """系统数据"""
+        return b"".join(_SYSTEM_ITEM.pack(self._string_index[name], value)
+                        for name, value in sorted(self._system.items()))
+
+
+class SnapshotDecoder(object):
+    """快照解码器 (按顺序应用帧)"""
+
+    def __init__(self):
+        self.seq = 0
+        self._strings = []
+        self._rows = {}  # pid -> 字段值列表(字符串为编号)
+
+    def decode(self, data):
+        """解码一帧,返回应用该帧之后的快照"""
+        data = bytes(data)
+        if len(data) < _HEADER.size:
+            raise SnapshotCodecError("frame too short")
+        magic, version, frame_type, field_count, seq, base_seq, frame_time, n_strings, string_base, n_system, \
+            n_rows, n_removed = _HEADER.unpack_from(data, 0)
+        if magic != SNAPSHOT_MAGIC:
+            raise SnapshotCodecError("bad magic : {!r}".format(magic))
+        if version != SNAPSHOT_VERSION or field_count != len(PROCESS_FIELDS):
+            raise SnapshotCodecError("unsupported snapshot version : {} ({} fields)".format(version, field_count))
+        if frame_type == FRAME_DELTA and (base_seq != self.seq or string_base != len(self._strings)):
+            raise SnapshotCodecError("delta frame {} does not follow frame {}".format(seq, self.seq))
+        if frame_type not in (FRAME_FULL, FRAME_DELTA):
+            raise SnapshotCodecError("unknown frame type : {}".format(frame_type))
+
+        try:
+            offset = _HEADER.size
+            strings = [] if frame_type == FRAME_FULL else list(self._strings)
+            for _ in range(n_strings):
+                length, = _LENGTH.unpack_from(data, offset)
+                offset += _LENGTH.size
+                strings.append(data[offset:offset + length].decode("utf-8"))
+                offset += length
+
+            system = {}
+            for _ in range(n_system):
+                index, value = _SYSTEM_ITEM.unpack_from(data, offset)
+                offset += _SYSTEM_ITEM.size
+                system[strings[index]] = value
+
+            if frame_type == FRAME_FULL:
+                rows = self._decode_full(data, offset, n_rows)
+            else:
+                rows = self._decode_delta(data, offset, n_rows, n_removed)
+        except (struct.error, IndexError, UnicodeDecodeError) as err:
+            raise SnapshotCodecError("corrupted frame {} : {}".format(seq, err))
+
+        self._strings = strings
+        self._rows = rows
+        self.seq = seq
+        return {"seq": seq, "time": frame_time, "system": system, "process": self._to_process(rows, strings)}
+
+    @staticmethod
+    def _decode_full(data, offset, n_rows):
+        """完整帧 - 按列读取"""
+        pids = struct.unpack_from("<{}I".format(n_rows), data, offset)
+        offset += 4 * n_rows
+        columns = []
+        for code in _FIELD_CODES:
+            fmt = struct.Struct("<{}{}".format(n_rows, code))
+            columns.append(fmt.unpack_from(data, offset))
+            offset += fmt.size
+        return dict((pid, list(values)) for pid, values in zip(pids, zip(*columns)))
+
+    def _decode_delta(self, data, offset, n_rows, n_removed):
+        """增量帧 - 在上一帧的基础上应用变化"""
+        rows = dict(self._rows)
+        for pid in struct.unpack_from("<{}I".format(n_removed), data, offset):
+            rows.pop(pid, None)
+        offset += 4 * n_removed
+        field_count = len(PROCESS_FIELDS)
+        for _ in range(n_rows):
+            pid, mask = _ROW_HEAD.unpack_from(data, offset)
+            offset += _ROW_HEAD.size
+            values = list(rows[pid]) if pid in rows else [0] * field_count
+            for i in range(field_count):
+                if mask >> i & 1:
+                    values[i], = _FIELD_STRUCTS[i].unpack_from(data, offset)
+                    offset += _FIELD_STRUCTS[i].size
+            rows[pid] = values
+        return rows
+
+    @staticmethod
+    def _to_process(rows, strings):
+        """字段值转换为进程数据"""
+        process = {}
+        for pid, values in rows.items():
+            row = {}
+            for (name, code), value in zip(PROCESS_FIELDS, values):
+                if code == "S":
+                    value = strings[value]
+                elif code == "B":
+                    value = chr(value)
+                row[name] = value
+            process[pid] = row
+        return process
+
+
+def encode_snapshot(snapshot):
+    """快照编码为一个独立的完整帧"""
+    return SnapshotEncoder().encode(snapshot)
+
+
+def decode_snapshot(data):
+    """解码一个独立的完整帧"""
+    return SnapshotDecoder().decode(data)
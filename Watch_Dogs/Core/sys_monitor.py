@@ -22,6 +22,7 @@ reference   :   https://www.kernel.org/doc/Documentation/filesystems/proc.txt
 from os import statvfs
 from time import sleep, time
 
+from proc_root import proc_path, proc_ns_path
 from prcess_exception import wrap_process_exceptions
 
 calc_func_interval = 2
@@ -121,7 +122,7 @@ def get_total_cpu_time():
     # sum everything up (except guest and guestnice since they are already included
     # in user and nice, see http://unix.stackexchange.com/q/178045/20626)
 
-    with open("/proc/stat", "r") as cpu_stat:
+    with open(proc_path("stat"), "r") as cpu_stat:
         total_cpu_time = cpu_stat.readline().replace('cpu', '').strip()
         user, nice, system, idle, iowait, irq, softirq, steal, guest, guestnice = map(int, total_cpu_time.split(' '))
         return user + nice + system + idle + iowait + irq + softirq + steal, user + nice + system
@@ -145,7 +146,7 @@ def get_cpu_total_time_by_cores():
     """获取各核心cpu时间 - /proc/stat"""
     cpu_total_times = {}
 
-    with open("/proc/stat", "r") as cpu_stat:
+    with open(proc_path("stat"), "r") as cpu_stat:
         for line in cpu_stat:
             if line.startswith("cpu"):
                 cpu_name = line.split(' ')[0].strip()
@@ -384,7 +385,7 @@ def get_mem_info():
         (x86 with CONFIG_X86_64 and CONFIG_X86_DIRECT_GBPAGES enabled.)
     """
 
-    with open("/proc/meminfo", "r") as mem_info:
+    with open(proc_path("meminfo"), "r") as mem_info:
         MemTotal = mem_info.readline().split(":")[1].strip().strip("kB")
         MemFree = mem_info.readline().split(":")[1].strip().strip("kB")
         MemAvailable = mem_info.readline().split(":")[1].strip().strip("kB")
@@ -418,7 +419,7 @@ def get_all_net_device():
     # tpp0      -   ...
 
     devices = []
-    with open("/proc/net/dev", "r") as net_dev:
+    with open(proc_ns_path("net/dev"), "r") as net_dev:
         for line in net_dev:
             if not line.count("lo:") and line.count(":"):
                 devices.append(line.split(":")[0].strip())
@@ -463,7 +464,7 @@ def get_net_dev_data(device):
     """
     receive_bytes = -1
     send_bytes = -1
-    with open("/proc/net/dev", "r") as net_dev:
+    with open(proc_ns_path("net/dev"), "r") as net_dev:
         for line in net_dev:
             if line.count(device):
                 dev_data = map(int, filter(lambda x: x, line.split(":", 2)[1].strip().split(" ")))
@@ -508,7 +509,7 @@ def get_cpu_info():
 
     result = []
     c = ""
-    with open("/proc/cpuinfo", "r") as cpuinfo:
+    with open(proc_path("cpuinfo"), "r") as cpuinfo:
         for line in cpuinfo:
             if line.startswith("processor"):
                 c = ""
@@ -538,7 +539,7 @@ def get_sys_info():
     """
 
     sys_info = {"kernel": "", "system": ""}
-    with open("/proc/version", "r") as version:
+    with open(proc_path("version"), "r") as version:
         sys_info_data = version.readline()
     sys_info["kernel"] = sys_info_data.split('(')[0].strip()
     sys_info["system"] = sys_info_data.split('(')[3].split(')')[0].strip()
@@ -550,7 +551,7 @@ def get_sys_info():
 def get_sys_total_mem():
     """获取总内存大小 - /proc/meminfo"""
 
-    with open("/proc/meminfo", "r") as mem_info:
+    with open(proc_path("meminfo"), "r") as mem_info:
         MemTotal = mem_info.readline().split(":")[1].strip().strip("kB")
 
     return MemTotal
@@ -573,7 +574,7 @@ def get_sys_loadavg():
 
     la = {}
 
-    with open("/proc/loadavg", "r") as loadavg:
+    with open(proc_path("loadavg"), "r") as loadavg:
         la['lavg_1'], la['lavg_5'], la['lavg_15'], la['nr'], la['last_pid'] = \
             loadavg.readline().split()
 
@@ -598,7 +599,7 @@ def get_sys_uptime():
         return "%d Days %d hours %02d min %02d secs" % (d, h, m, s)
 
     ut = {}
-    with open("/proc/uptime", "r") as uptime:
+    with open(proc_path("uptime"), "r") as uptime:
         system_uptime, idle_time = map(float, uptime.readline().split())
         ut["system_uptime"] = second2time_str(int(system_uptime))
         ut["idle_time"] = idle_time
@@ -629,7 +630,7 @@ def get_disk_stat(style='G'):
         """
 
         mount_points = {}
-        with open("/proc/mounts", "r") as mounts:
+        with open(proc_ns_path("mounts"), "r") as mounts:
             for line in mounts.readlines():
                 spl = line.split()
                 if len(spl) < 4:
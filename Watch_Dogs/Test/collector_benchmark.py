@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+# encoding:utf-8
+
+"""
+采集函数性能测试
+
+主要包括
+- 生成测试数据 : 类似 procfs 的进程目录(1k/10k/100k个pid), 文件夹树, 大日志文件 (生成一次, 之后复用)
+- 对各采集函数计时 : 每秒操作数, 延迟百分位数(p50/p95/p99/max), 内存分配
+- 结果输出为 JSON, 可以与之前的结果对比 (--compare), 用于发现不同提交之间的性能退化
+
+内存分配 : Python3 使用 tracemalloc 统计单次调用的峰值分配字节数,
+          Python2 统计单次调用中新增的 gc 跟踪对象数量(关闭gc时第0代计数器的增量)及进程最大RSS.
+
+生成的进程目录通过 proc_root.use_proc_root 作为 proc 根目录, 与真实 /proc 使用相同的采集函数.
+
+calc_* 系列函数在调用时 sleep, 测试的是后台采样器(sampler)完成同样计算的耗时 (一次采样 + 计算).
+
+用法
+    python collector_benchmark.py --sizes 1000,10000 --log-size 256M --output result.json
+    python collector_benchmark.py --sizes 100000 --log-size 4G --compare result.json
+"""
+
+import os
+import gc
+import sys
+import json
+import random
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+from array import array
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Core"))
+
+import sys_monitor
+import process_monitor
+import process_manage
+from bulk_collect import bulk_get_process_stat, bulk_get_process_info, bulk_get_process_mem, bulk_get_process_io
+from snapshot_codec import collect_snapshot
+from sampler import Sampler
+from metrics_query import percentiles
+from proc_root import use_proc_root
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# 测试数据目录
+BENCH_DATA_PATH = os.path.join(tempfile.gettempdir(), "watch_dogs_bench")
+# 每项测试的最短运行时间(秒) / 最少及最多调用次数
+BENCH_MIN_TIME = 1.0
+BENCH_MIN_RUNS = 3
+BENCH_MAX_RUNS = 100000
+# 与之前结果对比时, 每秒操作数下降超过该比例视为性能退化
+BENCH_REGRESSION_RATIO = 0.1
+
+_COMMS = ("python", "nginx", "sshd", "java", "Web Content", "kworker/0:1", "a) b (c")
+
+
+def _parse_size(text):
+    """64M -> 67108864"""
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    if text[-1].upper() in units:
+        return int(float(text[:-1]) * units[text[-1].upper()])
+    return int(text)
+
+
+def _write(path, data):
+    """写入文件"""
+    with open(path, "w") as f:
+        f.write(data)
+
+
+def make_proc_tree(root, count):
+    """
+    生成类似 /proc 的目录 : count 个进程的 stat/status/io/cmdline/comm/statm/task, 以及系统的 stat/meminfo/net/dev 等
+    (已经生成过时直接复用)
+    """
+    done = os.path.join(root, ".complete")
+    if os.path.exists(done):
+        return root
+    rand = random.Random(count)
+    for pid in xrange(1, count + 1):
+        path = os.path.join(root, str(pid))
+        if not os.path.exists(path):
+            os.makedirs(os.path.join(path, "task", str(pid)))
+        comm = _COMMS[pid % len(_COMMS)]
+        ppid = 0 if pid == 1 else rand.randint(1, pid - 1)
+        utime, stime, rss = rand.randint(0, 10 ** 6), rand.randint(0, 10 ** 5), rand.randint(100, 10 ** 5)
+        _write(os.path.join(path, "stat"),
+               "{} ({}) S {} {} {} 0 -1 4194560 {} 0 {} 0 {} {} 0 0 20 0 {} 0 {} {} {} 18446744073709551615 "
+               "1 1 0 0 0 0 0 4096 0 0 0 0 17 {} 0 0 0 0 0 0 0 0 0 0 0 0 0\n".format(
+                   pid, comm, ppid, ppid, ppid, rand.randint(0, 10 ** 5), rand.randint(0, 100), utime, stime,
+                   rand.randint(1, 64), rand.randint(0, 10 ** 7), rss * 4096 * 4, rss, pid % 8))
+        _write(os.path.join(path, "comm"), comm + "\n")
+        _write(os.path.join(path, "cmdline"), "/usr/bin/{}\0--worker\0{}\0".format(comm, pid))
+        _write(os.path.join(path, "statm"), "{} {} 500 10 0 {} 0\n".format(rss * 4, rss, rss * 2))
+        _write(os.path.join(path, "io"),
+               "rchar: {}\nwchar: {}\nsyscr: 10\nsyscw: 10\nread_bytes: 0\nwrite_bytes: 0\n"
+               "cancelled_write_bytes: 0\n".format(rand.randint(0, 10 ** 9), rand.randint(0, 10 ** 9)))
+        _write(os.path.join(path, "status"),
+               "Name:\t{}\nState:\tS (sleeping)\nTgid:\t{}\nPid:\t{}\nPPid:\t{}\nUid:\t0\t0\t0\t0\n"
+               "VmRSS:\t{} kB\nThreads:\t1\nNSpid:\t{}\n".format(comm, pid, pid, ppid, rss * 4, pid))
+    # 系统数据 (net/dev, mounts 按命名空间显示, 使用其他根目录时读取1号进程的, 见 proc_root.proc_ns_path)
+    for name in ("stat", "meminfo", "loadavg", "uptime", "cpuinfo", "version"):
+        with open("/proc/" + name) as f:
+            _write(os.path.join(root, name), f.read())
+    if not os.path.isdir(os.path.join(root, "1", "net")):  # 上一次生成中断时已经存在
+        os.makedirs(os.path.join(root, "1", "net"))
+    for name in ("net/dev", "mounts"):
+        with open("/proc/" + name) as f:
+            _write(os.path.join(root, "1", name), f.read())
+    _write(done, str(count))
+    return root
+
+
+def make_dir_tree(root, depth=3, fanout=10, files=5, file_size=1024):
+    """生成文件夹树 (fanout^depth 个文件夹, 每个文件夹 files 个文件)"""
+    done = os.path.join(root, ".complete")
+    if os.path.exists(done):
+        return root
+
+    def make(path, level):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for i in xrange(files):
+            _write(os.path.join(path, "file_{}.dat".format(i)), "x" * file_size)
+        if level < depth:
+            for i in xrange(fanout):
+                make(os.path.join(path, "dir_{}".format(i)), level + 1)
+
+    make(root, 1)
+    _write(done, "")
+    return root
+
+
+def make_log(path, size):
+    """生成日志文件 (约1%的行包含 ERROR)"""
+    if os.path.exists(path) and os.path.getsize(path) >= size:
+        return path
+    rand = random.Random(size)
+    lines = []
+    for i in xrange(10000):
+        level = "ERROR" if rand.random() < 0.01 else rand.choice(("INFO", "DEBUG", "WARNING"))
+        lines.append("2019-12-23 12:00:{:02d},{:03d} {} worker-{} request {} handled in {} ms\n".format(
+            i % 60, i % 1000, level, i % 16, rand.randint(0, 10 ** 9), rand.randint(1, 1000)))
+    block = "".join(lines)
+    with open(path, "w") as f:
+        written = 0
+        while written < size:
+            f.write(block)
+            written += len(block)
+    return path
+
+
+def measure_alloc(func, args):
+    """单次调用的内存分配"""
+    gc.collect()
+    if tracemalloc is not None:
+        tracemalloc.start()
+        func(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return {"peak_bytes": peak}
+    gc.disable()
+    try:
+        before = gc.get_count()[0]
+        func(*args)
+        objects = gc.get_count()[0] - before
+    finally:
+        gc.enable()
+    return {"gc_objects": objects, "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def run_bench(name, func, args=(), min_time=BENCH_MIN_TIME, min_runs=BENCH_MIN_RUNS, max_runs=BENCH_MAX_RUNS):
+    """对 func(*args) 计时, 返回测试结果"""
+    func(*args)  # 预热 (文件缓存)
+    latencies = array("d")
+    start = time()
+    while len(latencies) < max_runs:
+        t = time()
+        func(*args)
+        latencies.append(time() - t)
+        if len(latencies) >= min_runs and time() - start >= min_time:
+            break
+    total = sum(latencies)
+    latency = dict((k, v * 1000) for k, v in percentiles(latencies, (50, 95, 99)).items())
+    latency["max"] = max(latencies) * 1000
+    latency["mean"] = total / len(latencies) * 1000
+    return {
+        "name": name,
+        "runs": len(latencies),
+        "ops_per_sec": len(latencies) / total if total else None,
+        "latency_ms": latency,
+        "alloc": measure_alloc(func, args),
+    }
+
+
+def procfs_benchmarks(root):
+    """进程目录测试 (在生成的 procfs 上运行采集函数)"""
+
+    def in_root(func):
+        def wrapper(*args):
+            with use_proc_root(root):
+                return func(*args)
+
+        return wrapper
+
+    sampler = Sampler(proc_root=root)
+    for pid in xrange(1, 1001):
+        sampler.watch_process(pid)
+    return [(name, in_root(func), args) for name, func, args in (
+        ("get_all_pid", process_monitor.get_all_pid, ()),
+        ("get_process_info", process_monitor.get_process_info, (1,)),
+        ("get_all_pid_name", process_manage.get_all_pid_name, ()),
+        ("search_pid_by_keyword", process_manage.search_pid_by_keyword, ("nginx",)),
+        ("get_process_tree", process_manage.get_process_tree, (1,)),
+        ("bulk_get_process_stat", bulk_get_process_stat, ()),
+        ("bulk_get_process_info", bulk_get_process_info, ()),
+        ("bulk_get_process_mem", bulk_get_process_mem, ()),
+        ("bulk_get_process_io", bulk_get_process_io, ()),
+        ("collect_snapshot", collect_snapshot, ()),
+        ("sample_1000_process", sampler.sample_once, ()),
+        ("get_disk_stat", sys_monitor.get_disk_stat, ()),
+    )]
+
+
+def system_benchmarks(dir_tree, log_path):
+    """当前系统上的采集函数测试"""
+    pid = os.getpid()
+    device = sys_monitor.get_default_net_device()
+    sampler = Sampler()
+    sampler.watch_process(pid)
+    sampler.sample_once()
+
+    def sampled(get, *args):
+        sampler.sample_once()
+        return get(*args)
+
+    return [
+        # 系统
+        ("get_total_cpu_time", sys_monitor.get_total_cpu_time, ()),
+        ("get_cpu_total_time_by_cores", sys_monitor.get_cpu_total_time_by_cores, ()),
+        ("get_mem_info", sys_monitor.get_mem_info, ()),
+        ("calc_mem_percent", sys_monitor.calc_mem_percent, ()),
+        ("get_all_net_device", sys_monitor.get_all_net_device, ()),
+        ("get_net_dev_data", sys_monitor.get_net_dev_data, (device,)),
+        ("get_cpu_info", sys_monitor.get_cpu_info, ()),
+        ("get_sys_loadavg", sys_monitor.get_sys_loadavg, ()),
+        ("get_sys_uptime", sys_monitor.get_sys_uptime, ()),
+        ("get_disk_stat", sys_monitor.get_disk_stat, ()),
+        ("calc_cpu_percent", sampled, (sampler.get_cpu_percent,)),
+        ("calc_cpu_percent_by_cores", sampled, (sampler.get_cpu_percent_by_cores,)),
+        ("calc_net_speed", sampled, (sampler.get_net_speed, device)),
+        # 进程
+        ("get_all_pid", process_monitor.get_all_pid, ()),
+        ("get_process_info", process_monitor.get_process_info, (pid,)),
+        ("get_process_cpu_time", process_monitor.get_process_cpu_time, (pid,)),
+        ("get_process_start_time", process_monitor.get_process_start_time, (pid,)),
+        ("get_process_mem", process_monitor.get_process_mem, (pid,)),
+        ("get_process_io", process_monitor.get_process_io, (pid,)),
+        ("calc_process_cpu_percent", sampled, (sampler.get_process_cpu_percent, pid)),
+        ("calc_process_cpu_io", sampled, (sampler.get_process_io_speed, pid)),
+        ("get_all_pid_name", process_manage.get_all_pid_name, ()),
+        ("get_process_tree", process_manage.get_process_tree, (1,)),
+        ("bulk_get_process_stat", bulk_get_process_stat, ()),
+        ("bulk_get_process_info", bulk_get_process_info, ()),
+        ("collect_snapshot", collect_snapshot, ()),
+        # 文件夹
+        ("get_path_total_size", process_monitor.get_path_total_size, (dir_tree,)),
+        ("get_path_avail_size", process_monitor.get_path_avail_size, (dir_tree,)),
+        # 日志
+        ("is_log_exist", process_monitor.is_log_exist, (log_path,)),
+        ("get_log_head", process_monitor.get_log_head, (log_path,)),
+        ("get_log_tail", process_monitor.get_log_tail, (log_path,)),
+        ("get_log_last_update_time", process_monitor.get_log_last_update_time, (log_path,)),
+        ("get_log_keyword_lines", process_monitor.get_log_keyword_lines, (log_path, "ERROR")),
+    ]
+
+
+def _git_commit():
+    """当前提交 (不在git仓库中返回None)"""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, base_path, ratio=BENCH_REGRESSION_RATIO):
+    """与之前的结果对比, 返回性能退化的测试项"""
+    with open(base_path) as f:
+        base = dict((r["name"], r) for r in json.load(f)["results"])
+    regressions = []
+    for res in results:
+        old = base.get(res["name"])
+        if old is None or not old.get("ops_per_sec") or not res.get("ops_per_sec"):  # 之前或本次出错
+            continue
+        change = res["ops_per_sec"] / old["ops_per_sec"] - 1
+        sys.stderr.write("{:<45} {:>12.1f} -> {:>12.1f} ops/s  {:+.1%}{}\n".format(
+            res["name"], old["ops_per_sec"], res["ops_per_sec"], change, "  REGRESSION" if change < -ratio else ""))
+        if change < -ratio:
+            regressions.append(res["name"])
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Watch_Dogs collector benchmark")
+    parser.add_argument("--sizes", default="1000,10000", help="procfs pid counts, e.g. 1000,10000,100000")
+    parser.add_argument("--log-size", default="64M", help="synthetic log size, e.g. 256M, 4G")
+    parser.add_argument("--data", default=BENCH_DATA_PATH, help="directory for generated fixtures")
+    parser.add_argument("--min-time", type=float, default=BENCH_MIN_TIME, help="minimum seconds per benchmark")
+    parser.add_argument("--filter", default=None, help="only run benchmarks whose name contains this text")
+    parser.add_argument("--output", default=None, help="write JSON result to this file (default stdout)")
+    parser.add_argument("--compare", default=None, help="previous JSON result to compare with")
+    args = parser.parse_args()
+
+    log_size = _parse_size(args.log_size)
+    benchmarks = []
+    for size in [int(s) for s in args.sizes.split(",") if s]:
+        root = make_proc_tree(os.path.join(args.data, "proc_{}".format(size)), size)
+        benchmarks.extend(("procfs_{}.{}".format(size, name), func, func_args)
+                          for name, func, func_args in procfs_benchmarks(root))
+    dir_tree = make_dir_tree(os.path.join(args.data, "dir_tree"))
+    log_path = make_log(os.path.join(args.data, "log_{}.log".format(args.log_size)), log_size)
+    benchmarks.extend(system_benchmarks(dir_tree, log_path))
+
+    results = []
+    for name, func, func_args in benchmarks:
+        if args.filter and args.filter not in name:
+            continue
+        try:
+            res = run_bench(name, func, func_args, args.min_time)
+        except Exception as err:
+            res = {"name": name, "error": "{}: {}".format(type(err).__name__, err)}
+        results.append(res)
+        sys.stderr.write("{:<45} {}\n".format(name, "{:.1f} ops/s".format(res["ops_per_sec"])
+                                              if res.get("ops_per_sec") else res.get("error")))
+
+    report = {
+        "meta": {
+            "time": time(),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.sysconf("SC_NPROCESSORS_ONLN"),
+            "log_size": log_size,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        print json.dumps(report, indent=2, sort_keys=True)
+
+    if args.compare:
+        if compare([r for r in results if "error" not in r], args.compare):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()